@@ -1,15 +1,22 @@
+import collections
 import os
-import time
 import pprint
 import click
+from concurrent.futures.process import BrokenProcessPool
 from watchdog.observers import Observer
 
 from . import config
+from . import geocode
+from . import log
 from . import metadata
-from .color import vprint, vvprint, error, info
-from .keywords import keywords_to_hash, hash_to_acdsee
+from . import query
+from . import stats
+from .catalog import get_catalog, entry as catalog_entry, mode as catalog_mode
+from .manifest import get_manifest
+from .log import vprint, vvprint, error, info
+from .keywords import KeywordCounts, KeywordTrie
 from . import changes
-from .util import file_age, remove_duplicates, walk
+from .util import batched, default_jobs, files_to_walk, pool, walk
 
 
 class CommonCommand(click.Command):
@@ -25,6 +32,27 @@ class CommonCommand(click.Command):
                                                 help="Be chatty. More is more chatty!"))
         self.params.insert(0, click.core.Option(('-d', '--dry-run'), default=False, is_flag=True,
                                                 help="Don't really do the work"))
+        self.params.append(click.core.Option(('--stats',), default=False, is_flag=True,
+                                             help="Print how long things took when done"))
+        self.params.append(click.core.Option(('--stats-json',), default=False, is_flag=True,
+                                             help="Print how long things took, as JSON, when done"))
+        self.params.append(click.core.Option(('--log-json',), default=None,
+                                             help="Also append the messages, as JSON lines, to this file"))
+
+    def invoke(self, ctx):
+        show_stats = ctx.params.pop('stats', False)
+        json_stats = ctx.params.pop('stats_json', False)
+        log_json = ctx.params.pop('log_json', None)
+        if show_stats or json_stats:
+            stats.enable()
+        if log_json is not None:
+            log.open_json(log_json)
+        try:
+            return super().invoke(ctx)
+        finally:
+            if show_stats or json_stats:
+                stats.report(as_json=json_stats)
+            log.close_json()
 
 
 pp = pprint.PrettyPrinter(indent=4)
@@ -55,42 +83,129 @@ def _build_options(dry_run, verbose, no_color, config_file, keyword_file, recurs
 
 
 def _tidy_unknown_people(cfg, keywords):
-    tidy_keywords = []
+    """Drop unknown people who have since been given a name.
+
+    `keywords` is a `KeywordTrie`, it is changed in place. Returns the
+    keywords that were dropped.
+    """
     known_people = set()
     unknown_people = []
-    for keyword in keywords:
-        topics = keyword.split('|')
-        pp.pprint(topics)
-        if topics[0].lower() == cfg.people_prefix.lower():
-            if topics[1].lower() == cfg.people_unknown_prefix.lower():
-                unknown_people.append(keyword)
+    for topic, people in list(keywords.items()):
+        if topic.lower() != cfg.people_prefix_lower:
+            continue
+        for group, _ in list(people.items()):
+            group_keywords = keywords.keywords(f'{topic}|{group}')
+            if group.lower() == cfg.people_unknown_prefix_lower:
+                unknown_people.extend(group_keywords)
             else:
-                tidy_keywords.append(keyword)
-                known_people.add(topics[-1])
-        else:
-            tidy_keywords.append(keyword)
+                known_people.update(keyword.rpartition('|')[2] for keyword in group_keywords)
+
+    removed = [unknown for unknown in unknown_people if unknown.rpartition('|')[2] in known_people]
+    for unknown in removed:
+        keywords.remove(unknown)
+
+    return removed
+
+
+# What a callback hands back instead of its result when the location of its
+# file has to be looked up first, see `_geocoded_walk`.
+Lookup = collections.namedtuple('Lookup', ['file', 'coords'])
+
+
+def _cached_places(cfg, m):
+    """Return `places` for `fix_up_geo` using only the geocode cache, or None
+    if the file's coordinates have to be looked up.
+    """
+    latitude, longitude = m.get_geo_coords
+    if latitude is None or longitude is None:
+        return {}
+    details = geocode.get_cache(cfg).check((latitude, longitude))
+    if details is None:
+        return None
+    return {(latitude, longitude): details}
+
+
+def _prepare_geocoder(cfg, no_geo):
+    # Set the locator up before any workers start, so an offline gazetteer's
+    # index is built once, here, rather than by every worker at the same time.
+    if not no_geo:
+        geocode.get_locator(cfg)
+
+
+def _geocoded_walk(cfg, files_or_dirs, callback, jobs, merge=None, skip=None, **kwargs):
+    """Like `walk` but with the GPS look ups gathered up and done together.
+
+    The files are taken a batch at a time. The callback is run with
+    `defer_geo` set: a file whose location is in the geocode cache is dealt
+    with there and then, otherwise the callback hands back a `Lookup` in place
+    of its result. The coordinates for those are looked up together, see
+    `BaseGeoLocator.resolve`, and the callback is run again for just those
+    files, each one sent only its own place. So only files needing a look up
+    are opened twice.
+
+    Look ups that don't go over the network are cheap enough to do in the
+    workers, for those this is just `walk`.
+    """
+    locator = geocode.get_locator(cfg)
+    if not locator.rate_limited:
+        walk(cfg, files_or_dirs, callback, jobs=jobs, merge=merge, skip=skip, **kwargs)
+        return
+
+    with pool(cfg, jobs) as run:
+        for batch in batched(files_to_walk(cfg, files_or_dirs, skip), cfg.geocode_batch_size):
+            lookups = {}
 
-    for unknown in unknown_people:
-        topics = unknown.split('|')
-        if topics[-1] not in known_people:
-            tidy_keywords.append(unknown)
+            def gather(result):
+                if isinstance(result, Lookup):
+                    lookups[result.file] = result.coords
+                elif merge is not None:
+                    merge(result)
 
-    return sorted(tidy_keywords)
+            run(batch, callback, gather, defer_geo=True, **kwargs)
+            if not lookups:
+                continue
+            places = locator.resolve(lookups.values())
 
+            def place(file):
+                coords = lookups[file]
+                return {'places': {coords: places[coords]} if coords in places else {}}
 
-def _fixup_image(cfg, file, no_geo):
+            run(list(lookups), callback, merge, file_kwargs=place, count_files=False, **kwargs)
+
+
+def _fixup_image(cfg, file, no_geo, places=None, defer_geo=False):
     try:
-        m = metadata.MetaData(cfg, file)
+        m = metadata.MetaData(cfg, file, tags=metadata.FIX_TAGS)
+        if defer_geo and not no_geo:
+            places = _cached_places(cfg, m)
+            if places is None:
+                return Lookup(file, tuple(m.get_geo_coords))
         m.fix_up_start()
         m.fix_up()
         if no_geo:
             vvprint('skipping GPS to location lookup')
         else:
-            m.fix_up_geo()
+            m.fix_up_geo(places)
         m.write_changes()
         m.fix_up_finished()
+        return catalog_entry(file, m, catalog_mode(fixed=True, geo=not no_geo)), m.is_complete, m.was_written
     except Exception as e:
         error(f"problem reading {file} ({str(e)}")
+    return None, False, False
+
+
+def _fixup_merge(cfg, catalog, manifest):
+    """Return a function to save the results of `_fixup_image`.
+    """
+    def merge(result):
+        entry, complete, _ = result
+        if cfg.dry_run:
+            return
+        if entry is not None and catalog is not None:
+            catalog.update(entry)
+        if complete and manifest is not None:
+            manifest.update(entry['path'])
+    return merge
 
 
 def _dump_image(cfg, file, no_exif, no_xmp):
@@ -105,9 +220,13 @@ def _dump_image(cfg, file, no_exif, no_xmp):
         error(f"problem reading {file} ({str(e)}")
 
 
-def _get_keywords(cfg, file, no_fix, no_geo, all_keywords):
+def _get_keywords(cfg, file, no_fix, no_geo, places=None, defer_geo=False):
     try:
-        m = metadata.MetaData(cfg, file)
+        m = metadata.MetaData(cfg, file, tags=metadata.FIX_TAGS)
+        if defer_geo and not no_geo:
+            places = _cached_places(cfg, m)
+            if places is None:
+                return Lookup(file, tuple(m.get_geo_coords))
         m.fix_up_start()
         if no_fix:
             vvprint('skipping tag fix')
@@ -116,15 +235,32 @@ def _get_keywords(cfg, file, no_fix, no_geo, all_keywords):
         if no_geo:
             vvprint('skipping GPS to location lookup')
         else:
-            m.fix_up_geo()
-        all_keywords[:] = remove_duplicates(all_keywords + m.get_all_keywords)
+            m.fix_up_geo(places)
+        return catalog_entry(file, m, catalog_mode(fixed=not no_fix, geo=not no_geo))
     except Exception as e:
         error(f"problem reading {file} ({str(e)}")
+    return None
+
+
+def _catalog_image(cfg, file, no_fix, no_geo):
+    """Get the catalog entry for a file.
+
+    If the catalog has an up to date copy, worked out the same way, we use
+    that, otherwise we read the file and return the new entry as well so the
+    caller can save it.
+    """
+    entry_mode = catalog_mode(fixed=not no_fix, geo=not no_geo)
+    catalog = get_catalog(cfg)
+    if catalog is not None:
+        entry = catalog.lookup(file, entry_mode)
+        if entry is not None:
+            vvprint(f"{file}: using catalog entry")
+            stats.count('catalog.hit')
+            return entry, None
+        stats.count('catalog.miss')
 
-
-def _find_keyword(cfg, file, keyword, no_fix, no_geo, found_in):
     try:
-        m = metadata.MetaData(cfg, file)
+        m = metadata.MetaData(cfg, file, tags=metadata.FIX_TAGS)
         m.fix_up_start()
         if no_fix:
             vvprint('skipping tag fix')
@@ -134,13 +270,38 @@ def _find_keyword(cfg, file, keyword, no_fix, no_geo, found_in):
             vvprint('skipping GPS to location lookup')
         else:
             m.fix_up_geo()
-        for possible_keyword in m.get_all_keywords:
-            if keyword in possible_keyword:
-                found_in.add(file)
-                return
+        entry = catalog_entry(file, m, entry_mode)
+        return entry, entry
     except Exception as e:
         error(f"problem reading {file} ({str(e)}")
-    return
+    return None, None
+
+
+def _find_keyword(cfg, file, keyword_query, no_fix, no_geo):
+    entry, new_entry = _catalog_image(cfg, file, no_fix, no_geo)
+    if entry is not None and keyword_query.matches(entry['keywords']):
+        return file, new_entry
+    return None, new_entry
+
+
+def _index_image(cfg, file, no_fix, no_geo):
+    entry, new_entry = _catalog_image(cfg, file, no_fix, no_geo)
+    return os.path.abspath(file), new_entry
+
+
+def _watch_config_files(observer, handler, cfg, watches):
+    """Watch the configuration files `cfg` uses, and stop watching any it
+    no longer uses.
+
+    :param watches Dictionary of file to watch, from the last call
+    :return The new dictionary
+    """
+    files = {file for file in (cfg.config_file, cfg.keyword_file) if file is not None}
+    for file in set(watches) - files:
+        observer.unschedule(watches.pop(file))
+    for file in files - set(watches):
+        watches[file] = observer.schedule(handler, file)
+    return watches
 
 
 @click.group()
@@ -153,12 +314,25 @@ def cli():
               help="Disable GPS to  location look up")
 @click.option("-r", "--recursive", default=False, is_flag=True,
               help="Descend into directories")
+@click.option("-j", "--jobs", default=default_jobs(), show_default=True, type=int,
+              help="Number of files to process in parallel")
+@click.option("-A", "--all", "all_files", default=False, is_flag=True,
+              help="Fix files even if they haven't changed since they were last fixed")
 @click.argument('files_or_dirs', required=True, nargs=-1)
-def fix(dry_run, verbose, no_color, config_file, keyword_file, files_or_dirs, no_geo, recursive):
+def fix(dry_run, verbose, no_color, config_file, keyword_file, files_or_dirs, no_geo, recursive, jobs, all_files):
     _build_options(dry_run, verbose, no_color, config_file, keyword_file, recursive)
     cfg = config.ACDSeeConfig(options)
 
-    walk(cfg, files_or_dirs, _fixup_image, no_geo=no_geo)
+    manifest = get_manifest(cfg, no_geo)
+    merge = _fixup_merge(cfg, get_catalog(cfg), manifest)
+
+    skip = None
+    if manifest is not None and not all_files:
+        skip = manifest.is_current
+    if no_geo:
+        walk(cfg, files_or_dirs, _fixup_image, jobs=jobs, merge=merge, skip=skip, no_geo=no_geo)
+    else:
+        _geocoded_walk(cfg, files_or_dirs, _fixup_image, jobs, merge=merge, skip=skip, no_geo=no_geo)
 
 
 @cli.command(cls=CommonCommand)
@@ -183,91 +357,242 @@ def dump(dry_run, verbose, no_color, config_file, keyword_file, files_or_dirs, r
               help="Disable GPS to location look up.")
 @click.option("-r", "--recursive", default=False, is_flag=True,
               help="Descend into directories")
+@click.option("-j", "--jobs", default=default_jobs(), show_default=True, type=int,
+              help="Number of files to process in parallel")
+@click.option("-C", "--counts", default=False, is_flag=True,
+              help="Show how many files use each keyword, person and event instead")
 @click.argument('files_or_dirs', required=True, nargs=-1)
-def keywords(dry_run, verbose, no_color, config_file, keyword_file, no_fix, no_geo, recursive, files_or_dirs):
+def keywords(dry_run, verbose, no_color, config_file, keyword_file, no_fix, no_geo, recursive, jobs, counts,
+             files_or_dirs):
     _build_options(dry_run, verbose, no_color, config_file, keyword_file, recursive)
     cfg = config.ACDSeeConfig(options)
 
-    all_keywords = []
-    walk(cfg, files_or_dirs, _get_keywords, no_fix=no_fix, no_geo=no_geo, all_keywords=all_keywords)
+    all_keywords = KeywordTrie()
+    keyword_counts = KeywordCounts()
+    catalog = get_catalog(cfg)
+
+    def merge(entry):
+        if entry is not None:
+            all_keywords.update(entry['keywords'])
+            keyword_counts.add(entry)
+            if catalog is not None and not cfg.dry_run:
+                catalog.update(entry)
+
+    if no_geo:
+        walk(cfg, files_or_dirs, _get_keywords, jobs=jobs, merge=merge, no_fix=no_fix, no_geo=no_geo)
+    else:
+        _geocoded_walk(cfg, files_or_dirs, _get_keywords, jobs, merge=merge, no_fix=no_fix, no_geo=no_geo)
 
     # If given current list them merge with it.
     if keyword_file is not None:
-        all_keywords = all_keywords + list(cfg.keywords)
+        all_keywords.merge(cfg.keywords)
 
-    # Remove duplicates and tidy up then output in ACDSee format.
-    all_keywords = remove_duplicates(all_keywords)
-    all_keywords = _tidy_unknown_people(cfg, all_keywords)
-    khash = keywords_to_hash(all_keywords)
-    print("\n".join(hash_to_acdsee(khash)))
+    # Tidy up then output in ACDSee format, or the counts. Keywords from the
+    # keyword file that no file uses show up with a count of 0.
+    keyword_counts.discard(_tidy_unknown_people(cfg, all_keywords))
+    if counts:
+        print("\n".join(keyword_counts.report(all_keywords.keywords())))
+    else:
+        print("\n".join(all_keywords.to_acdsee()))
 
 
 @cli.command(cls=CommonCommand)
 @click.option("-r", "--recursive", default=False, is_flag=True,
               help="Descend into directories")
+@click.option("-j", "--jobs", default=default_jobs(), show_default=True, type=int,
+              help="Number of files to process in parallel")
+@click.option("-I", "--indexed", default=False, is_flag=True,
+              help="Only search the catalog, don't look at the files")
+@click.option("-f", "--fix", default=False, is_flag=True,
+              help="Search the keywords as `fix` would leave them, not as they are")
+@click.option("-g", "--geo", default=False, is_flag=True,
+              help="Look up locations from GPS coordinates while fixing")
 @click.argument('keyword', required=True, nargs=1)
 @click.argument('files_or_dirs', required=True, nargs=-1)
-def find(dry_run, verbose, no_color, config_file, keyword_file, recursive, keyword, files_or_dirs):
+def find(dry_run, verbose, no_color, config_file, keyword_file, recursive, jobs, indexed, fix, geo, keyword,
+         files_or_dirs):
+    """Find the files with keywords matching KEYWORD.
+
+    KEYWORD is a query, terms can be joined with and, or and not and grouped
+    with brackets. A plain term matches part of a keyword, =A|B matches A|B
+    and anything under it and /regex/ is a regular expression.
+    """
+    if geo and not fix:
+        raise click.UsageError("-g/--geo only works with -f/--fix")
     _build_options(dry_run, verbose, no_color, config_file, keyword_file, recursive)
     cfg = config.ACDSeeConfig(options)
 
-    found_in = set()
-    walk(cfg, files_or_dirs, _find_keyword, no_fix=False, no_geo=False, keyword=keyword, found_in=found_in)
-
-    if found_in:
-        print("Keyword found in the following files:")
-        for file in found_in:
-            print(f"  {file}")
+    try:
+        keyword_query = query.parse(keyword)
+    except ValueError as e:
+        error(f"bad query ({str(e)})")
+        return
+
+    found = 0
+    catalog = get_catalog(cfg)
+
+    def report(file):
+        # Print matches as they turn up rather than at the end.
+        nonlocal found
+        if found == 0:
+            print("Keyword found in the following files:")
+        found += 1
+        print(f"  {file}", flush=True)
+
+    def merge(result):
+        file, new_entry = result
+        if new_entry is not None and catalog is not None and not cfg.dry_run:
+            catalog.update(new_entry)
+        if file is not None:
+            report(file)
+
+    if indexed:
+        if catalog is None:
+            error("no catalog configured")
+            return
+        entry_mode = catalog_mode(fixed=fix, geo=geo)
+        for file in catalog.search(keyword_query, entry_mode, under=files_or_dirs, recursive=recursive):
+            report(file)
     else:
+        _prepare_geocoder(cfg, not geo)
+        walk(cfg, files_or_dirs, _find_keyword, jobs=jobs, merge=merge, no_fix=not fix, no_geo=not geo,
+             keyword_query=keyword_query)
+
+    if found == 0:
         print("Keyword not found any files.")
 
 
+@cli.command(cls=CommonCommand)
+@click.option("-r", "--recursive", default=False, is_flag=True,
+              help="Descend into directories")
+@click.option("-j", "--jobs", default=default_jobs(), show_default=True, type=int,
+              help="Number of files to process in parallel")
+@click.option("-f", "--fix", default=False, is_flag=True,
+              help="Catalog the keywords as `fix` would leave them, not as they are")
+@click.option("-g", "--geo", default=False, is_flag=True,
+              help="Look up locations from GPS coordinates while fixing")
+@click.argument('files_or_dirs', required=True, nargs=-1)
+def index(dry_run, verbose, no_color, config_file, keyword_file, recursive, jobs, fix, geo, files_or_dirs):
+    """Catalog the keywords of the files so `find -I` can search them.
+
+    Use the same -f and -g options the searches will use.
+    """
+    if geo and not fix:
+        raise click.UsageError("-g/--geo only works with -f/--fix")
+    _build_options(dry_run, verbose, no_color, config_file, keyword_file, recursive)
+    cfg = config.ACDSeeConfig(options)
+
+    catalog = get_catalog(cfg)
+    if catalog is None:
+        error("no catalog configured")
+        return
+
+    seen = set()
+
+    def merge(result):
+        path, new_entry = result
+        seen.add(path)
+        if new_entry is not None and not cfg.dry_run:
+            catalog.update(new_entry)
+
+    _prepare_geocoder(cfg, not geo)
+    walk(cfg, files_or_dirs, _index_image, jobs=jobs, merge=merge, no_fix=not fix, no_geo=not geo)
+
+    # Forget about files that have gone away.
+    for file_or_dir in files_or_dirs:
+        if os.path.isdir(file_or_dir) and recursive and not cfg.dry_run:
+            catalog.prune(file_or_dir, seen)
+
+
 @cli.command(cls=CommonCommand)
 @click.option("-G", "--no-geo", default=False, is_flag=True,
               help="Disable GPS to  location look up")
+@click.option("-j", "--jobs", default=default_jobs(), show_default=True, type=int,
+              help="Number of files to process in parallel")
 @click.argument('base', required=True, nargs=1, default=".")
-def watch(dry_run, verbose, no_color, config_file, keyword_file, no_geo, base):
-    _build_options(dry_run, verbose, no_color, config_file, keyword_file)
+def watch(dry_run, verbose, no_color, config_file, keyword_file, no_geo, jobs, base):
+    _build_options(dry_run, verbose, no_color, config_file, keyword_file, recursive=True)
     cfg = config.ACDSeeConfig(options)
 
     # Add watchers for directories and configuration.
-    exif_handler = changes.ExifFileHandler(cfg)
-    config_handler = changes.AnyFileHandler(cfg)
+    scheduler = changes.Scheduler(cfg.update_delay)
+    exif_handler = changes.ExifFileHandler(cfg, scheduler)
+    config_handler = changes.AnyFileHandler(cfg, scheduler)
 
     observer = Observer()
     observer.schedule(exif_handler, base, recursive=True)
-    if cfg.config_file is not None:
-        observer.schedule(config_handler, cfg.config_file)
-    if cfg.keyword_file is not None:
-        observer.schedule(config_handler, cfg.keyword_file)
+    config_watches = _watch_config_files(observer, config_handler, cfg, {})
     observer.start()
 
+    # Catch up with anything that changed while we weren't watching. We
+    # started the observer first so nothing slips through in between.
+    manifest = get_manifest(cfg, no_geo)
+    skip = manifest.is_current if manifest is not None else None
+    for file in files_to_walk(cfg, [base], skip):
+        vvprint(f"{file}: changed while not watching")
+        scheduler.add(file, delay=0)
+
+    own_writes = changes.OwnWrites()
+    _prepare_geocoder(cfg, no_geo)
+
     try:
         while True:
-            time.sleep(1)
-            too_soon = set()
-            with changes.files_lock_:
-                files = changes.files_
-                changes.files_ = set()
-
-            for file in files:
-                try:
-                    if file_age(file) < cfg.update_delay:
-                        vvprint(f"{file}: too young")
-                        too_soon.add(file)
-                        continue
-
-                    if cfg.is_data_file(file):
+            # The workers have a copy of the config so we need a new pool
+            # whenever it is reloaded, we also start again if the pool breaks.
+            fixup_merge = _fixup_merge(cfg, get_catalog(cfg), manifest)
+
+            def merge(result):
+                fixup_merge(result)
+                entry, _, written = result
+                if written:
+                    own_writes.add(entry['path'])
+
+            with pool(cfg, jobs) as run:
+                new_cfg = None
+                restart = False
+                while new_cfg is None and not restart:
+                    ready = scheduler.wait()
+
+                    # Saving a file can leave it missing for a moment, if we
+                    # can't read the configuration keep the one we have.
+                    if any(cfg.is_config_file(file) for file in ready):
+                        try:
+                            new_cfg = cfg.reload()
+                        except Exception as e:
+                            error(f"failed to reload the configuration ({str(e)})")
+
+                    # A directory means one was created or moved in, look
+                    # for anything new in it.
+                    files = []
+                    for file in ready:
+                        if os.path.isdir(file):
+                            files.extend(files_to_walk(cfg, [file], skip))
+                        elif own_writes.is_own(file):
+                            vvprint(f"{file}: ignoring our own change")
+                        elif cfg.is_data_file(file) and os.path.exists(file):
+                            files.append(file)
+                    for file in files:
                         vprint(f"would check {file}")
-                        _fixup_image(cfg, file, no_geo)
-                    if cfg.is_config_file(file):
-                        cfg.load()
-
-                except Exception as e:
-                    error(f"{file}: error ({str(e)})")
-
-            with changes.files_lock_:
-                changes.files_ = changes.files_.union(too_soon)
+                    # A broken pool needs replacing, anything else is logged
+                    # and we carry on with the next lot of changes.
+                    try:
+                        run(files, _fixup_image, merge, no_geo=no_geo)
+                    except BrokenProcessPool as e:
+                        error(f"fix up workers failed, restarting them ({str(e)})")
+                        restart = True
+                    except Exception as e:
+                        error(f"fix up failed ({str(e)})")
+            if new_cfg is None:
+                continue
+            # Everything holding on to the old snapshot has to be pointed at
+            # the new one.
+            cfg = new_cfg
+            exif_handler.set_config(cfg)
+            config_handler.set_config(cfg)
+            config_watches = _watch_config_files(observer, config_handler, cfg, config_watches)
+            scheduler.delay = cfg.update_delay
+            manifest = get_manifest(cfg, no_geo)
+            skip = manifest.is_current if manifest is not None else None
     finally:
         observer.stop()
         observer.join()
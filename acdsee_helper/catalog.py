@@ -0,0 +1,215 @@
+import os
+import sqlite3
+
+from .log import warn
+from .manifest import fingerprint
+from .util import Database
+
+"""Keyword catalog.
+
+We keep what we learned about each file - keywords, people, event, subjects
+and location - in an SQLite database keyed by path. An entry is only used if
+the file's size and modification time haven't changed since it was saved, so
+`find` only has to open files that are new or have been edited.
+
+What is in an entry depends on how it was worked out: the tags as they are in
+the file, or as `fix` would leave them, with or without the location looked
+up. Each entry is saved under its `mode` and is only handed back to someone
+asking for the same mode, so a file can have one of each. Entries also carry
+the fingerprint of the configuration and keyword files they were worked out
+with, like the manifest, and are ignored once those change.
+
+If SQLite was built with FTS5 we add a trigram index over the keywords and
+substring searches use that instead of scanning the table.
+"""
+
+
+SEPARATOR = '\n'
+
+# Bump this when the tables change, the catalog is only a cache so an old one
+# is thrown away.
+SCHEMA_VERSION = 3
+
+
+def _join(values):
+    if values is None:
+        return ''
+    return SEPARATOR.join(values)
+
+
+def _split(value):
+    if not value:
+        return []
+    return value.split(SEPARATOR)
+
+
+def _glob_escape(term):
+    return ''.join(f'[{c}]' if c in '*?[]' else c for c in term)
+
+
+def mode(fixed, geo):
+    """Name the way an entry's tags were worked out.
+
+    :param fixed True if the tags were fixed up, False if they are as found
+    :param geo True if the location was looked up from the GPS coordinates
+    """
+    return ('fixed' if fixed else 'raw') + ('+geo' if geo else '')
+
+
+def entry(file, m, entry_mode):
+    """Build a catalog entry from a `MetaData` instance.
+
+    :param entry_mode How the tags in `m` were worked out, see `mode`.
+    """
+    return {
+        'path': os.path.abspath(file),
+        'mode': entry_mode,
+        'keywords': m.get_all_keywords,
+        'people': m.get_people,
+        'event': m.get_event,
+        'subjects': m.get_subjects,
+        'location': m.get_location,
+    }
+
+
+class Catalog:
+
+    def __init__(self, file, signature):
+        self._fingerprint = signature
+        self._fts = False
+        self._db = Database(file, self._create)
+
+    def _create(self, db):
+        if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            with db:
+                db.execute('DROP TABLE IF EXISTS files')
+                db.execute('DROP TABLE IF EXISTS search')
+                db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        db.execute('CREATE TABLE IF NOT EXISTS files ('
+                   'path TEXT, mode TEXT, mtime REAL, size INTEGER, '
+                   'keywords TEXT, people TEXT, event TEXT, subjects TEXT, location TEXT, '
+                   'fingerprint TEXT, PRIMARY KEY (path, mode))')
+        try:
+            db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search "
+                       "USING fts5(path UNINDEXED, mode UNINDEXED, fingerprint UNINDEXED, keywords, "
+                       "tokenize='trigram')")
+            self._fts = True
+        except sqlite3.Error:
+            self._fts = False
+
+    def lookup(self, file, entry_mode):
+        """Return the saved entry for the file worked out in `entry_mode`, or
+        None if we don't have one or it is out of date.
+        """
+        path = os.path.abspath(file)
+        try:
+            stat = os.stat(path)
+            row = self._db.connect().execute('SELECT mtime, size, keywords, people, event, subjects, location, fingerprint '
+                                       'FROM files WHERE path = ? AND mode = ?', (path, entry_mode)).fetchone()
+        except (OSError, sqlite3.Error) as e:
+            warn(f"catalog read failed for {file} ({str(e)})")
+            return None
+        if row is None or row[0] != stat.st_mtime or row[1] != stat.st_size or row[7] != self._fingerprint:
+            return None
+        return {
+            'path': path,
+            'mode': entry_mode,
+            'keywords': _split(row[2]),
+            'people': _split(row[3]),
+            'event': row[4],
+            'subjects': _split(row[5]),
+            'location': _split(row[6]),
+        }
+
+    def update(self, new_entry):
+        path, entry_mode = new_entry['path'], new_entry['mode']
+        try:
+            stat = os.stat(path)
+            with self._db.connect() as db:
+                db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (path, entry_mode, stat.st_mtime, stat.st_size,
+                            _join(new_entry['keywords']), _join(new_entry['people']), new_entry['event'],
+                            _join(new_entry['subjects']), _join(new_entry['location']), self._fingerprint))
+                if self._fts:
+                    db.execute('DELETE FROM search WHERE path = ? AND mode = ?', (path, entry_mode))
+                    db.execute('INSERT INTO search VALUES (?, ?, ?, ?)',
+                               (path, entry_mode, self._fingerprint, _join(new_entry['keywords'])))
+        except (OSError, sqlite3.Error) as e:
+            warn(f"catalog write failed for {path} ({str(e)})")
+
+    def remove(self, path):
+        with self._db.connect() as db:
+            db.execute('DELETE FROM files WHERE path = ?', (path,))
+            if self._fts:
+                db.execute('DELETE FROM search WHERE path = ?', (path,))
+
+    def paths(self, under):
+        """Generate the catalogued paths below the directory `under`.
+        """
+        under = os.path.join(os.path.abspath(under), '')
+        for path, in self._db.connect().execute('SELECT DISTINCT path FROM files WHERE substr(path, 1, ?) = ?',
+                                          (len(under), under)):
+            yield path
+
+    def prune(self, under, seen):
+        """Drop the entries below `under` we didn't see on the last walk.
+        """
+        for path in list(self.paths(under)):
+            if path not in seen:
+                self.remove(path)
+
+    def search(self, query, entry_mode, under=None, recursive=True):
+        """Generate the catalogued paths whose keywords, as worked out in
+        `entry_mode`, match `query`.
+
+        Only entries worked out with the current configuration are searched.
+        `query` comes from `query.parse`. If it has a hint, a piece of text
+        every match contains, the database query uses it to narrow the search
+        down, we then do the exact check the same as `find` does on a file.
+
+        `under` limits the search to those files and directories, without
+        `recursive` only to the files directly in the directories.
+        """
+        db = self._db.connect()
+        hint = query.hint
+        current = (entry_mode, self._fingerprint)
+        if hint is None:
+            rows = db.execute('SELECT path, keywords FROM files WHERE mode = ? AND fingerprint = ?', current)
+        elif self._fts and len(hint) >= 3:
+            rows = db.execute('SELECT path, keywords FROM search WHERE mode = ? AND fingerprint = ? '
+                              'AND keywords GLOB ?', (*current, f'*{_glob_escape(hint)}*'))
+        else:
+            rows = db.execute('SELECT path, keywords FROM files WHERE mode = ? AND fingerprint = ? '
+                              'AND keywords GLOB ?', (*current, f'*{_glob_escape(hint)}*'))
+
+        prefixes = None
+        if under is not None:
+            under = [os.path.abspath(u) for u in under]
+            prefixes = tuple(os.path.join(u, '') for u in under)
+        for path, keywords in rows:
+            if under is not None and path not in under:
+                if not path.startswith(prefixes):
+                    continue
+                if not recursive and os.path.dirname(path) not in under:
+                    continue
+            if query.matches(_split(keywords)):
+                yield path
+
+
+catalog_ = None
+catalog_config_ = None
+
+
+def get_catalog(config):
+    """Get the catalog determined by config.
+
+    Returns None if the catalog has been turned off. A reloaded configuration
+    gets a new catalog, with the new fingerprint.
+    """
+    global catalog_, catalog_config_
+    if catalog_config_ is not config:
+        catalog_config_ = config
+        catalog_ = None
+        if config.catalog_file is not None:
+            catalog_ = Catalog(config.catalog_file, fingerprint(config))
+    return catalog_
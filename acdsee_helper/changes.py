@@ -1,37 +1,142 @@
+import heapq
+import os
 import threading
+import time
 
 from watchdog.events import PatternMatchingEventHandler
 
 
-files_ = set()
-files_lock_ = threading.Lock()
+class Scheduler:
+    """Hold on to changed files until they have settled down.
+
+    Every change to a file pushes its due time back to `delay` seconds after
+    the change. `wait` sleeps until the earliest due time and then returns
+    every file that is ready.
+
+    The due times are kept in a heap. When a file is changed again we don't
+    look for its old entry, we push a new one and skip the old one when it
+    comes off the heap because it no longer matches the file's due time.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self._heap = []
+        self._due = {}
+        self._changed = threading.Condition()
+
+    def add(self, file, delay=None):
+        with self._changed:
+            due = time.monotonic() + (self.delay if delay is None else delay)
+            self._due[file] = due
+            heapq.heappush(self._heap, (due, file))
+            self._changed.notify()
+
+    def _drop_stale(self):
+        while self._heap and self._due.get(self._heap[0][1], None) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def wait(self):
+        """Wait for files to be ready and return them in the order they became
+        ready.
+        """
+        with self._changed:
+            while True:
+                self._drop_stale()
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    break
+                self._changed.wait(self._heap[0][0] - now if self._heap else None)
+
+            ready = []
+            while self._heap and self._heap[0][0] <= now:
+                _, file = heapq.heappop(self._heap)
+                ready.append(file)
+                del self._due[file]
+                self._drop_stale()
+            return ready
+
+
+class OwnWrites:
+    """Remember how files looked after we wrote to them.
+
+    Writing to a file makes the observer tell us it changed. If a file still
+    has the size and modification time it had when we finished with it the
+    change was ours and there is no need to look at it again.
+
+    The scheduler gathers up a file's events so we are asked about each write
+    once, after that we forget the file.
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def add(self, file):
+        path = os.path.abspath(file)
+        self._files[path] = self._stat(path)
+
+    def is_own(self, file):
+        path = os.path.abspath(file)
+        recorded = self._files.pop(path, None)
+        return recorded is not None and recorded == self._stat(path)
 
 
 class AnyFileHandler(PatternMatchingEventHandler):
-    def __init__(self, config):
+    """Pass changed files on to the scheduler.
+
+    Files that are created or moved into place count as changed. Created and
+    moved in directories are passed on as well so whoever gets them can look
+    for new files inside them.
+    """
+
+    def __init__(self, config, scheduler):
         super().__init__()
         self._config = config
+        self._scheduler = scheduler
+
+    def set_config(self, config):
+        """Use `config` from now on, for when it has been reloaded.
+        """
+        self._config = config
 
-    def is_match(self, event):
+    def is_match(self, path):
         return True
 
+    def _changed(self, path):
+        if self.is_match(path):
+            self._scheduler.add(path)
+
+    def _arrived(self, path, is_directory):
+        if is_directory:
+            self._scheduler.add(path)
+        else:
+            self._changed(path)
+
     def on_modified(self, event):
-        if self.is_match(event):
-            with files_lock_:
-                global files_
-                files_.add(event.src_path)
+        if not event.is_directory:
+            self._changed(event.src_path)
 
     def on_closed(self, event):
-        if self.is_match(event):
-            with files_lock_:
-                global files_
-                files_.add(event.src_path)
+        if not event.is_directory:
+            self._changed(event.src_path)
 
+    def on_created(self, event):
+        self._arrived(event.src_path, event.is_directory)
+
+    def on_moved(self, event):
+        self._arrived(event.dest_path, event.is_directory)
 
-class ExifFileHandler(AnyFileHandler):
-    def __init__(self, config):
-        super().__init__(config)
 
-    def is_match(self, event):
-        return self._config.is_data_file(event.src_path)
+class ExifFileHandler(AnyFileHandler):
+    def __init__(self, config, scheduler):
+        super().__init__(config, scheduler)
 
+    def is_match(self, path):
+        return self._config.is_data_file(path)
@@ -13,7 +13,6 @@ STYLES = {
 }
 
 no_color_ = False
-verbose_ = 0
 
 
 def color(msg, fg=None, style=None):
@@ -35,30 +34,3 @@ def disable_color():
 def enable_color():
     global no_color_
     no_color_ = False
-
-
-def info(msg, fg='green', style='normal'):
-    print(color(f'{msg}', fg=fg, style=style))
-
-
-def warn(msg):
-    print(color(f' {msg}', fg='yellow', style='bold'))
-
-
-def error(msg):
-    print(color(f' {msg}', fg='red', style='bold'))
-
-
-def vprint(msg, fg='green', style='normal'):
-    if verbose_ > 0:
-        print(color(f' {msg}', fg=fg, style=style))
-
-
-def vvprint(msg, fg='yellow', style='normal'):
-    if verbose_ > 1:
-        print(color(f' {msg}', fg=fg, style=style))
-
-
-def set_verbosity(level):
-    global verbose_
-    verbose_ = level
\ No newline at end of file
@@ -1,251 +1,285 @@
-
-import pprint
+import os
 import yaml
-import fnmatch
 
-from .color import color, disable_color, enable_color, set_verbosity
+from .color import disable_color, enable_color
+from .log import error, info, pretty, set_verbosity
+from .util import PatternMatcher
 from . import keywords
 
-pp = pprint.PrettyPrinter(indent=4)
 
+class FrozenDict(dict):
+    """A dictionary that can't be changed once it is made.
+    """
+
+    def _read_only(self, *_args, **_kwargs):
+        raise TypeError(f"{type(self).__name__} is read only")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
 
-class BaseConfig:
-    def __init__(self, name, options):
-        self._name = name
-        self._options = options
-        self._config = {}
 
-    def _setup_output(self):
+def freeze(value):
+    """Return a read only copy of value, dictionaries become `FrozenDict`
+    and lists tuples, all the way down.
+    """
+    if isinstance(value, dict):
+        return value if isinstance(value, FrozenDict) else FrozenDict(
+            (key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class BaseConfig:
+    """Program settings.
+
+    A config is a snapshot. Everything is worked out when it is created and
+    stored in slots so reading a setting is a plain attribute look up. Nothing
+    can be changed afterwards, that includes what was read from the files
+    which is kept frozen, see `freeze`; to pick up edits to the configuration
+    files ask for a new snapshot with `reload` and swap it in. Anything still
+    using the old snapshot carries on with the old settings.
+    """
+
+    __slots__ = ('_options', '_config', '_data_files', '_excluded_files',
+                 'name', 'config_file', 'verbose', 'very_verbose', 'dry_run', 'is_recursive',
+                 'file_patterns', 'excluded_patterns', 'cache_dir')
+
+    def __init__(self, name, options, previous=None):
+        self._set('name', name)
+        self._set('_options', freeze(dict(options)))
+        self._set('_config', freeze(self._load_config(previous)))
+        self._load()
+        self.setup_output()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read only")
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._slot_names() if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            self._set(name, value)
+
+    @classmethod
+    def _slot_names(cls):
+        names = []
+        for klass in cls.__mro__:
+            names.extend(getattr(klass, '__slots__', ()))
+        return names
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def setup_output(self):
         set_verbosity(self._options['verbose'])
         if self._options['no_color']:
             disable_color()
         else:
             enable_color()
 
-    def _load_config(self):
-        if self.config_file is not None:
-            with open(self.config_file, 'r') as config_file:
+    def _load_config(self, previous):
+        # If the file is broken we carry on with what we had.
+        config_file = self._options['config_file']
+        if config_file is not None:
+            with open(config_file, 'r') as config_file:
                 try:
-                    self._config = yaml.safe_load(config_file)
+                    return yaml.safe_load(config_file) or {}
                 except yaml.YAMLError as exc:
-                    print(color(f'failed to read config: {exc}', fg="red"))
-
-    @property
-    def name(self):
-        return self._name
-
-    @property
-    def config_file(self):
-        return self._options['config_file']
-
-    @property
-    def verbose(self):
-        return self._options['verbose'] > 0
-
-    @property
-    def very_verbose(self):
-        return self._options['verbose'] > 1
-
-    @property
-    def dry_run(self):
-        return self._options['dry_run']
-
-    @property
-    def file_patterns(self):
-        return self._config.get('global', {}).get('file-patterns',
-                                                  ["*.xmp", "*.tif", "*.tiff", "*.jpg", "*.jpeg", "*.dng"])
-
-    @property
-    def excluded_patterns(self):
-        return self._config.get('global', {}).get('excluded-patterns', [])
+                    error(f'failed to read config: {exc}')
+        if previous is not None:
+            return previous._config
+        return {}
+
+    def _global(self, name, default):
+        return self._config.get('global', {}).get(name, default)
+
+    def _file(self, name, default):
+        file = self._global(name, default)
+        if file:
+            return os.path.expanduser(file)
+        return None
+
+    def _load(self):
+        self._set('config_file', self._options['config_file'])
+        self._set('verbose', self._options['verbose'] > 0)
+        self._set('very_verbose', self._options['verbose'] > 1)
+        self._set('dry_run', self._options['dry_run'])
+        self._set('is_recursive', self._options.get('recursive', False))
+        self._set('file_patterns', self._global('file-patterns',
+                                                ["*.xmp", "*.tif", "*.tiff", "*.jpg", "*.jpeg", "*.dng"]))
+        self._set('excluded_patterns', self._global('excluded-patterns', []))
+        self._set('cache_dir', os.path.expanduser(self._global('cache-dir', '~/.cache/acdsee-helper')))
+        self._set('_data_files', PatternMatcher(self.file_patterns))
+        self._set('_excluded_files', PatternMatcher(self.excluded_patterns))
+
+    def reload(self):
+        """Return a new snapshot read from the current configuration files.
+        """
+        return type(self)(self._options, previous=self)
 
     def is_data_file(self, file):
-        for pattern in self.file_patterns:
-            if fnmatch.fnmatch(file, pattern):
-                return True
-        return False
+        return self._data_files.match(file)
 
     def is_excluded_file(self, file):
-        for pattern in self.excluded_patterns:
-            if fnmatch.fnmatch(file, pattern):
-                return True
-        return False
-
-    @property
-    def is_recursive(self):
-        return self._options.get('recursive', False)
+        return self._excluded_files.match(file)
 
     def dump(self):
-        print(color(f"options (for {self.name}):", fg='green'))
-        pp.pprint(self._options)
-        print(color(f"config (for {self.name}):", fg='green'))
-        pp.pprint(self._config)
+        info(f"options (for {self.name}):")
+        info("{}", pretty(self._options))
+        info(f"config (for {self.name}):")
+        info("{}", pretty(self._config))
 
 
 class ACDSeeConfig(BaseConfig):
-    def __init__(self, options):
-        super().__init__('acdsee-helper', options)
-        self._keyword_hash = {}
-        self._people = {}
-        self._exclude = []
-        self.load()
+
+    __slots__ = ('_keyword_hash', '_keyword_people', '_exclude', '_hidden', 'people',
+                 'keyword_file', 'keywords_cache_file', 'events', 'places',
+                 'event_prefix', 'event_prefix_lower', 'event_tag_count', 'event_separator',
+                 'people_prefix', 'people_prefix_lower', 'people_unknown_prefix', 'people_unknown_prefix_lower',
+                 'places_prefix', 'keywords_event_included', 'keywords_people_included',
+                 'keywords_location_included', 'keywords_excluded',
+                 'geocode_backend', 'geocode_token', 'geocode_coalesce', 'geocode_cache_file', 'geocode_unidecode',
+                 'geocode_workers', 'geocode_rate', 'geocode_batch_size', 'geocode_geonames_dir',
+                 'geocode_geonames_cities', 'geocode_geonames_index_file',
+                 'catalog_file', 'manifest_file', 'update_delay')
+
+    def __init__(self, options, previous=None):
+        super().__init__('acdsee-helper', options, previous)
+
+    def _load_settings(self):
+        keyword_file = self._options['keyword_file']
+        if keyword_file is None:
+            keyword_file = self._global('keywords-file', None)
+        self._set('keyword_file', keyword_file)
+        self._set('keywords_cache_file', self._file('keywords-cache-file', f'{self.cache_dir}/keywords.json'))
+
+        self._set('event_prefix', self._global('event-prefix', 'Events'))
+        self._set('event_prefix_lower', self.event_prefix.lower())
+        self._set('event_tag_count', self._global('event-tag-count', -1))
+        self._set('event_separator', self._global('event-separator', ', '))
+        self._set('people_prefix', self._global('people-prefix', 'People'))
+        self._set('people_prefix_lower', self.people_prefix.lower())
+        self._set('people_unknown_prefix', self._global('people-unknown-prefix', 'Unknown'))
+        self._set('people_unknown_prefix_lower', self.people_unknown_prefix.lower())
+        self._set('places_prefix', self._global('places-prefix', 'Places'))
+        self._set('keywords_event_included', self._global('keywords-event-included', True))
+        self._set('keywords_people_included', self._global('keywords-people-included', True))
+        self._set('keywords_location_included', self._global('keywords-location-included', True))
+        self._set('keywords_excluded', self._global('keywords-excluded', []))
+        self._set('geocode_backend', self._global('geocode-backend', []))
+        self._set('geocode_token', self._global('geocode-token', []))
+        self._set('geocode_coalesce', self._global('geocode-coalesce', 250))
+        self._set('geocode_cache_file', self._file('geocode-cache-file', f'{self.cache_dir}/geocode.db'))
+        self._set('geocode_unidecode', self._global('geocode-unidecode', False))
+        self._set('geocode_workers', self._global('geocode-workers', 4))
+        self._set('geocode_rate', self._global('geocode-rate', 10))
+        self._set('geocode_batch_size', self._global('geocode-batch-size', 200))
+        self._set('geocode_geonames_dir', self._file('geocode-geonames-dir', f'{self.cache_dir}/geonames'))
+        self._set('geocode_geonames_cities', self._global('geocode-geonames-cities', 'cities500.txt'))
+        self._set('geocode_geonames_index_file',
+                  self._file('geocode-geonames-index-file', f'{self.cache_dir}/geonames.idx'))
+        self._set('catalog_file', self._file('catalog-file', f'{self.cache_dir}/catalog.db'))
+        self._set('manifest_file', self._file('manifest-file', f'{self.cache_dir}/manifest.db'))
+        self._set('update_delay', self._global('update-delay', 5))
 
     def _load_keywords(self):
+        keyword_hash = {}
+        keyword_people = {}
         if self.keyword_file is not None:
-            self._keyword_hash = keywords.acdsee_file_to_hash(self.keyword_file)
+            keyword_hash, keyword_people = keywords.compile_acdsee_file(self.keyword_file, self.people_prefix,
+                                                                        self.keywords_cache_file)
+        keyword_hash = freeze(keyword_hash)
+        self._set('_keyword_hash', keyword_hash)
+        self._set('_keyword_people', freeze(keyword_people))
+        self._set('events', keyword_hash.get(self.event_prefix, FrozenDict()))
+        self._set('places', keyword_hash.get(self.places_prefix, FrozenDict()))
 
     def _load_people(self):
-        people = set()
+        # The keyword file's share of the map comes ready made with the parsed
+        # file, we only have to add the people from the config.
+        people = dict(self._keyword_people)
         if 'people' in self._config:
-            people = keywords.yaml_to_hash(self._config['people'])
-            people = keywords.hash_to_keywords(people)
-        if self.people_prefix in self._keyword_hash:
-            people.update(keywords.hash_to_keywords(self._keyword_hash[self.people_prefix]))
-        self._build_people_map(people)
+            entries = keywords.KeywordTrie.from_yaml(self._config['people']).keywords()
+            people.update(keywords.people_map(entries, self.people_prefix))
+        self._set('people', FrozenDict(people))
 
     def _load_exclusions(self):
+        exclude = []
         if not self.keywords_event_included:
-            self._exclude.append(f'{self.event_prefix}|*')
+            exclude.append(f'{self.event_prefix}|*')
         if not self.keywords_people_included:
-            self._exclude.append(f'{self.people_prefix}|*')
-        for exclude in self.keywords_excluded:
-            self._exclude.append(f'{exclude}*')
-
-    def _build_people_map(self, entries):
-        for entry in entries:
-            topics = entry.split('|')
-            self._people[topics[-1].lower()] = f'{self.people_prefix}|{entry}'
-
-    def load(self):
-        self._load_config()
+            exclude.append(f'{self.people_prefix}|*')
+        for excluded in self.keywords_excluded:
+            exclude.append(f'{excluded}*')
+        self._set('_exclude', tuple(exclude))
+        self._set('_hidden', PatternMatcher(exclude))
+
+    def _load(self):
+        super()._load()
+        self._load_settings()
         self._load_keywords()
         self._load_people()
         self._load_exclusions()
-        self._setup_output()
 
     def name_to_keywords(self, name):
-        return self._people.get(name.lower(), None)
+        return self.people.get(name.lower(), None)
 
     def remove_hidden(self, all_keywords):
-        keywords = []
-        for keyword in all_keywords:
-            add = True
-            for pattern in self._exclude:
-                if fnmatch.fnmatch(keyword, pattern):
-                    add = False
-                    break
-            if add:
-                keywords.append(keyword)
-        return keywords
-
-    @property
-    def events(self):
-        return self._keyword_hash.get(self.event_prefix, {})
-
-    @property
-    def event_prefix(self):
-        return self._config.get('global', {}).get('event-prefix', 'Events')
-
-    @property
-    def event_tag_count(self):
-        return self._config.get('global', {}).get('event-tag-count', -1)
-
-    @property
-    def event_separator(self):
-        return self._config.get('global', {}).get('event-separator', ', ')
-
-    @property
-    def people(self):
-        return self._people
-
-    @property
-    def people_prefix(self):
-        return self._config.get('global', {}).get('people-prefix', 'People')
-
-    @property
-    def people_unknown_prefix(self):
-        return self._config.get('global', {}).get('people-unknown-prefix', 'Unknown')
-
-    @property
-    def places(self):
-        return self._keyword_hash.get(self.places_prefix, {})
-
-    @property
-    def places_prefix(self):
-        return self._config.get('global', {}).get('places-prefix', 'Places')
-
-    @property
-    def keywords_event_included(self):
-        return self._config.get('global', {}).get('keywords-event-included', True)
-
-    @property
-    def keywords_people_included(self):
-        return self._config.get('global', {}).get('keywords-people-included', True)
-
-    @property
-    def keywords_location_included(self):
-        return self._config.get('global', {}).get('keywords-location-included', True)
+        return [keyword for keyword in all_keywords if not self._hidden.match(keyword)]
 
     @property
     def keywords(self):
-        return keywords.hash_to_keywords(self._keyword_hash)
-
-    @property
-    def keywords_excluded(self):
-        return self._config.get('global', {}).get('keywords-excluded', [])
-
-    @property
-    def geocode_backend(self):
-        return self._config.get('global', {}).get('geocode-backend', [])
-
-    @property
-    def geocode_token(self):
-        return self._config.get('global', {}).get('geocode-token', [])
-
-    @property
-    def geocode_coalesce(self):
-        return self._config.get('global', {}).get('geocode-coalesce', 250)
-
-    @property
-    def geocode_unidecode(self):
-        return self._config.get('global', {}).get('geocode-unidecode', False)
-
-    @property
-    def update_delay(self):
-        return self._config.get('global', {}).get('update-delay', 5)
-
-    @property
-    def keyword_file(self):
-        if self._options['keyword_file'] is not None:
-            return self._options['keyword_file']
-        return self._config.get('global', {}).get('keywords-file', None)
+        return keywords.KeywordTrie.from_hash(self._keyword_hash)
 
     def is_config_file(self, file):
         return file == self.config_file or file == self.keyword_file
 
     def dump(self):
         super().dump()
-        #  print(color("keywords_:", fg='green'))
-        #  pp.pprint(self._keyword_hash)
-        #  print(color("people:", fg='green'))
-        #  pp.pprint(self._people)
-        #  print(color("exclude:", fg='green'))
-        #  pp.pprint(self._exclude)
+        #  info("keywords_:")
+        #  info("{}", pretty(self._keyword_hash))
+        #  info("people:")
+        #  info("{}", pretty(self.people))
+        #  info("exclude:")
+        #  info("{}", pretty(self._exclude))
 
 
 class DxoConfig(BaseConfig):
-    def __init__(self, options):
-        super().__init__('dxo-helper', options)
-        self.load()
 
-    def load(self):
-        self._load_config()
-        self._setup_output()
-
-    @property
-    def fake_dir(self):
-        return self._config.get('global', {}).get('fake-dir', None)
-
-    @property
-    def models(self):
-        return self._config.get('models', {})
+    __slots__ = ('fake_dir', 'models', '_models_lower', '_fake_parts')
+
+    def __init__(self, options, previous=None):
+        super().__init__('dxo-helper', options, previous)
+
+    def _load(self):
+        super()._load()
+        self._set('fake_dir', self._global('fake-dir', None))
+        fake_parts = None
+        if self.fake_dir is not None:
+            fake_parts = tuple(os.path.normpath(self.fake_dir).split(os.sep))
+        self._set('_fake_parts', fake_parts)
+        self._set('models', self._config.get('models', FrozenDict()))
+        self._set('_models_lower', FrozenDict((model.lower(), mapped_to) for model, mapped_to in self.models.items()))
+
+    def mapped_model(self, model):
+        """Return the make and model to fake for `model`, or None if it isn't
+        mapped.
+        """
+        return self._models_lower.get(model.lower(), None)
+
+    def is_fake_file(self, file):
+        """Is file in a fake directory? `fake-dir` can be more than one
+        directory deep so we compare the end of the file's path with all of it.
+        """
+        if self._fake_parts is None:
+            return False
+        parts = os.path.normpath(os.path.dirname(file)).split(os.sep)
+        return tuple(parts[-len(self._fake_parts):]) == self._fake_parts
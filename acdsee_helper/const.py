@@ -21,6 +21,7 @@ they don't update correctly.
 """
 ACDSEE_CATEGORIES_TAG = 'Xmp.acdsee.categories'
 ACDSEE_KEYWORDS_TAG = 'Xmp.acdsee.keywords'
+ACDSEE_REGIONS_TAG = 'Xmp.acdsee-rs.Regions'
 DC_SUBJECT_TAG = 'Xmp.dc.subject'
 EXIF_GPS_LATITUDE_TAG = 'Xmp.exif.GPSLatitude'
 EXIF_GPS_LONGITUDE_TAG = 'Xmp.exif.GPSLongitude'
@@ -1,12 +1,14 @@
 import os.path
 import pprint
-import shutil
 import click
 
 from . import config
+from . import log
 from . import metadata
-from .color import vprint
-from .util import walk
+from . import stats
+from . import tiff
+from .log import error, vprint
+from .util import copy_file, default_jobs, walk
 
 
 class CommonCommand(click.Command):
@@ -20,6 +22,27 @@ class CommonCommand(click.Command):
                                                 help="Be chatty. More is more chatty!"))
         self.params.insert(0, click.core.Option(('-d', '--dry-run'), default=False, is_flag=True,
                                                 help="Don't really do the work"))
+        self.params.append(click.core.Option(('--stats',), default=False, is_flag=True,
+                                             help="Print how long things took when done"))
+        self.params.append(click.core.Option(('--stats-json',), default=False, is_flag=True,
+                                             help="Print how long things took, as JSON, when done"))
+        self.params.append(click.core.Option(('--log-json',), default=None,
+                                             help="Also append the messages, as JSON lines, to this file"))
+
+    def invoke(self, ctx):
+        show_stats = ctx.params.pop('stats', False)
+        json_stats = ctx.params.pop('stats_json', False)
+        log_json = ctx.params.pop('log_json', None)
+        if show_stats or json_stats:
+            stats.enable()
+        if log_json is not None:
+            log.open_json(log_json)
+        try:
+            return super().invoke(ctx)
+        finally:
+            if show_stats or json_stats:
+                stats.report(as_json=json_stats)
+            log.close_json()
 
 
 pp = pprint.PrettyPrinter(indent=4)
@@ -46,42 +69,95 @@ def build_options(dry_run, verbose, no_color, config_file, recursive=None):
         options['recursive'] = recursive
 
 
-def _fixup_image(cfg, file):
-    print(file)
-    m = metadata.MetaData(cfg, file)
-    m.fix_up_start()
+def _is_synced(cfg, new_file, file, mapped_to):
+    # Is the fake copy newer than the file and already faked?
+    try:
+        if os.path.getmtime(new_file) < os.path.getmtime(file):
+            return False
+    except OSError:
+        return False
+    make, model = metadata.MetaData(cfg, new_file, tags=metadata.MAKE_MODEL_TAGS).get_make_model
+    return make == mapped_to['make'] and model == mapped_to['model']
 
-    make, model = m.get_make_model
-    for mapped_model, mapped_to in cfg.models.items():
-        if model.lower() != mapped_model.lower():
-            continue
 
-        dirname = os.path.dirname(file)
-        basename = os.path.basename(file)
-        new_dir = f'{dirname}/{cfg.fake_dir}'
-        new_file = f'{new_dir}/{basename}'
+def _fake_dir(cfg, file):
+    return f'{os.path.dirname(file)}/{cfg.fake_dir}'
 
-        if cfg.dry_run:
-            vprint(f" would copy {file} to {new_file}")
-            vprint(f" and replace {model} with {mapped_to}")
-            continue
 
-        if not os.path.exists(new_file):
-            vprint(f" creating {new_dir}")
-            os.makedirs(new_dir, exist_ok=True)
+def _fixup_image(cfg, file, sync=False):
+    """Make the fake copy of file if its model is mapped.
 
-        if os.path.exists(new_file):
-            vprint(f" copying {file} over {new_file}")
-            os.remove(new_file)
-        else:
-            vprint(f" copying {file} to {new_file}")
-        shutil.copy(file, new_file)
+    :return The fake copy's name, or None if there isn't one. If file can't
+    be read we return the name its copy would have so a sync leaves any copy
+    we made before alone.
+    """
+    try:
+        return _fake_image(cfg, file, sync)
+    except Exception as e:
+        error(f"problem reading {file} ({str(e)}")
+    return f'{_fake_dir(cfg, file)}/{os.path.basename(file)}'
 
-        vprint(f" and replacing '{model}' with '{mapped_to['model']}'")
-        nm = metadata.MetaData(cfg, new_file)
+
+def _fake_image(cfg, file, sync):
+    m = metadata.MetaData(cfg, file, tags=metadata.MAKE_MODEL_TAGS)
+    m.fix_up_start()
+
+    make, model = m.get_make_model
+    mapped_to = cfg.mapped_model(model)
+    if mapped_to is None:
+        m.fix_up_finished()
+        return None
+
+    new_dir = _fake_dir(cfg, file)
+    new_file = f'{new_dir}/{os.path.basename(file)}'
+
+    if sync and _is_synced(cfg, new_file, file, mapped_to):
+        vprint(f" {new_file} is up to date")
+        stats.count('up_to_date')
+        m.fix_up_finished()
+        return new_file
+
+    if cfg.dry_run:
+        vprint(f" would copy {file} to {new_file}")
+        vprint(f" and replace {model} with {mapped_to}")
+        m.fix_up_finished()
+        return new_file
+
+    if not os.path.exists(new_file):
+        vprint(f" creating {new_dir}")
+        os.makedirs(new_dir, exist_ok=True)
+
+    if os.path.exists(new_file):
+        vprint(f" copying {file} over {new_file}")
+    else:
+        vprint(f" copying {file} to {new_file}")
+    with stats.timed('copy'):
+        copy_file(file, new_file)
+
+    # The copy shares its blocks with the original where the file system
+    # allows, so change as few bytes as we can. If the new names don't fit
+    # where the old ones were let exiv2 rewrite the metadata.
+    vprint(f" and replacing '{model}' with '{mapped_to['model']}'")
+    with stats.timed('patch'):
+        patched = tiff.set_make_model(new_file, mapped_to['make'], mapped_to['model'])
+    if not patched:
+        nm = metadata.MetaData(cfg, new_file, tags=metadata.MAKE_MODEL_TAGS)
         nm.set_make_model(mapped_to['make'], mapped_to['model'])
 
     m.fix_up_finished()
+    return new_file
+
+
+def _prune(cfg, fake_files, wanted):
+    """Remove the fake copies we didn't make or find up to date this time.
+    """
+    for fake_file in sorted(fake_files - wanted):
+        if cfg.dry_run:
+            vprint(f"would remove stale {fake_file}")
+            continue
+        vprint(f"removing stale {fake_file}")
+        os.remove(fake_file)
+        stats.count('pruned')
 
 
 @click.group()
@@ -92,12 +168,33 @@ def cli():
 @cli.command(cls=CommonCommand)
 @click.option("-r", "--recursive", default=False, is_flag=True,
               help="Descend into directories")
+@click.option("-j", "--jobs", default=default_jobs(), show_default=True, type=int,
+              help="Number of files to work on at once")
+@click.option("-s", "--sync", default=False, is_flag=True,
+              help="Leave up to date copies alone and remove stale ones")
 @click.argument('files_or_dirs', required=True, nargs=-1)
-def fake(dry_run, verbose, no_color, config_file, files_or_dirs, recursive):
+def fake(dry_run, verbose, no_color, config_file, files_or_dirs, recursive, jobs, sync):
     build_options(dry_run, verbose, no_color, config_file, recursive)
     cfg = config.DxoConfig(options)
 
-    walk(cfg, files_or_dirs, _fixup_image)
+    # Never fake the fakes, but note them so a sync can tidy them up.
+    fake_files = set()
+
+    def skip(file):
+        if cfg.is_fake_file(file):
+            fake_files.add(os.path.normpath(file))
+            return True
+        return False
+
+    wanted = set()
+
+    def merge(new_file):
+        if new_file is not None:
+            wanted.add(os.path.normpath(new_file))
+
+    walk(cfg, files_or_dirs, _fixup_image, jobs=jobs, merge=merge, skip=skip, sync=sync)
+    if sync:
+        _prune(cfg, fake_files, wanted)
 
 
 if __name__ == '__main__':
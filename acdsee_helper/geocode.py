@@ -1,8 +1,19 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from unidecode import unidecode
 from geopy.geocoders import GoogleV3
 from geopy import distance
 
-from .color import warn, error, vprint, vvprint
+from .log import warn, error, vprint, vvprint
+from . import geonames
+from . import stats
+from .util import Database
 
 """Reverse Lookup a set of latitude/longitude coordinates.
 
@@ -24,53 +35,206 @@ GEOCODE_CITY_TAG = 'city'
 GEOCODE_COUNTRY_TAG = 'country'
 GEOCODE_STATE_TAG = 'state'
 
+# A little under the smallest radius of curvature of the earth, in meters.
+# Using it to turn a distance into an angle gives a slightly larger area than
+# we need, never a smaller one.
+EARTH_MIN_RADIUS = 6300000
+
+
+class GeoIndex:
+    """Grid index of places.
+
+    Coordinates are turned into points on a unit sphere and dropped into
+    cubic cells. The cells are sized so anything within `radius` meters of a
+    point is in the point's cell or one of its neighbours, so a search only
+    has to look at 27 cells whatever the size of the index.
+    """
+
+    def __init__(self, radius):
+        self._cell = radius / EARTH_MIN_RADIUS
+        self._cells = {}
+
+    def _key(self, coords):
+        latitude, longitude = math.radians(coords[0]), math.radians(coords[1])
+        return (math.floor(math.cos(latitude) * math.cos(longitude) / self._cell),
+                math.floor(math.cos(latitude) * math.sin(longitude) / self._cell),
+                math.floor(math.sin(latitude) / self._cell))
+
+    def add(self, coords, value):
+        self._cells.setdefault(self._key(coords), []).append((coords, value))
+
+    def nearby(self, coords):
+        """Generate the entries that could be within `radius` of coords.
+        """
+        x, y, z = self._key(coords)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    yield from self._cells.get((x + dx, y + dy, z + dz), [])
+
+    def nearest(self, coords, radius):
+        """Return the closest (coords, value) within `radius` meters of coords
+        or None, None.
+        """
+        best, best_meters = (None, None), radius
+        for entry_coords, value in self.nearby(coords):
+            meters = distance.distance(entry_coords, coords).meters
+            if meters < best_meters:
+                best, best_meters = (entry_coords, value), meters
+        return best
+
+
+class GeoDiskCache:
+    """Location caching between runs.
+
+    The decoded places are kept in an SQLite database. Every process opens
+    its own connection so it is safe to share the database between the
+    workers of a run and between runs.
+    """
+
+    def __init__(self, file, backend, coalesce):
+        self._backend = str(backend)
+        self._coalesce = coalesce
+        self._db = Database(file, self._create)
+
+    @staticmethod
+    def _create(db):
+        db.execute('CREATE TABLE IF NOT EXISTS places ('
+                   'backend TEXT, latitude REAL, longitude REAL, details TEXT, '
+                   'PRIMARY KEY (backend, latitude, longitude))')
+
+    def check(self, new_coords):
+        """Find the closest saved place within the coalesce distance.
+
+        We use the index to pull out the entries in a box around the
+        coordinates and only work out the real distance for those.
+
+        With a coalesce distance of 0 only the exact coordinates match.
+
+        :return Tuple of coordinates and details or None, None.
+        """
+        latitude, longitude = new_coords
+        dlatitude = math.degrees(self._coalesce / EARTH_MIN_RADIUS)
+        dlongitude = dlatitude / max(math.cos(math.radians(min(abs(latitude) + dlatitude, 90))), 1e-6)
+
+        query = 'SELECT latitude, longitude, details FROM places WHERE backend = ? AND latitude BETWEEN ? AND ?'
+        args = [self._backend, latitude - dlatitude, latitude + dlatitude]
+        if dlongitude < 180 and -180 <= longitude - dlongitude and longitude + dlongitude <= 180:
+            query += ' AND longitude BETWEEN ? AND ?'
+            args += [longitude - dlongitude, longitude + dlongitude]
+
+        best, best_meters = (None, None), self._coalesce
+        try:
+            for cached_latitude, cached_longitude, details in self._db.connect().execute(query, args):
+                cached_coords = (cached_latitude, cached_longitude)
+                meters = distance.distance(cached_coords, new_coords).meters
+                if meters < best_meters or (meters == 0 and best[0] is None):
+                    best, best_meters = (cached_coords, json.loads(details)), meters
+        except sqlite3.Error as e:
+            warn(f"geocode cache read failed ({str(e)})")
+        return best
+
+    def update(self, new_coords, details):
+        try:
+            with self._db.connect() as db:
+                db.execute('INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?)',
+                           (self._backend, new_coords[0], new_coords[1], json.dumps(details)))
+        except sqlite3.Error as e:
+            warn(f"geocode cache write failed ({str(e)})")
+
 
 class GeoCache:
     """Location caching.
 
     User can set a distance to see if a 'rough' area has been queried before.
-    This will prevent too many look-ups from happening.
+    This will prevent too many look-ups from happening. If configured we also
+    look in, and save to, a cache on disk.
     """
 
     def __init__(self, config):
         self._config = config
         self._coalesce = config.geocode_coalesce
-        self._cache = {}
+        self._cache = None
+        if self._coalesce != 0:
+            self._cache = GeoIndex(self._coalesce)
+        self._disk = None
+        if config.geocode_cache_file is not None:
+            self._disk = GeoDiskCache(config.geocode_cache_file, config.geocode_backend, self._coalesce)
 
     def check(self, new_coords):
-        if self._coalesce == 0:
-            vvprint("not caching!")
-            return None
-
-        for cached_coords, details in self._cache.items():
-            meters = distance.distance(cached_coords, new_coords).meters
-            if meters < self._coalesce:
+        if self._cache is not None:
+            cached_coords, details = self._cache.nearest(new_coords, self._coalesce)
+            if details is not None:
                 vprint("found a GPS entry")
+                stats.count('geocode_cache.hit')
+                return details
+        else:
+            vvprint("not coalescing, only exact matches are cached")
+
+        if self._disk is not None:
+            cached_coords, details = self._disk.check(new_coords)
+            if details is not None:
+                vprint("found a saved GPS entry")
+                stats.count('geocode_cache.hit')
+                if self._cache is not None:
+                    self._cache.add(cached_coords, details)
                 return details
 
+        stats.count('geocode_cache.miss')
         return None
 
     def update(self, new_coords, details):
-        self._cache[new_coords] = details
+        if self._cache is not None:
+            self._cache.add(new_coords, details)
+        if self._disk is not None:
+            self._disk.update(new_coords, details)
 
 
 geo_cache_ = None
 
 
+def get_cache(config):
+    """Get the cache shared by everything in this process.
+    """
+    global geo_cache_
+    if geo_cache_ is None:
+        geo_cache_ = GeoCache(config)
+    return geo_cache_
+
+
+class RateLimiter:
+    """Limit how often something can happen, across threads.
+
+    :param rate Calls allowed per second, 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
 class BaseGeoLocator:
     """Base Geo Locator class.
 
     They all have to provide the `reverse`, `decode_address` class.
     """
 
+    # Look ups that go over the network are held to `geocode-rate`.
+    rate_limited = True
+
     def __init__(self, config, locator):
         self._config = config
         self._locator = locator
-
-        global geo_cache_
-        if geo_cache_ is None:
-            geo_cache_ = GeoCache(config)
-        self._cache = geo_cache_
+        self._cache = get_cache(config)
 
     def _squash(self, msg):
         """Remove unicode characters.
@@ -86,11 +250,8 @@ class BaseGeoLocator:
         return msg
 
     def reverse(self, coords):
-        reverse = self._cache.check(coords)
-        if reverse is None:
+        with stats.timed('geocode'):
             reverse = self._locator.reverse(coords)
-            if reverse:
-                self._cache.update(coords, reverse)
         if reverse is None:
             warn('error, missing GEO information')
         return reverse
@@ -98,19 +259,101 @@ class BaseGeoLocator:
     def decode_address(self, _raw_location):
         return None
 
+    def cached(self, coords):
+        return self._cache.check(coords)
+
+    def lookup(self, coords):
+        """Reverse look up and decode without touching the cache.
+
+        This is safe to call from several threads at once.
+        """
+        location = self.reverse(coords)
+        if location is None:
+            return None
+        return self.decode_address(location.raw)
+
     def get_exif_info(self, coords):
         """Reverse look up and decode in one.
 
+        We cache the decoded place, so a cache hit needs neither the look up
+        nor the decode.
+
         :param coords Coordinates tuple to look for
         :return Place description of None on failure.
         """
-        location = self.reverse(coords)
-        if location is not None:
-            return self.decode_address(location.raw)
-        return None
+        details = self.cached(coords)
+        if details is None:
+            details = self.lookup(coords)
+            if details is not None:
+                self._cache.update(coords, details)
+        return details
+
+    def resolve(self, all_coords):
+        """Reverse look up a batch of coordinates.
+
+        Coordinates already in the cache are taken from there. The rest are
+        collapsed so anything within the coalesce distance of another one
+        shares its look up. Look ups that go over the network are spread
+        across a pool of threads, limited to `geocode-rate` a second, the
+        others are quick enough to do one after the other.
+
+        :param all_coords Iterable of coordinate tuples
+        :return Dictionary of coordinates to place description, coordinates
+        that couldn't be looked up are missing.
+        """
+        coalesce = self._config.geocode_coalesce
+        places = {}
+        pending = GeoIndex(coalesce) if coalesce != 0 else None
+        shared = {}
+        for coords in all_coords:
+            if coords in places or coords in shared:
+                continue
+            details = self.cached(coords)
+            if details is not None:
+                places[coords] = details
+                continue
+            if pending is not None:
+                lead, _ = pending.nearest(coords, coalesce)
+                if lead is not None:
+                    shared[lead].append(coords)
+                    continue
+                pending.add(coords, coords)
+            shared[coords] = [coords]
+
+        if not shared:
+            return places
+        vprint(f"looking up {len(shared)} locations")
+
+        limiter = RateLimiter(self._config.geocode_rate if self.rate_limited else 0)
+
+        def lookup(coords):
+            limiter.wait()
+            try:
+                return self.lookup(coords)
+            except Exception as e:
+                error(f"look up failed for {coords} ({str(e)})")
+            return None
+
+        # Only the look ups happen in the threads, the cache is updated here.
+        if self.rate_limited:
+            with ThreadPoolExecutor(max_workers=max(1, self._config.geocode_workers)) as executor:
+                found = list(executor.map(lookup, shared))
+        else:
+            found = map(lookup, shared)
+        for lead, details in zip(shared, found):
+            if details is None:
+                continue
+            self._cache.update(lead, details)
+            for coords in shared[lead]:
+                places[coords] = details
+        return places
 
 
 class NullGeoLocator(BaseGeoLocator):
+
+    # Nothing to look up, so nothing worth gathering up either.
+    rate_limited = False
+
     def __init__(self, config):
         super().__init__(config, None)
 
@@ -182,13 +425,41 @@ class GoogleGeoLocator(BaseGeoLocator):
         return pieces
 
 
+class GeoNamesGeoLocator(BaseGeoLocator):
+    """The offline version of the GeoLocator, it looks for the nearest town in
+    a GeoNames gazetteer. There is no street so location is always None.
+    """
+
+    rate_limited = False
+
+    def __init__(self, config):
+        super().__init__(config, geonames.get_index(config))
+
+    def reverse(self, coords):
+        if self._locator is None:
+            return None
+        return super().reverse(coords)
+
+    def decode_address(self, raw_location):
+        if not raw_location['country_code']:
+            error(f'error, no country found')
+            return None
+        pieces = {GEOCODE_COUNTRY_CODE_TAG: raw_location['country_code'],
+                  GEOCODE_LOCATION_TAG: None}
+        for piece in (GEOCODE_COUNTRY_TAG, GEOCODE_STATE_TAG, GEOCODE_CITY_TAG):
+            pieces[piece] = self._squash(raw_location[piece]) if raw_location[piece] else None
+        return pieces
+
+
 def get_locator(config):
     """Get Locator determined byu config.
 
-    We currently on support Google.
+    We currently support Google and an offline GeoNames gazetteer.
     """
     if config.geocode_backend == 'google':
         return GoogleGeoLocator(config)
+    if config.geocode_backend == 'geonames':
+        return GeoNamesGeoLocator(config)
     return NullGeoLocator(config)
 
 
@@ -0,0 +1,227 @@
+import array
+import contextlib
+import math
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+from .log import error, vprint
+from .util import _temp_file
+
+"""Offline reverse look ups from a GeoNames gazetteer.
+
+We need three files from https://download.geonames.org/export/dump/ in one
+directory:
+    cities500.txt (or one of the other cities files)
+    admin1CodesASCII.txt
+    countryInfo.txt
+
+The first time they are used we build an index file from them. It holds a
+unit vector for every city, sorted by the cell of a 3D grid the vector falls
+in, and the names that go with it. Later runs memory map the index so
+starting up costs nothing more than reading the list of cells.
+
+A look up checks the cells around the coordinates, a shell at a time, until
+no unchecked cell can hold anything nearer than the best city found so far.
+"""
+
+MAGIC = b'ACDGEO01'
+HEADER = struct.Struct('<8sIIId')
+
+# Grid cell size in unit vector space, about 32km.
+CELL = 0.005
+
+# Give up if there is nothing within this many cells, about 2000km.
+MAX_SHELL = 64
+
+# What `reverse` returns, like a geopy Location the raw part is a dictionary.
+Location = namedtuple('Location', ['raw'])
+
+
+def _vector(latitude, longitude):
+    latitude = math.radians(latitude)
+    longitude = math.radians(longitude)
+    return (math.cos(latitude) * math.cos(longitude),
+            math.cos(latitude) * math.sin(longitude),
+            math.sin(latitude))
+
+
+def _cell(vector):
+    return tuple(int(math.floor(axis / CELL)) for axis in vector)
+
+
+def _cell_key(cell):
+    x, y, z = cell
+    return ((x + 1024) << 22) | ((y + 1024) << 11) | (z + 1024)
+
+
+def _pad(data):
+    return data + b'\0' * (-len(data) % 8)
+
+
+def _read_tsv(file):
+    with open(file, 'r', encoding='utf-8') as tsv_file:
+        for line in tsv_file:
+            if line.startswith('#') or not line.strip():
+                continue
+            yield line.rstrip('\n').split('\t')
+
+
+def build_index(cities_file, admin1_file, countries_file, index_file):
+    """Turn the GeoNames text files into an index file.
+    """
+    countries = {row[0]: row[4] for row in _read_tsv(countries_file) if len(row) > 4}
+    states = {row[0]: row[1] for row in _read_tsv(admin1_file) if len(row) > 1}
+
+    entries = []
+    for row in _read_tsv(cities_file):
+        if len(row) < 11:
+            continue
+        country_code = row[8]
+        vector = _vector(float(row[4]), float(row[5]))
+        name = '\t'.join([country_code, countries.get(country_code, ''),
+                          states.get(f'{country_code}.{row[10]}', ''), row[1]])
+        entries.append((_cell_key(_cell(vector)), vector, name))
+    entries.sort(key=lambda entry: entry[0])
+
+    keys = array.array('q')
+    starts = array.array('i')
+    points = array.array('f')
+    offsets = array.array('i', [0])
+    names = bytearray()
+    for index, (key, vector, name) in enumerate(entries):
+        if not keys or keys[-1] != key:
+            keys.append(key)
+            starts.append(index)
+        points.extend(vector)
+        names.extend(name.encode('utf-8'))
+        offsets.append(len(names))
+    starts.append(len(entries))
+
+    os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+    out, new_file = _temp_file(index_file)
+    try:
+        with out:
+            out.write(_pad(HEADER.pack(MAGIC, len(entries), len(keys), len(names), CELL)))
+            for section in (keys, starts, points, offsets):
+                out.write(_pad(section.tobytes()))
+            out.write(bytes(names))
+        os.replace(new_file, index_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(new_file)
+        raise
+
+
+class GeoNamesIndex:
+
+    def __init__(self, index_file):
+        with open(index_file, 'rb') as index:
+            self._map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        magic, count, cells, names_size, cell = HEADER.unpack_from(view)
+        if magic != MAGIC or cell != CELL:
+            self._map.close()
+            raise ValueError(f"{index_file} is not an index we understand")
+
+        def section(offset, length, code, size):
+            end = offset + length * size
+            return view[offset:end].cast(code), end + (-end % 8)
+
+        offset = HEADER.size + (-HEADER.size % 8)
+        keys, offset = section(offset, cells, 'q', 8)
+        starts, offset = section(offset, cells + 1, 'i', 4)
+        self._points, offset = section(offset, count * 3, 'f', 4)
+        self._offsets, offset = section(offset, count + 1, 'i', 4)
+        self._names = view[offset:offset + names_size]
+        self._cells = {keys[i]: (starts[i], starts[i + 1]) for i in range(cells)}
+
+    def _shell(self, centre, radius):
+        # The cells on the surface of the cube `radius` cells out from centre.
+        cx, cy, cz = centre
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                if abs(dx) == radius or abs(dy) == radius:
+                    dzs = range(-radius, radius + 1)
+                else:
+                    dzs = (-radius, radius) if radius else (0,)
+                for dz in dzs:
+                    span = self._cells.get(_cell_key((cx + dx, cy + dy, cz + dz)), None)
+                    if span is not None:
+                        yield span
+
+    def nearest(self, latitude, longitude):
+        """Return the name pieces of the nearest place or None.
+        """
+        qx, qy, qz = vector = _vector(latitude, longitude)
+        centre = _cell(vector)
+        points = self._points
+        # Squared chord lengths rather than dot products, the dot product of
+        # two close float32 vectors is too near 1 to tell towns apart.
+        best, best_distance = None, 5.0
+        for radius in range(MAX_SHELL + 1):
+            for start, end in self._shell(centre, radius):
+                for i in range(start * 3, end * 3, 3):
+                    dx = points[i] - qx
+                    dy = points[i + 1] - qy
+                    dz = points[i + 2] - qz
+                    distance = dx * dx + dy * dy + dz * dz
+                    if distance < best_distance:
+                        best, best_distance = i // 3, distance
+            # Anything in a cell we haven't looked at is at least `radius`
+            # cells away.
+            if best is not None and best_distance <= (radius * CELL) ** 2:
+                break
+        if best is None:
+            return None
+        name = bytes(self._names[self._offsets[best]:self._offsets[best + 1]]).decode('utf-8')
+        return name.split('\t')
+
+    def reverse(self, coords):
+        """Look up coords the way a geopy geocoder does.
+        """
+        pieces = self.nearest(*coords)
+        if pieces is None:
+            return None
+        return Location(dict(zip(('country_code', 'country', 'state', 'city'), pieces)))
+
+
+def _open_index(index_file, sources):
+    # Use the index we have if it's newer than the gazetteer and we can read
+    # it, otherwise build it again.
+    if os.path.exists(index_file):
+        built = os.path.getmtime(index_file)
+        if all(os.path.getmtime(source) <= built for source in sources):
+            try:
+                return GeoNamesIndex(index_file)
+            except (ValueError, struct.error):
+                pass
+    vprint(f"building geonames index {index_file}")
+    build_index(*sources, index_file)
+    return GeoNamesIndex(index_file)
+
+
+geonames_index_ = None
+geonames_missing_ = False
+
+
+def get_index(config):
+    """Get the index for the configured gazetteer, building it if needed.
+
+    Returns None if the gazetteer files can't be found, we only look for them
+    the first time.
+    """
+    global geonames_index_, geonames_missing_
+    if geonames_index_ is None and not geonames_missing_:
+        directory = config.geocode_geonames_dir
+        sources = [os.path.join(directory, config.geocode_geonames_cities),
+                   os.path.join(directory, 'admin1CodesASCII.txt'),
+                   os.path.join(directory, 'countryInfo.txt')]
+        missing = [source for source in sources if not os.path.exists(source)]
+        if missing:
+            error(f"missing geonames files {', '.join(missing)}")
+            geonames_missing_ = True
+            return None
+        geonames_index_ = _open_index(config.geocode_geonames_index_file, sources)
+    return geonames_index_
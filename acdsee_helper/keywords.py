@@ -1,7 +1,14 @@
+import collections
+import contextlib
+import hashlib
 import io
+import json
+import os
 import pprint
+import sys
 
-from .color import color
+from .log import error, vvprint, warn
+from .util import _temp_file
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -14,9 +21,209 @@ We store and manipulate the keywords in several format.
   the previous entries
 - keywords: set of '|' symbol separated hierarchical keywords, we build this from
   the dictionary
+- trie; a `KeywordTrie`, this can be built from and turned into any of the
+  others without going through the dictionary
 """
 
 
+class KeywordTrie:
+    """A tree of keyword topics.
+
+    Each node holds its children keyed by topic, the topic strings are
+    interned so the same topic in lots of places is only stored once. A node
+    without children is a leaf and the path down to a leaf is a keyword, the
+    same as the dictionary format.
+    """
+
+    __slots__ = ('_children',)
+
+    def __init__(self, keywords=()):
+        self._children = {}
+        for keyword in keywords:
+            self.insert(keyword)
+
+    def _child(self, topic):
+        child = self._children.get(topic, None)
+        if child is None:
+            child = self._children[sys.intern(topic)] = KeywordTrie()
+        return child
+
+    def insert(self, keyword):
+        node = self
+        for topic in keyword.split('|'):
+            children = node._children
+            node = children.get(topic, None)
+            if node is None:
+                node = children[sys.intern(topic)] = KeywordTrie()
+        return node
+
+    def update(self, keywords):
+        for keyword in keywords:
+            self.insert(keyword)
+
+    def merge(self, other):
+        """Add everything in `other` to this trie.
+        """
+        for topic, child in other._children.items():
+            self._child(topic).merge(child)
+
+    def find(self, keyword):
+        """Return the node for `keyword` or None.
+        """
+        node = self
+        for topic in keyword.split('|'):
+            node = node._children.get(topic, None)
+            if node is None:
+                return None
+        return node
+
+    def remove(self, keyword):
+        """Remove `keyword` and everything under it.
+
+        Topics left with nothing under them are removed as well, otherwise
+        they would turn into keywords.
+        """
+        path = [self]
+        topics = keyword.split('|')
+        for topic in topics[:-1]:
+            path.append(path[-1]._children.get(topic, None))
+            if path[-1] is None:
+                return
+        path[-1]._children.pop(topics[-1], None)
+        for node, topic in zip(reversed(path[:-1]), reversed(topics[:-1])):
+            if node._children[topic]:
+                break
+            del node._children[topic]
+
+    @property
+    def is_leaf(self):
+        return not self._children
+
+    def __contains__(self, keyword):
+        node = self.find(keyword)
+        return node is not None and node.is_leaf
+
+    def __bool__(self):
+        return bool(self._children)
+
+    def items(self):
+        return self._children.items()
+
+    def keywords(self, prefix=None):
+        """Generate the keywords in the trie, or the ones under `prefix`.
+
+        If `prefix` is itself a keyword that is all you get.
+        """
+        node = self
+        if prefix is not None:
+            node = self.find(prefix)
+            if node is None:
+                return
+            if node.is_leaf:
+                yield prefix
+                return
+        yield from node._keywords(f'{prefix}|' if prefix is not None else '')
+
+    def _keywords(self, base):
+        stack = [(base, self)]
+        while stack:
+            base, node = stack.pop()
+            for topic, child in node._children.items():
+                if child._children:
+                    stack.append((f'{base}{topic}|', child))
+                else:
+                    yield base + topic
+
+    def to_acdsee(self):
+        """Generate the lines of an ACDSee keyword file, topics are sorted.
+        """
+        stack = [(0, topic, child) for topic, child in sorted(self._children.items(), reverse=True)]
+        while stack:
+            depth, topic, node = stack.pop()
+            yield ('\t' * depth) + topic
+            stack.extend((depth + 1, topic, child) for topic, child in sorted(node._children.items(), reverse=True))
+
+    def to_yaml(self):
+        """Return the trie in the format used by the config file.
+        """
+        entries = []
+        for topic, child in self._children.items():
+            entries.append(topic if child.is_leaf else {topic: child.to_yaml()})
+        return entries
+
+    def to_hash(self):
+        return {topic: None if child.is_leaf else child.to_hash() for topic, child in self._children.items()}
+
+    def _add_hash(self, hash):
+        for topic, value in hash.items():
+            child = self._child(topic)
+            if value is not None:
+                child._add_hash(value)
+
+    def _add_yaml(self, entries):
+        for entry in entries:
+            if isinstance(entry, dict):
+                for topic, value in entry.items():
+                    self._child(topic)._add_yaml(value or [])
+            else:
+                self._child(entry)
+
+    @classmethod
+    def from_hash(cls, hash):
+        trie = cls()
+        trie._add_hash(hash or {})
+        return trie
+
+    @classmethod
+    def from_yaml(cls, entries):
+        trie = cls()
+        trie._add_yaml(entries or [])
+        return trie
+
+
+class KeywordCounts:
+    """How many files use each keyword, person and event.
+
+    Fed one catalog entry at a time, a file counts once however many times it
+    repeats a keyword.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.keywords = collections.Counter()
+        self.people = collections.Counter()
+        self.events = collections.Counter()
+
+    def add(self, entry):
+        self.files += 1
+        self.keywords.update(set(entry['keywords']))
+        self.people.update(set(entry['people'] or ()))
+        if entry['event']:
+            self.events[entry['event']] += 1
+
+    def discard(self, keywords):
+        """Stop counting keywords, for ones tidied away after they were added.
+
+        People are counted by name so a person moved out of the unknown group
+        is already counted under the name they were given.
+        """
+        for keyword in keywords:
+            self.keywords.pop(keyword, None)
+
+    def report(self, known=()):
+        """Generate the lines of the counts, least used first.
+
+        :param known Keywords that should be listed even if no file uses them
+        """
+        keywords = collections.Counter(dict.fromkeys(known, 0))
+        keywords.update(self.keywords)
+        yield f'files: {self.files}'
+        for title, counter in (('keywords', keywords), ('people', self.people), ('events', self.events)):
+            yield f'{title}:'
+            for name, count in sorted(counter.items(), key=lambda item: (item[1], item[0])):
+                yield f'{count:8} {name}'
+
+
 def _hash_to_acdsee(acdsee, hash, depth):
     for topic, value in hash.items():
         acdsee.append(('\t' * depth) + topic)
@@ -72,32 +279,37 @@ def hash_to_acsdee_file(hash, file):
         afile.writelines(acdsee)
 
 
-def acdsee_to_hash(lines, depth=0):
-    entries = {}
+def acdsee_to_hash(lines):
+    """Parse the lines of an ACDSee keyword export.
 
-    # Loop until we detect a return to a previous level, or we run out of lines.
+    Each line is a topic indented, with tabs, one more than its parent. We
+    keep a stack of the entries being filled in at each level so the lines
+    are only looked at once.
+    """
+    entries = {}
+    stack = [(0, entries)]
     last = None
-    while len(lines) > 0:
-        line = lines[0]
+    for line in lines:
         sline = line.strip()
-        new_depth = len(line) - len(sline) - 1
+        if not sline:
+            continue
+        depth = len(line) - len(line.lstrip())
 
-        # Going down a level. Update last entry in array to the return value.
-        if new_depth > depth:
-            entries[last] = acdsee_to_hash(lines, depth + 1)
+        # Back up to the level this line belongs to.
+        while len(stack) > 1 and depth < stack[-1][0]:
+            stack.pop()
 
-        # At current level. Add in the end of entries and save value, just
-        # incase we have to drop down a level.
-        elif new_depth == depth:
-            entries[sline] = None
-            last = sline
-            lines.pop(0)
+        # Going down a level, the last entry gets some children.
+        if depth > stack[-1][0] and last is not None:
+            parent, topic = last
+            if parent[topic] is None:
+                parent[topic] = {}
+            stack.append((depth, parent[topic]))
 
-        # Previous level. Return what we have.
-        elif new_depth < depth:
-            return entries
+        current = stack[-1][1]
+        current.setdefault(sline, None)
+        last = (current, sline)
 
-    # Ran out of lines. Return what we have.
     return entries
 
 
@@ -109,10 +321,93 @@ def acdsee_file_to_hash(file, topic=None):
         return keywords
     if topic in keywords:
         return keywords[topic]
-    print(color(f'no "{topic}" section detected', fg='red'))
+    error(f'no "{topic}" section detected')
     return None
 
 
+def people_map(entries, people_prefix):
+    """Map the lower case name at the end of each people keyword to the full
+    keyword.
+    """
+    people = {}
+    for entry in entries:
+        topics = entry.split('|')
+        people[topics[-1].lower()] = f'{people_prefix}|{entry}'
+    return people
+
+
+compiled_ = {}
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _read_compiled(cache_file):
+    try:
+        with open(cache_file, 'r') as compiled_file:
+            return json.load(compiled_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_compiled(cache_file, compiled):
+    # Every worker compiles the keywords, each writes a file of its own.
+    new_file = None
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        compiled_file, new_file = _temp_file(cache_file)
+        with compiled_file:
+            compiled_file.write(json.dumps(compiled).encode())
+        os.replace(new_file, cache_file)
+    except OSError as e:
+        warn(f"can't save compiled keywords to {cache_file} ({str(e)})")
+        if new_file is not None:
+            with contextlib.suppress(OSError):
+                os.remove(new_file)
+
+
+def compile_acdsee_file(file, people_prefix, cache_file=None):
+    """Parse an ACDSee keyword file and build the people map from it.
+
+    The result is kept in memory and, if `cache_file` is given, on disk. It is
+    reused as long as the keyword file has the same modification time and
+    size, or failing that the same contents.
+
+    :return Tuple of the keyword hash and the people map.
+    """
+    stat = os.stat(file)
+    path = os.path.abspath(file)
+    compiled = compiled_.get(path, None)
+    if compiled is None and cache_file is not None:
+        compiled = _read_compiled(cache_file)
+    if compiled is not None and (compiled.get('path') != path or compiled.get('people_prefix') != people_prefix):
+        compiled = None
+
+    if compiled is not None and compiled['mtime'] == stat.st_mtime and compiled['size'] == stat.st_size:
+        vvprint(f"using compiled keywords for {file}")
+        compiled_[path] = compiled
+        return compiled['keywords'], compiled['people']
+
+    with open(file, 'rb') as keyword_file:
+        data = keyword_file.read()
+    digest = _digest(data)
+    if compiled is None or compiled['digest'] != digest:
+        vvprint(f"parsing keywords in {file}")
+        # Decode and split the lines the same way `acdsee_file_to_hash` does.
+        keywords = acdsee_to_hash(io.TextIOWrapper(io.BytesIO(data)).readlines())
+        people = people_map(KeywordTrie.from_hash(keywords.get(people_prefix, None)).keywords(), people_prefix)
+        compiled = {'path': path, 'people_prefix': people_prefix, 'digest': digest,
+                    'keywords': keywords, 'people': people}
+
+    compiled['mtime'] = stat.st_mtime
+    compiled['size'] = stat.st_size
+    compiled_[path] = compiled
+    if cache_file is not None:
+        _write_compiled(cache_file, compiled)
+    return compiled['keywords'], compiled['people']
+
+
 def yaml_to_hash(entries):
     khash = {}
     for entry in entries:
@@ -0,0 +1,159 @@
+"""Messages for the user.
+
+Code reports things through `info`, `warn`, `error`, `vprint` and `vvprint`,
+which turn them into records. A record that is too
+chatty for the current verbosity is dropped before anything is formatted, and
+any arguments are only formatted into the message when it is kept, so wrap
+expensive ones in `pretty` and they cost nothing when nobody will see them.
+
+Kept records go to the sinks: the console, where colour is added, and
+optionally a JSON lines file. While a file is being worked on records are
+buffered, along with anything printed, and written out in one go at the end;
+pool workers hand the buffer back to the parent to write, so output from
+different files doesn't interleave.
+"""
+import collections
+import contextlib
+import json
+import pprint
+import sys
+import time
+
+from . import color
+
+OUTPUT, ERROR, WARN, INFO, VERBOSE, DEBUG = range(-1, 5)
+LEVEL_NAMES = {OUTPUT: 'output', ERROR: 'error', WARN: 'warn', INFO: 'info', VERBOSE: 'verbose', DEBUG: 'debug'}
+
+Record = collections.namedtuple('Record', ['level', 'message', 'fg', 'style', 'file', 'time'])
+
+pp = pprint.PrettyPrinter(indent=4)
+
+
+class pretty:
+    """Pretty print `value`, but only if the message it is in is kept.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __format__(self, _spec):
+        return pp.pformat(self.value)
+
+
+threshold_ = INFO
+buffer_ = None
+file_ = None
+json_sink_ = None
+
+
+def set_verbosity(level):
+    global threshold_
+    threshold_ = INFO + level
+
+
+def enabled(level):
+    return level <= threshold_
+
+
+def log(level, msg, args=(), fg=None, style=None):
+    if level > threshold_:
+        return
+    if args:
+        msg = msg.format(*args)
+    record = Record(level, msg, fg, style, file_, time.time())
+    if buffer_ is not None:
+        buffer_.append(record)
+    else:
+        write([record])
+
+
+def info(msg, *args, fg='green', style='normal'):
+    log(INFO, msg, args, fg, style)
+
+
+def warn(msg, *args):
+    log(WARN, msg, args, 'yellow', 'bold')
+
+
+def error(msg, *args):
+    log(ERROR, msg, args, 'red', 'bold')
+
+
+def vprint(msg, *args, fg='green', style='normal'):
+    log(VERBOSE, msg, args, fg, style)
+
+
+def vvprint(msg, *args, fg='yellow', style='normal'):
+    log(DEBUG, msg, args, fg, style)
+
+
+def _console_text(record):
+    # Colour is only a matter of how the console shows things.
+    if record.level == OUTPUT:
+        return record.message
+    if record.level == INFO:
+        return color.color(record.message, fg=record.fg, style=record.style) + '\n'
+    return color.color(f' {record.message}', fg=record.fg, style=record.style) + '\n'
+
+
+def _json_line(record):
+    return json.dumps({'time': record.time, 'level': LEVEL_NAMES[record.level], 'file': record.file,
+                       'message': record.message.strip()}) + '\n'
+
+
+def write(records):
+    """Send records to the sinks, each sink gets a single write.
+    """
+    if not records:
+        return
+    sys.stdout.write(''.join(_console_text(record) for record in records))
+    if json_sink_ is not None:
+        json_sink_.write(''.join(_json_line(record) for record in records if record.message.strip()))
+        json_sink_.flush()
+
+
+class _Capture:
+    """Stand in for stdout that turns what is printed into records.
+    """
+
+    def __init__(self, records):
+        self._records = records
+
+    def write(self, text):
+        if text:
+            self._records.append(Record(OUTPUT, text, None, None, file_, time.time()))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+@contextlib.contextmanager
+def buffered(file=None):
+    """Hold back the records, and anything printed, made inside the block.
+
+    Yields the list they are gathered in. Nothing is written, it is up to the
+    caller to `write` them when it is ready.
+    """
+    global buffer_, file_
+    records = []
+    previous = buffer_, file_
+    buffer_, file_ = records, file
+    try:
+        with contextlib.redirect_stdout(_Capture(records)):
+            yield records
+    finally:
+        buffer_, file_ = previous
+
+
+def open_json(file):
+    global json_sink_
+    json_sink_ = open(file, 'a', encoding='utf-8')
+
+
+def close_json():
+    global json_sink_
+    if json_sink_ is not None:
+        json_sink_.close()
+        json_sink_ = None
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import sqlite3
+
+from .log import warn
+from .util import Database
+
+"""Record of files we have fixed.
+
+After a file has been fixed we save its size and modification time along with
+a fingerprint of the configuration used. If none of those have changed the
+next time we see the file there is no point opening it again.
+"""
+
+
+def fingerprint(config, *extras):
+    """Hash the things that affect how a file gets fixed.
+
+    That is the contents of the configuration and keyword files plus whatever
+    options the caller passes in `extras`.
+    """
+    digest = hashlib.sha1()
+    for file in [config.config_file, config.keyword_file]:
+        if file is None:
+            digest.update(b'\0')
+            continue
+        try:
+            with open(file, 'rb') as config_file:
+                digest.update(config_file.read())
+        except OSError:
+            digest.update(b'\0')
+    for extra in extras:
+        digest.update(repr(extra).encode())
+    return digest.hexdigest()
+
+
+class Manifest:
+
+    def __init__(self, file, signature):
+        self._fingerprint = signature
+        self._db = Database(file, self._create)
+
+    @staticmethod
+    def _create(db):
+        db.execute('CREATE TABLE IF NOT EXISTS files ('
+                   'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, fingerprint TEXT)')
+
+    def is_current(self, file):
+        """Is the file unchanged since we last fixed it with this configuration?
+        """
+        path = os.path.abspath(file)
+        try:
+            stat = os.stat(path)
+            row = self._db.connect().execute('SELECT mtime, size, fingerprint FROM files WHERE path = ?',
+                                       (path,)).fetchone()
+        except (OSError, sqlite3.Error) as e:
+            warn(f"manifest read failed for {file} ({str(e)})")
+            return False
+        return row is not None and row == (stat.st_mtime, stat.st_size, self._fingerprint)
+
+    def update(self, file):
+        path = os.path.abspath(file)
+        try:
+            stat = os.stat(path)
+            with self._db.connect() as db:
+                db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                           (path, stat.st_mtime, stat.st_size, self._fingerprint))
+        except (OSError, sqlite3.Error) as e:
+            warn(f"manifest write failed for {file} ({str(e)})")
+
+    def remove(self, file):
+        with self._db.connect() as db:
+            db.execute('DELETE FROM files WHERE path = ?', (os.path.abspath(file),))
+
+
+def get_manifest(config, *extras):
+    """Get the manifest determined by config.
+
+    Returns None if the manifest has been turned off.
+    """
+    if config.manifest_file is None:
+        return None
+    return Manifest(config.manifest_file, fingerprint(config, *extras))
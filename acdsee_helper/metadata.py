@@ -1,14 +1,17 @@
+import os
 import pprint
 import pyexiv2
 
-from .const import XMP_CREATOR_TOOL_TAG, ACDSEE_KEYWORDS_TAG, LR_SUBJECT_TAG, IPTCEXT_PERSON_TAG, IPTCEXT_EVENT_TAG, \
+from .const import XMP_CREATOR_TOOL_TAG, ACDSEE_KEYWORDS_TAG, ACDSEE_REGIONS_TAG, LR_SUBJECT_TAG, IPTCEXT_PERSON_TAG, IPTCEXT_EVENT_TAG, \
     DC_SUBJECT_TAG, EXIF_GPS_LATITUDE_TAG, EXIF_GPS_LONGITUDE_TAG, PS_GEO_CITY_TAG, PS_GEO_COUNTRY_TAG, \
     IPTC_GEO_COUNTRY_CODE_TAG, IPTC_GEO_LOCATION_TAG, PS_GEO_STATE_TAG, EXIF_MAKE_TAG, EXIF_MODEL_TAG
-from .color import info, warn, vprint, vvprint
+from .log import info, pretty, warn, vprint, vvprint
 from .geocode import GEOCODE_COUNTRY_CODE_TAG, GEOCODE_LOCATION_TAG, GEOCODE_CITY_TAG, GEOCODE_COUNTRY_TAG, \
     GEOCODE_STATE_TAG
-from .util import remove_duplicates, to_list
+from .util import remove_duplicates, replace_file, to_list
 from . import geocode
+from . import stats
+from . import xmp
 
 
 # This is a list of all the tags we might change. We back them into `_old_data`
@@ -27,8 +30,32 @@ GEO_TAGS_TO_EXIF = {
 }
 
 
+# The derived views built from `_new_data`, by the tag they are built from.
+# Setting the tag throws away the view. The other views are built from what we
+# read from the file so they never need rebuilding.
+DERIVED_FROM_TAGS = {
+    LR_SUBJECT_TAG: ['all_keywords'],
+    IPTC_GEO_LOCATION_TAG: ['location'],
+    PS_GEO_CITY_TAG: ['location'],
+    PS_GEO_COUNTRY_TAG: ['location'],
+    PS_GEO_STATE_TAG: ['location'],
+}
+
+
+# The tags fixing a file needs.
+FIX_TAGS = {ACDSEE_KEYWORDS_TAG, ACDSEE_REGIONS_TAG, EXIF_GPS_LATITUDE_TAG, EXIF_GPS_LONGITUDE_TAG,
+            XMP_CREATOR_TOOL_TAG, *BACKUP_TAGS}
+
+# The tags DxO needs.
+MAKE_MODEL_TAGS = {EXIF_MAKE_TAG, EXIF_MODEL_TAG}
+
+# Images at least this big, in bytes, are changed where they are rather than
+# read into memory and written out again.
+IN_PLACE_SIZE = 256 * 1024 * 1024
+
+
 def acdsee_region_entry(i, entry):
-    return f'Xmp.acdsee-rs.Regions/acdsee-rs:RegionList[{i}]/acdsee-rs:{entry}'
+    return f'{ACDSEE_REGIONS_TAG}/acdsee-rs:RegionList[{i}]/acdsee-rs:{entry}'
 
 
 def geo_tag_to_exif(tag):
@@ -36,40 +63,108 @@ def geo_tag_to_exif(tag):
 
 
 class MetaData:
-    def __init__(self, config, file_name):
+    """The meta data of one image or sidecar.
+
+    `pyexiv2` parses the whole file when it is opened, but the EXIF, XMP and
+    IPTC sections are only turned into dictionaries when something first needs
+    them, so sections nothing uses cost nothing more. If `tags` is given only
+    those tags, and anything nested under them, are kept from each section.
+    """
+
+    def __init__(self, config, file_name, tags=None):
         self._msg = ''
+        self._complete = True
+        self._written = False
         self._config = config
         self._file_name = file_name
         self._image = None
+        self._tags = set(tags) if tags is not None else None
         self._unknowns = set()
+        self._derived = {}
+        self._sections = {}
+        self._backups = None
         self._pp = pprint.PrettyPrinter(indent=4)
 
-        self._image = pyexiv2.Image(file_name)
-        self._exif = self._image.read_exif()
-        self._data = self._image.read_xmp()
-        self._iptc = self._image.read_iptc()
+        with stats.timed('open'):
+            self._image = self._open(file_name, self._tags)
+
+    def _section(self, reader):
+        """Read a section the first time it is asked for.
+        """
+        if reader not in self._sections:
+            with stats.timed('read'):
+                section = getattr(self._image, reader)()
+                if self._tags is not None:
+                    section = {tag: value for tag, value in section.items() if self._is_wanted(tag)}
+            self._sections[reader] = section
+        return self._sections[reader]
 
-        # Here we copy pieces from the 3 separate sections into a single
+    def _is_wanted(self, tag):
+        return tag in self._tags or tag.split('/', 1)[0] in self._tags
+
+    @property
+    def _exif(self):
+        return self._section('read_exif')
+
+    @property
+    def _data(self):
+        return self._section('read_xmp')
+
+    @property
+    def _iptc(self):
+        return self._section('read_iptc')
+
+    def _backup(self):
+        # Here we copy pieces from the separate sections into a single
         # dictionary.This simplifies the check to see if data has really
         # changed and the code that unpacks the location data - currently
         # location some data is IPTC based and some is XMP based.
-        self._old_data = {}
-        self._new_data = {}
-        for keyword in BACKUP_TAGS:
-            if keyword in self._exif:
-                self._old_data[keyword] = self._exif[keyword]
-                self._new_data[keyword] = self._exif[keyword]
-            if keyword in self._data:
-                self._old_data[keyword] = self._data[keyword]
-                self._new_data[keyword] = self._data[keyword]
-            if keyword in self._iptc:
-                self._old_data[keyword] = self._iptc[keyword]
-                self._new_data[keyword] = self._iptc[keyword]
+        if self._backups is None:
+            old_data = {}
+            new_data = {}
+            for keyword in BACKUP_TAGS:
+                section = self._iptc if keyword.startswith('Iptc.') else self._data
+                if keyword in section:
+                    old_data[keyword] = section[keyword]
+                    new_data[keyword] = section[keyword]
+            self._backups = old_data, new_data
+        return self._backups
+
+    @property
+    def _old_data(self):
+        return self._backup()[0]
+
+    @property
+    def _new_data(self):
+        return self._backup()[1]
+
+    @staticmethod
+    def _open(file_name, tags):
+        # Sidecars are plain XML, read them ourselves unless they confuse us
+        # or we want tags we don't keep.
+        if file_name.lower().endswith('.xmp') and tags is not None and tags <= xmp.SIDECAR_TAGS:
+            try:
+                return xmp.XmpSidecar(file_name)
+            except xmp.XmpError as e:
+                vvprint(f"using exiv2 for {file_name} ({str(e)})")
+        return pyexiv2.Image(file_name)
 
     def __del__(self):
         if self._image is not None:
             self._image.close()
 
+    def _get_derived(self, name, build):
+        """Build a derived view the first time it is asked for.
+        """
+        if name not in self._derived:
+            self._derived[name] = build()
+        return self._derived[name]
+
+    def _set_tag(self, tag, value):
+        self._new_data[tag] = value
+        for name in DERIVED_FROM_TAGS.get(tag, []):
+            self._derived.pop(name, None)
+
     def _parse_area(self):
         people = []
         keywords = []
@@ -89,60 +184,96 @@ class MetaData:
             i = i + 1
         return people, keywords
 
+    def _timed_parse_area(self):
+        with stats.timed('parse_area'):
+            return self._parse_area()
+
     @property
-    def get_creator(self):
-        return self._data.get(XMP_CREATOR_TOOL_TAG, "Unknown")
+    def _regions(self):
+        return self._get_derived('regions', self._timed_parse_area)
 
     @property
-    def get_event(self):
+    def _topics(self):
+        return self._get_derived('topics', lambda: [keyword.split('|')
+                                                    for keyword in self._data.get(ACDSEE_KEYWORDS_TAG, [])])
+
+    def _build_event(self):
         # Try in keywords field.
-        for keyword in self._data.get(ACDSEE_KEYWORDS_TAG, []):
-            topics = keyword.split('|')
-            if topics[0].lower() == self._config.event_prefix.lower():
+        for topics in self._topics:
+            if topics[0].lower() == self._config.event_prefix_lower:
                 return self._config.event_separator.join(to_list(topics[self._config.event_tag_count:]))
         return None
 
-    @property
-    def get_people(self):
+    def _build_people(self):
         people = []
-        for keyword in self._data.get(ACDSEE_KEYWORDS_TAG, []):
-            topics = keyword.split('|')
-            if topics[0].lower() == self._config.people_prefix.lower():
+        for topics in self._topics:
+            if topics[0].lower() == self._config.people_prefix_lower:
                 people.append(topics[-1])
 
-        apeople, akeywords = self._parse_area()
-        people = remove_duplicates(people + apeople)
-        return people
+        apeople, akeywords = self._regions
+        return remove_duplicates(people + apeople)
 
-    @property
-    def get_keywords(self):
+    def _build_keywords(self):
         keywords = self._data.get(ACDSEE_KEYWORDS_TAG, [])
-        apeople, akeywords = self._parse_area()
-        keywords = self._config.remove_hidden(remove_duplicates(keywords + akeywords))
-        return keywords
+        apeople, akeywords = self._regions
+        return self._config.remove_hidden(remove_duplicates(keywords + akeywords))
 
-    @property
-    def get_all_keywords(self):
+    def _build_all_keywords(self):
         keywords = to_list(self._data.get(ACDSEE_KEYWORDS_TAG, []))
         lkeywords = to_list(self._new_data.get(LR_SUBJECT_TAG, []))
-        apeople, akeywords = self._parse_area()
+        apeople, akeywords = self._regions
         return remove_duplicates(keywords + lkeywords + akeywords)
 
-    @property
-    def get_subjects(self):
-        subjects = []
-        for keyword in self.get_keywords:
-            subjects.append(keyword.split('|')[-1])
-        return remove_duplicates(subjects)
+    def _build_subjects(self):
+        return remove_duplicates([keyword.split('|')[-1] for keyword in self.get_keywords])
 
-    @property
-    def get_geo_coords(self):
+    def _build_geo_coords(self):
         latitude = self._data.get(EXIF_GPS_LATITUDE_TAG, None)
         longitude = self._data.get(EXIF_GPS_LONGITUDE_TAG, None)
         if latitude and longitude:
             return geocode.unpack_gps(latitude), geocode.unpack_gps(longitude)
         return None, None
 
+    def _build_location(self):
+        location = []
+        for tag in [PS_GEO_COUNTRY_TAG, PS_GEO_STATE_TAG, PS_GEO_CITY_TAG, IPTC_GEO_LOCATION_TAG]:
+            for value in to_list(self._new_data.get(tag, None)):
+                if value:
+                    location.append(value)
+        return location
+
+    @property
+    def get_creator(self):
+        return self._data.get(XMP_CREATOR_TOOL_TAG, "Unknown")
+
+    @property
+    def get_event(self):
+        return self._get_derived('event', self._build_event)
+
+    @property
+    def get_people(self):
+        return self._get_derived('people', self._build_people)
+
+    @property
+    def get_keywords(self):
+        return self._get_derived('keywords', self._build_keywords)
+
+    @property
+    def get_all_keywords(self):
+        return self._get_derived('all_keywords', self._build_all_keywords)
+
+    @property
+    def get_subjects(self):
+        return self._get_derived('subjects', self._build_subjects)
+
+    @property
+    def get_geo_coords(self):
+        return self._get_derived('coords', self._build_geo_coords)
+
+    @property
+    def get_location(self):
+        return self._get_derived('location', self._build_location)
+
     @property
     def get_make_model(self):
         return self._exif.get(EXIF_MAKE_TAG, "UNKNOWN"), self._exif.get(EXIF_MODEL_TAG, "UNKNOWN")
@@ -154,6 +285,18 @@ class MetaData:
     def get_unknown_people(self):
         return self._unknowns
 
+    @property
+    def is_complete(self):
+        """Did all the fix up steps work?
+        """
+        return self._complete
+
+    @property
+    def was_written(self):
+        """Did `write_changes` write to the file?
+        """
+        return self._written
+
     @property
     def needs_update(self):
         return self._old_data != self._new_data
@@ -162,36 +305,36 @@ class MetaData:
         if not new_event:
             if IPTCEXT_EVENT_TAG in self._old_data:
                 vprint(f" removing {IPTCEXT_EVENT_TAG}", fg='magenta')
-                self._new_data[IPTCEXT_EVENT_TAG] = None
+                self._set_tag(IPTCEXT_EVENT_TAG, None)
         else:
-            self._new_data[IPTCEXT_EVENT_TAG] = {'lang="x-default"': new_event}
+            self._set_tag(IPTCEXT_EVENT_TAG, {'lang="x-default"': new_event})
 
     def set_keywords(self, new_keywords):
         if not new_keywords:
             if LR_SUBJECT_TAG in self._old_data:
                 vprint(f" removing {LR_SUBJECT_TAG}", fg='magenta')
-                self._new_data[LR_SUBJECT_TAG] = None
+                self._set_tag(LR_SUBJECT_TAG, None)
         else:
-            self._new_data[LR_SUBJECT_TAG] = new_keywords
+            self._set_tag(LR_SUBJECT_TAG, new_keywords)
 
     def set_subjects(self, new_subjects):
         if not new_subjects:
             if DC_SUBJECT_TAG in self._old_data and self._old_data[DC_SUBJECT_TAG] != ['']:
                 vprint(f" removing {DC_SUBJECT_TAG}", fg='magenta')
-                self._new_data[DC_SUBJECT_TAG] = ['']
+                self._set_tag(DC_SUBJECT_TAG, [''])
         else:
-            self._new_data[DC_SUBJECT_TAG] = new_subjects
+            self._set_tag(DC_SUBJECT_TAG, new_subjects)
 
     def set_people(self, new_people):
         if not new_people:
             if IPTCEXT_PERSON_TAG in self._old_data:
                 vprint(f" removing {IPTCEXT_PERSON_TAG}", fg='magenta')
-                self._new_data[IPTCEXT_PERSON_TAG] = None
+                self._set_tag(IPTCEXT_PERSON_TAG, None)
         else:
-            self._new_data[IPTCEXT_PERSON_TAG] = new_people
+            self._set_tag(IPTCEXT_PERSON_TAG, new_people)
 
     def set_make_model(self, make, model):
-        self._image.modify_exif({EXIF_MAKE_TAG: make, EXIF_MODEL_TAG: model})
+        self._commit({}, {}, {EXIF_MAKE_TAG: make, EXIF_MODEL_TAG: model})
 
     def fix_up_start(self):
         # info(f"{os.path.basename(self._file_name)}:", style='bold')
@@ -203,12 +346,23 @@ class MetaData:
 
     def fix_up(self):
         info(f" processing tags")
-        self.set_event(self.get_event)
-        self.set_keywords(self.get_keywords)
-        self.set_subjects(self.get_subjects)
-        self.set_people(self.get_people)
-
-    def fix_up_geo(self):
+        with stats.timed('fix_up'):
+            self.set_event(self.get_event)
+            self.set_keywords(self.get_keywords)
+            self.set_subjects(self.get_subjects)
+            self.set_people(self.get_people)
+
+    def fix_up_geo(self, places=None):
+        """Fill in the location tags from the GPS coordinates.
+
+        If `places` is given it is the result of `BaseGeoLocator.resolve` for
+        a batch of files including this one and we use that instead of looking
+        the coordinates up ourselves.
+        """
+        with stats.timed('fix_up_geo'):
+            self._fix_up_geo(places)
+
+    def _fix_up_geo(self, places):
         info(f" processing GPS data")
         latitude, longitude = self.get_geo_coords
         if latitude is None or longitude is None:
@@ -216,10 +370,15 @@ class MetaData:
             return
 
         # Hand it off to the geocoder. Make something useful comes back.
-        locator = geocode.get_locator(self._config)
-        geo_tags = locator.get_exif_info((latitude, longitude))
+        if places is not None:
+            geo_tags = places.get((latitude, longitude), None)
+        else:
+            locator = geocode.get_locator(self._config)
+            geo_tags = locator.get_exif_info((latitude, longitude))
         if not geo_tags:
             self._msg = " (couldn't get details)"
+            self._complete = False
+            return
 
         # Convert geocode tags to exif/xmp/iptc tags. Handle empty tags smartly,
         # if it isn't present then don't add an empty entry.
@@ -234,14 +393,14 @@ class MetaData:
             if value is None:
                 if exif_tag in self._old_data:
                     if self._old_data[exif_tag] != '':
-                        self._new_data[exif_tag] = ''
+                        self._set_tag(exif_tag, '')
                         vprint(f'removing {tag}', fg='magenta')
                     else:
                         vprint(f'ignoring blank {tag}', fg='magenta')
                 else:
                     vprint(f'ignoring removed {tag}', fg='magenta')
             else:
-                self._new_data[exif_tag] = value
+                self._set_tag(exif_tag, value)
 
         # Build the places keywords.
         keywords = [self._config.places_prefix]
@@ -254,6 +413,56 @@ class MetaData:
             keyword = "|".join(keywords)
             self.set_keywords(self.get_keywords + [keyword])
 
+    def _commit(self, iptc_changes, xmp_changes, exif_changes):
+        with stats.timed('write'):
+            self._commit_changes(iptc_changes, xmp_changes, exif_changes)
+
+    def _in_place(self):
+        # Big images would need a lot of memory and replacing a file with
+        # other hard links would split it from them.
+        if isinstance(self._image, xmp.XmpSidecar):
+            return False
+        stat = os.stat(self._file_name)
+        return stat.st_size >= IN_PLACE_SIZE or stat.st_nlink > 1
+
+    def _commit_in_place(self, iptc_changes, xmp_changes, exif_changes):
+        # Each `modify_*` call rewrites the file.
+        for modify, changes in ((self._image.modify_iptc, iptc_changes),
+                                (self._image.modify_xmp, xmp_changes),
+                                (self._image.modify_exif, exif_changes)):
+            if changes:
+                modify(changes)
+                stats.count('bytes_written', os.path.getsize(self._file_name))
+
+    def _commit_changes(self, iptc_changes, xmp_changes, exif_changes):
+        """Make all the changes and write the file once.
+
+        `pyexiv2.Image` rewrites the whole file for each `modify_*` call so we
+        make the changes to a copy in memory and write that out instead. Big
+        or hard linked images are the exception, see `_in_place`.
+        """
+        if self._in_place():
+            self._commit_in_place(iptc_changes, xmp_changes, exif_changes)
+            return
+        if isinstance(self._image, xmp.XmpSidecar):
+            image = self._image
+        else:
+            with open(self._file_name, 'rb') as image_file:
+                image = pyexiv2.ImageData(image_file.read())
+        try:
+            if iptc_changes:
+                image.modify_iptc(iptc_changes)
+            if xmp_changes:
+                image.modify_xmp(xmp_changes)
+            if exif_changes:
+                image.modify_exif(exif_changes)
+            data = image.get_bytes()
+            replace_file(self._file_name, data)
+            stats.count('bytes_written', len(data))
+        finally:
+            if image is not self._image:
+                image.close()
+
     def write_changes(self, force=False):
         if force or self.needs_update:
 
@@ -270,24 +479,20 @@ class MetaData:
                     xmp_changes[tag] = value
                 else:
                     exif_changes[tag] = value
-            vvprint(f" from\n{self._pp.pformat(self._old_data)}", fg='cyan')
-            vvprint(f" to-exif\n{self._pp.pformat(exif_changes)}", fg='green')
-            vvprint(f" to-xmp\n{self._pp.pformat(xmp_changes)}", fg='green')
-            vvprint(f" to-iptc\n{self._pp.pformat(iptc_changes)}", fg='green')
+            vvprint(" from\n{}", pretty(self._old_data), fg='cyan')
+            vvprint(" to-exif\n{}", pretty(exif_changes), fg='green')
+            vvprint(" to-xmp\n{}", pretty(xmp_changes), fg='green')
+            vvprint(" to-iptc\n{}", pretty(iptc_changes), fg='green')
 
             if not self._config.dry_run:
-                if iptc_changes:
-                    self._image.modify_iptc(iptc_changes)
-                if xmp_changes:
-                    self._image.modify_xmp(xmp_changes)
-                if exif_changes:
-                    self._image.modify_exif(exif_changes)
+                self._commit(iptc_changes, xmp_changes, exif_changes)
+                self._written = True
             else:
                 self._msg = ' (but only pretending to write)'
 
-            self._old_data = self._new_data
+            self._backups = dict(self._new_data), self._new_data
         else:
-            vvprint(f" from and to\n{self._pp.pformat(self._old_data)}", fg='cyan')
+            vvprint(" from and to\n{}", pretty(self._old_data), fg='cyan')
             self._msg = " (nothing changed, no write done)"
 
     def dump_xmp(self):
@@ -0,0 +1,173 @@
+import re
+
+"""Keyword queries for `find`.
+
+A query is one or more terms joined with `and`, `or` and `not`, brackets group
+them and terms next to each other are and-ed. A term is one of:
+
+    Paris             a keyword containing Paris
+    "New York"        the same, quoted so it can hold spaces
+    =Places|France    the keyword Places|France or anything under it
+    /^Events\\|20\\d\\d/  a keyword the regular expression matches
+
+`and` and `or` stop as soon as the answer is known, as does each term when it
+finds a keyword.
+"""
+
+TOKENS = re.compile(r'\s*(?:(?P<bracket>[()])|(?P<regex>/(?:[^/\\]|\\.)*/)|'
+                    r'(?P<word>=?"[^"]*"|=?[^\s()"]+))')
+OPERATORS = ('and', 'or', 'not')
+
+
+class Contains:
+    def __init__(self, text):
+        self.text = text
+        self.hint = text
+
+    def matches(self, keywords):
+        return any(self.text in keyword for keyword in keywords)
+
+
+class Exact:
+    def __init__(self, keyword):
+        self.keyword = keyword
+        self.prefix = f'{keyword}|'
+        self.hint = keyword
+
+    def matches(self, keywords):
+        return any(keyword == self.keyword or keyword.startswith(self.prefix) for keyword in keywords)
+
+
+class Regex:
+    hint = None
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+
+    def matches(self, keywords):
+        return any(self.pattern.search(keyword) for keyword in keywords)
+
+
+class Not:
+    hint = None
+
+    def __init__(self, query):
+        self.query = query
+
+    def matches(self, keywords):
+        return not self.query.matches(keywords)
+
+
+class And:
+    def __init__(self, queries):
+        self.queries = queries
+        self.hint = next((query.hint for query in queries if query.hint is not None), None)
+
+    def matches(self, keywords):
+        return all(query.matches(keywords) for query in self.queries)
+
+
+class Or:
+    hint = None
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def matches(self, keywords):
+        return any(query.matches(keywords) for query in self.queries)
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKENS.match(text, position)
+        if match is None:
+            raise ValueError(f"can't make sense of '{text[position:]}'")
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def is_operator(self, name):
+        kind, value = self.peek()
+        return kind == 'word' and value.lower() == name
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("empty query")
+        query = self.parse_or()
+        if self.peek()[0] is not None:
+            raise ValueError(f"unexpected '{self.peek()[1]}'")
+        return query
+
+    def parse_or(self):
+        queries = [self.parse_and()]
+        while self.is_operator('or'):
+            self.next()
+            queries.append(self.parse_and())
+        return queries[0] if len(queries) == 1 else Or(queries)
+
+    def parse_and(self):
+        queries = [self.parse_not()]
+        while True:
+            kind, value = self.peek()
+            if kind is None or value == ')' or self.is_operator('or'):
+                break
+            if self.is_operator('and'):
+                self.next()
+            queries.append(self.parse_not())
+        return queries[0] if len(queries) == 1 else And(queries)
+
+    def parse_not(self):
+        if self.is_operator('not'):
+            self.next()
+            return Not(self.parse_not())
+        return self.parse_term()
+
+    def parse_term(self):
+        kind, value = self.next()
+        if kind is None:
+            raise ValueError("query ends too soon")
+        if value == '(':
+            query = self.parse_or()
+            if self.next()[1] != ')':
+                raise ValueError("missing ')'")
+            return query
+        if value == ')' or (kind == 'word' and value.lower() in OPERATORS):
+            raise ValueError(f"unexpected '{value}'")
+        if kind == 'regex':
+            try:
+                return Regex(value[1:-1])
+            except re.error as e:
+                raise ValueError(f"bad regular expression {value} ({str(e)})")
+        exact = value.startswith('=')
+        if exact:
+            value = value[1:]
+        if value.startswith('"'):
+            value = value[1:-1]
+        return Exact(value) if exact else Contains(value)
+
+
+def parse(text):
+    """Turn the query text into something with a `matches(keywords)` method.
+
+    Raises ValueError if the query doesn't make sense.
+    """
+    return _Parser(text).parse()
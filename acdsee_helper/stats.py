@@ -0,0 +1,170 @@
+import contextlib
+import json
+import math
+import sys
+import time
+
+from .color import color
+
+"""Timings and counters for a run.
+
+Code marks the interesting phases with `timed` and the interesting events with
+`count`. Nothing is kept unless `enable` has been called, when it hasn't the
+calls cost next to nothing.
+
+Pool workers keep their own figures; `take` hands them back, along with a
+file's result, and the parent adds them in with `merge`. At the end `report`
+prints a summary.
+"""
+
+
+class _Timer:
+    __slots__ = ('_times', '_start')
+
+    def __init__(self, times):
+        self._times = times
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_args):
+        self._times.append(time.perf_counter() - self._start)
+        return False
+
+
+class Stats:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+
+    def timer(self, name):
+        return _Timer(self.phases.setdefault(name, []))
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def take(self):
+        taken = {'phases': self.phases, 'counters': self.counters}
+        self.phases = {}
+        self.counters = {}
+        return taken
+
+    def merge(self, taken):
+        for name, times in taken['phases'].items():
+            self.phases.setdefault(name, []).extend(times)
+        for name, amount in taken['counters'].items():
+            self.count(name, amount)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        files = self.counters.get('files', 0)
+        summary = {
+            'elapsed': elapsed,
+            'files': files,
+            'files_per_second': files / elapsed if elapsed > 0 else 0,
+            'phases': {},
+            'counters': dict(self.counters),
+            'hit_rates': {},
+        }
+        for name, times in sorted(self.phases.items()):
+            times = sorted(times)
+            summary['phases'][name] = {
+                'count': len(times),
+                'total': sum(times),
+                'p50': _percentile(times, 50),
+                'p90': _percentile(times, 90),
+                'p99': _percentile(times, 99),
+                'max': times[-1] if times else 0,
+            }
+        for name in self.counters:
+            base, _, outcome = name.rpartition('.')
+            if outcome in ('hit', 'miss') and base not in summary['hit_rates']:
+                hits = self.counters.get(f'{base}.hit', 0)
+                misses = self.counters.get(f'{base}.miss', 0)
+                summary['hit_rates'][base] = hits / (hits + misses)
+        return summary
+
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return 0
+    index = max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+stats_ = None
+null_timer_ = contextlib.nullcontext()
+
+
+def enable():
+    global stats_
+    stats_ = Stats()
+
+
+def enabled():
+    return stats_ is not None
+
+
+def timed(name):
+    """Time the block under `name`.
+    """
+    if stats_ is None:
+        return null_timer_
+    return stats_.timer(name)
+
+
+def count(name, amount=1):
+    if stats_ is not None:
+        stats_.count(name, amount)
+
+
+def take():
+    """Return and forget what has been gathered so far, or None if we aren't
+    gathering anything.
+    """
+    if stats_ is None:
+        return None
+    return stats_.take()
+
+
+def merge(taken):
+    if stats_ is not None and taken is not None:
+        stats_.merge(taken)
+
+
+# How wide each of the timing columns in the summary is.
+COLUMN = 11
+
+TIMINGS = ('total', 'p50', 'p90', 'p99', 'max')
+
+
+def _ms(seconds):
+    return f'{seconds * 1000:{COLUMN}.1f}'
+
+
+def report(as_json=False, out=None):
+    """Print the summary, it goes to stderr so it doesn't get mixed up with
+    what the command prints.
+    """
+    if stats_ is None:
+        return
+    out = out or sys.stderr
+    summary = stats_.summary()
+    if as_json:
+        print(json.dumps(summary, indent=2), file=out)
+        return
+
+    print(color("stats:", fg='green'), file=out)
+    print(f"  {summary['files']} files in {summary['elapsed']:.2f}s, "
+          f"{summary['files_per_second']:.1f} files/s", file=out)
+    print(f"  {'phase':<16}{'count':>8}" + ''.join(f"{f'{timing} ms':>{COLUMN}}" for timing in TIMINGS), file=out)
+    for name, phase in summary['phases'].items():
+        print(f"  {name:<16}{phase['count']:>8}" + ''.join(_ms(phase[timing]) for timing in TIMINGS), file=out)
+    for name, rate in summary['hit_rates'].items():
+        print(f"  {name} hit rate {rate * 100:.1f}%", file=out)
+    for name, amount in sorted(summary['counters'].items()):
+        if name != 'files' and not name.endswith('.hit') and not name.endswith('.miss'):
+            print(f"  {name} {amount}", file=out)
@@ -0,0 +1,92 @@
+import os
+import struct
+
+from .log import vvprint
+
+"""Edit TIFF tags in place.
+
+Most raw formats (CR2, NEF, ARW, DNG, PEF...) are TIFF files underneath, with
+the camera's Make and Model as ASCII strings in the first IFD. If a new value
+fits in the space the old one used we can overwrite those bytes and nothing
+else, leaving the rest of the file, and any blocks it shares with another copy,
+alone.
+"""
+
+MAKE_TAG = 0x010F
+MODEL_TAG = 0x0110
+ASCII = 2
+
+ENTRY_SIZE = 12
+
+
+def _ifd0(tiff_file):
+    # Return the byte order and the offset of the first IFD, or (None, None)
+    # if it isn't a TIFF file we can handle.
+    header = tiff_file.read(8)
+    if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+        return None, None
+    order = '<' if header[:2] == b'II' else '>'
+    magic, offset = struct.unpack(f'{order}HI', header[2:])
+    if magic != 42:
+        return None, None
+    return order, offset
+
+
+def _ascii_entries(tiff_file, order, offset, tags):
+    # Find where the values of the ASCII `tags` live in the IFD at offset.
+    tiff_file.seek(offset)
+    count_bytes = tiff_file.read(2)
+    if len(count_bytes) < 2:
+        return {}
+    count, = struct.unpack(f'{order}H', count_bytes)
+    entries = tiff_file.read(count * ENTRY_SIZE)
+    found = {}
+    for i in range(len(entries) // ENTRY_SIZE):
+        entry = entries[i * ENTRY_SIZE:(i + 1) * ENTRY_SIZE]
+        tag, kind, length = struct.unpack(f'{order}HHI', entry[:8])
+        if tag not in tags or kind != ASCII:
+            continue
+        if length <= 4:
+            # Small values are kept in the entry itself.
+            found[tag] = (offset + 2 + i * ENTRY_SIZE + 8, length)
+        else:
+            found[tag] = (struct.unpack(f'{order}I', entry[8:])[0], length)
+    return found
+
+
+def patch_ascii_tags(file, values):
+    """Overwrite the ASCII tags in the first IFD of file.
+
+    :param values Dictionary of tag number to new string
+    :return True if every tag was there and the new value fitted, in which
+    case they have all been written; False if nothing was changed.
+    """
+    with open(file, 'r+b') as tiff_file:
+        order, offset = _ifd0(tiff_file)
+        if order is None:
+            vvprint(f" {file} isn't a TIFF file")
+            return False
+        entries = _ascii_entries(tiff_file, order, offset, values)
+        size = os.fstat(tiff_file.fileno()).st_size
+        patches = []
+        for tag, value in values.items():
+            if tag not in entries:
+                vvprint(f" tag {tag:#06x} not found")
+                return False
+            value_offset, length = entries[tag]
+            if value_offset + length > size:
+                vvprint(f" tag {tag:#06x} is past the end of the file")
+                return False
+            data = value.encode('ascii', errors='replace') + b'\0'
+            if len(data) > length:
+                vvprint(f" no room for '{value}' in tag {tag:#06x}")
+                return False
+            patches.append((value_offset, data.ljust(length, b'\0')))
+        for value_offset, data in patches:
+            tiff_file.seek(value_offset)
+            tiff_file.write(data)
+    return True
+
+
+def set_make_model(file, make, model):
+    return patch_ascii_tags(file, {MAKE_TAG: make, MODEL_TAG: model})
@@ -1,6 +1,24 @@
+import collections
+import contextlib
+import errno
+import fnmatch
 import os
+import re
+import shutil
+import sqlite3
+import tempfile
 import time
-from .color import vvprint
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, we just don't get to clone files there.
+    fcntl = None
+
+from .log import vvprint
+from . import log
+from . import stats
 
 
 def remove_duplicates(messy_list):
@@ -16,11 +34,200 @@ def to_list(possible_list):
         return [possible_list]
 
 
+class PatternMatcher:
+    """Match strings against a list of `fnmatch` style patterns.
+
+    Patterns that are a plain prefix followed by `*`, which is what most of
+    ours look like, go into a trie so checking them costs O(len(string))
+    however many there are. The rest are compiled into a single regular
+    expression.
+    """
+
+    def __init__(self, patterns):
+        self._trie = {}
+        others = []
+        for pattern in patterns:
+            pattern = os.path.normcase(pattern)
+            prefix = pattern[:-1]
+            if pattern.endswith('*') and not any(c in prefix for c in '*?['):
+                node = self._trie
+                for c in prefix:
+                    node = node.setdefault(c, {})
+                node[None] = True
+            else:
+                others.append(fnmatch.translate(pattern))
+        self._regex = None
+        if others:
+            self._regex = re.compile('|'.join(others))
+
+    def match(self, string):
+        string = os.path.normcase(string)
+        node = self._trie
+        if None in node:
+            return True
+        for c in string:
+            node = node.get(c)
+            if node is None:
+                break
+            if None in node:
+                return True
+        return self._regex is not None and self._regex.match(string) is not None
+
+
 def file_age(filepath):
     return time.time() - os.path.getmtime(filepath)
 
 
-def walk(config, files_or_dirs, callback, **kwargs):
+def _temp_file(file):
+    # A file with a name nobody else will pick in the same directory as file,
+    # so it can be moved over file and two writers can't share it.
+    directory, name = os.path.split(file)
+    fd, tmp_file = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=directory or '.')
+    return os.fdopen(fd, 'wb'), tmp_file
+
+
+def _copy_attributes(file, tmp_file):
+    """Give tmp_file the permissions, owner and extended attributes of file.
+
+    Only the permissions have to be copied, we can't always set the owner or
+    the extended attributes and the file is still usable without them.
+    """
+    stat = os.stat(file)
+    if hasattr(os, 'chown'):
+        with contextlib.suppress(OSError):
+            os.chown(tmp_file, stat.st_uid, stat.st_gid)
+    # After the owner, changing that can clear the set-id bits.
+    shutil.copymode(file, tmp_file)
+    if hasattr(os, 'listxattr'):
+        try:
+            names = os.listxattr(file)
+        except OSError:
+            names = []
+        for name in names:
+            with contextlib.suppress(OSError):
+                os.setxattr(tmp_file, name, os.getxattr(file, name))
+
+
+def replace_file(file, data):
+    """Replace the contents of file with data in one write.
+
+    The data goes to a temporary file next to it which is then moved over the
+    top, so anyone reading the file sees either the old or the new contents.
+    """
+    out_file, new_file = _temp_file(file)
+    try:
+        with out_file:
+            out_file.write(data)
+        _copy_attributes(file, new_file)
+        os.replace(new_file, file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(new_file)
+        raise
+
+
+# ioctl to share a file's blocks with another, Linux's _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+# errnos meaning the file system can't do a clone or an in kernel copy.
+NO_FAST_COPY = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EBADF,
+                errno.ENOTTY)
+
+
+def _fast_copy(source, target):
+    # Try a copy on write clone, then an in kernel copy. Returns False if the
+    # file system can't do either.
+    size = os.fstat(source.fileno()).st_size
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in NO_FAST_COPY:
+                raise
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    try:
+        while copied < size:
+            done = os.copy_file_range(source.fileno(), target.fileno(), size - copied)
+            if done == 0:
+                break
+            copied += done
+    except OSError as e:
+        if e.errno not in NO_FAST_COPY or copied:
+            raise
+        return False
+    return copied == size
+
+
+def copy_file(file, new_file):
+    """Copy file to new_file as cheaply as the file system allows.
+
+    Where it can, new_file shares its blocks with file until one of them is
+    written to, otherwise the kernel does the copy or, failing that, we do.
+    Like `replace_file` the copy goes to a temporary file that is moved into
+    place, so new_file is always complete.
+    """
+    target, tmp_file = _temp_file(new_file)
+    try:
+        with target, open(file, 'rb') as source:
+            if not _fast_copy(source, target):
+                source.seek(0)
+                target.seek(0)
+                target.truncate()
+                shutil.copyfileobj(source, target)
+        _copy_attributes(file, tmp_file)
+        os.replace(tmp_file, new_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
+
+def open_database(file):
+    """Open one of our SQLite stores, creating it if needed.
+
+    We use write-ahead logging and a generous timeout so several processes
+    can read and update the same file.
+    """
+    dirname = os.path.dirname(file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    db = sqlite3.connect(file, timeout=60)
+    db.execute('PRAGMA journal_mode=WAL')
+    return db
+
+
+class Database:
+    """One of our SQLite stores, with a connection for each process.
+
+    A connection can't be used across a fork, so `connect` opens a new one
+    the first time it is called in each process. `setup` is called with each
+    new connection, to create the tables.
+    """
+
+    def __init__(self, file, setup):
+        self._file = file
+        self._setup = setup
+        self._db = None
+        self._pid = None
+
+    def connect(self):
+        if self._db is None or self._pid != os.getpid():
+            self._db = open_database(self._file)
+            self._setup(self._db)
+            self._pid = os.getpid()
+        return self._db
+
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+
+def data_files(config, files_or_dirs):
+    """Generate the data files `walk` will hand to its callback.
+    """
     for file_or_dir in files_or_dirs:
         if os.path.isdir(file_or_dir) and config.is_recursive:
             for root, dirs, files in os.walk(file_or_dir):
@@ -30,8 +237,153 @@ def walk(config, files_or_dirs, callback, **kwargs):
                         vvprint(f"ignoring excluded {file}")
                         continue
                     if config.is_data_file(file):
-                        callback(cfg=config, file=file, **kwargs)
+                        yield file
         elif config.is_data_file(file_or_dir):
-            callback(cfg=config, file=file_or_dir, **kwargs)
+            yield file_or_dir
         else:
             vvprint(f"ignoring {file_or_dir}")
+
+
+# The configuration a pool worker was started with. We pass it once, when the
+# worker starts, rather than pickling it up with every file.
+worker_config_ = None
+
+
+def _init_worker(config, gather_stats):
+    global worker_config_
+    worker_config_ = config
+    config.setup_output()
+    if gather_stats:
+        stats.enable()
+
+
+def _run_buffered(callback, file, kwargs):
+    """Run the callback inside a pool worker.
+
+    The messages the callback makes, and anything it prints, are handed back
+    with its result so the parent can write them in one piece, this stops the
+    output from several files interleaving.
+    """
+    with log.buffered(file) as records:
+        result = _run(callback, worker_config_, file, kwargs)
+    return records, result, stats.take()
+
+
+def _run(callback, config, file, kwargs):
+    with stats.timed('file'):
+        return callback(cfg=config, file=file, **kwargs)
+
+
+def _run_here(callback, config, file, kwargs):
+    # Without a pool we still hold a file's messages back and write them in
+    # one go.
+    try:
+        with log.buffered(file) as records:
+            return _run(callback, config, file, kwargs)
+    finally:
+        with stats.timed('output'):
+            log.write(records)
+
+
+def _finish(future, merge):
+    records, result, taken = future.result()
+    stats.merge(taken)
+    with stats.timed('output'):
+        log.write(records)
+    if merge is not None:
+        merge(result)
+
+
+def _unskipped(files, skip):
+    for file in files:
+        if skip(file):
+            vvprint(f"skipping unchanged {file}")
+            stats.count('skipped')
+            continue
+        yield file
+
+
+def files_to_walk(config, files_or_dirs, skip=None):
+    """The data files `walk` would visit.
+
+    If given, `skip` is called with each file and the file is passed over if
+    it returns True.
+    """
+    files = data_files(config, files_or_dirs)
+    if skip is not None:
+        files = _unskipped(files, skip)
+    return files
+
+
+def batched(files, size):
+    """Split files into lists of at most `size` files.
+    """
+    batch = []
+    for file in files:
+        batch.append(file)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@contextlib.contextmanager
+def pool(config, jobs=1):
+    """Provide a function that runs a callback over some files.
+
+    This is what `walk` uses. It is here so a caller can make several passes
+    over the files, or over batches of them, and keep the same processes.
+
+    The function looks like `run(files, callback, merge=None, file_kwargs=None,
+    count_files=True, **kwargs)`. `kwargs` go to the callback for every file,
+    if given `file_kwargs` is called with each file and returns extra ones for
+    just that file. Each file counts towards the 'files' statistic unless
+    `count_files` is False, for when a caller goes over files a second time.
+    """
+    def arguments(file, file_kwargs, count_files, kwargs):
+        if count_files:
+            stats.count('files')
+        if file_kwargs is None:
+            return kwargs
+        return {**kwargs, **file_kwargs(file)}
+
+    if jobs <= 1:
+        def run(files, callback, merge=None, file_kwargs=None, count_files=True, **kwargs):
+            for file in files:
+                result = _run_here(callback, config, file, arguments(file, file_kwargs, count_files, kwargs))
+                if merge is not None:
+                    merge(result)
+        yield run
+        return
+
+    # Keep a few files queued per worker but don't queue the whole tree up
+    # front, that can be a lot of futures.
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(config, stats.enabled())) as executor:
+        def run(files, callback, merge=None, file_kwargs=None, count_files=True, **kwargs):
+            pending = collections.deque()
+            for file in files:
+                pending.append(executor.submit(_run_buffered, callback, file,
+                                               arguments(file, file_kwargs, count_files, kwargs)))
+                if len(pending) >= jobs * 4:
+                    _finish(pending.popleft(), merge)
+            while pending:
+                _finish(pending.popleft(), merge)
+        yield run
+
+
+def walk(config, files_or_dirs, callback, jobs=1, merge=None, skip=None, **kwargs):
+    """Call `callback` for every data file found.
+
+    If `jobs` is more than 1 the files are spread across a pool of processes.
+    Callbacks can't share state with the parent in that case so anything they
+    want to pass back has to be returned; `merge` is then called, in the
+    parent, with each return value. Results come back in the same order as the
+    files were found.
+
+    If given, `skip` is called with each file and the file is passed over if
+    it returns True.
+    """
+    with pool(config, jobs) as run:
+        run(files_to_walk(config, files_or_dirs, skip), callback, merge, **kwargs)
@@ -0,0 +1,585 @@
+import re
+import xml.etree.ElementTree as ET
+import xml.parsers.expat
+from xml.sax.saxutils import escape, quoteattr
+
+from .const import ACDSEE_KEYWORDS_TAG, ACDSEE_REGIONS_TAG, DC_SUBJECT_TAG, EXIF_GPS_LATITUDE_TAG, EXIF_GPS_LONGITUDE_TAG, \
+    EXIF_MAKE_TAG, EXIF_MODEL_TAG, IPTCEXT_EVENT_TAG, IPTCEXT_PERSON_TAG, IPTC_GEO_COUNTRY_CODE_TAG, \
+    IPTC_GEO_LOCATION_TAG, LR_SUBJECT_TAG, PS_GEO_CITY_TAG, PS_GEO_COUNTRY_TAG, PS_GEO_STATE_TAG, \
+    XMP_CREATOR_TOOL_TAG
+
+"""Fast path for XMP sidecars.
+
+A sidecar is just an XML file so we don't need `pyexiv2` to read or write it.
+`XmpSidecar` provides the pieces of the `pyexiv2.Image` interface `MetaData`
+uses. It pulls out only the tags we are interested in and returns them with
+the same keys and value types `pyexiv2` would.
+
+When `exiv2` reads a sidecar it fills in a few IPTC and EXIF tags from their
+XMP equivalents, we do the same for the ones we use.
+
+Like `pyexiv2.ImageData`, and unlike `pyexiv2.Image`, changes are only
+recorded; `get_bytes` returns the updated file for the caller to write. The
+file is read in a single pass with `expat` noting where each property starts
+and ends, only the properties we want are built into elements. Writing splices
+the changed properties into the original text, everything else - comments,
+layout, namespace declarations and whatever wraps the packet - is left as it
+was.
+"""
+
+
+class XmpError(Exception):
+    pass
+
+
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+RDF_RDF = f'{{{RDF_NS}}}RDF'
+RDF_DESCRIPTION = f'{{{RDF_NS}}}Description'
+RDF_LI = f'{{{RDF_NS}}}li'
+RDF_ALT = f'{{{RDF_NS}}}Alt'
+RDF_BAG = f'{{{RDF_NS}}}Bag'
+RDF_SEQ = f'{{{RDF_NS}}}Seq'
+RDF_PARSE_TYPE = f'{{{RDF_NS}}}parseType'
+XML_LANG = f'{{{XML_NS}}}lang'
+
+# The prefixes `exiv2` uses in its keys, they don't have to match the ones
+# used in the file.
+EXIV2_PREFIXES = {
+    'http://ns.acdsee.com/iptc/1.0/': 'acdsee',
+    'http://ns.acdsee.com/regions/': 'acdsee-rs',
+    'http://purl.org/dc/elements/1.1/': 'dc',
+    'http://ns.adobe.com/exif/1.0/': 'exif',
+    'http://iptc.org/std/Iptc4xmpCore/1.0/xmlns/': 'iptc',
+    'http://iptc.org/std/Iptc4xmpExt/2008-02-29/': 'iptcExt',
+    'http://ns.adobe.com/lightroom/1.0/': 'lr',
+    'http://ns.adobe.com/photoshop/1.0/': 'photoshop',
+    'http://ns.adobe.com/tiff/1.0/': 'tiff',
+    'http://ns.adobe.com/xap/1.0/': 'xmp',
+}
+EXIV2_NAMESPACES = {prefix: uri for uri, prefix in EXIV2_PREFIXES.items()}
+
+# Prefixes to use if we have to add a namespace to the file, if it isn't here
+# we use the key prefix. These are what `exiv2` does.
+FILE_PREFIXES = {
+    'http://iptc.org/std/Iptc4xmpCore/1.0/xmlns/': 'Iptc4xmpCore',
+}
+
+# The IPTC and EXIF tags `exiv2` would fill in from XMP.
+IPTC_TO_XMP = {
+    IPTC_GEO_COUNTRY_CODE_TAG: 'Xmp.iptc.CountryCode',
+    IPTC_GEO_LOCATION_TAG: 'Xmp.iptc.Location',
+}
+EXIF_TO_XMP = {
+    EXIF_MAKE_TAG: 'Xmp.tiff.Make',
+    EXIF_MODEL_TAG: 'Xmp.tiff.Model',
+}
+
+# The array type to use when we create these tags.
+ARRAY_TYPES = {
+    DC_SUBJECT_TAG: RDF_BAG,
+    IPTCEXT_PERSON_TAG: RDF_SEQ,
+    LR_SUBJECT_TAG: RDF_SEQ,
+}
+
+REGIONS_TAG = ACDSEE_REGIONS_TAG
+
+# The only tags we pull out of the file.
+WANTED_TAGS = {ACDSEE_KEYWORDS_TAG, DC_SUBJECT_TAG, EXIF_GPS_LATITUDE_TAG, EXIF_GPS_LONGITUDE_TAG,
+               IPTCEXT_EVENT_TAG, IPTCEXT_PERSON_TAG, LR_SUBJECT_TAG, PS_GEO_CITY_TAG, PS_GEO_COUNTRY_TAG,
+               PS_GEO_STATE_TAG, XMP_CREATOR_TOOL_TAG, REGIONS_TAG,
+               *IPTC_TO_XMP.values(), *EXIF_TO_XMP.values()}
+
+# Every tag `XmpSidecar` can hand back, under the names pyexiv2 gives them.
+SIDECAR_TAGS = WANTED_TAGS | set(IPTC_TO_XMP) | set(EXIF_TO_XMP)
+
+
+# The end of a tag, skipping over any '>' in attribute values.
+TAG_END = re.compile(rb'''(?:[^>"']|"[^"]*"|'[^']*')*>''')
+
+# An attribute in a start tag along with the white space in front of it.
+ATTRIBUTE = re.compile(rb'''\s+([^\s=/>]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+
+
+def _tag_end(raw, position):
+    """Return the offset just past the tag that starts at position.
+    """
+    match = TAG_END.match(raw, position)
+    if match is None:
+        raise XmpError("unterminated tag")
+    return match.end()
+
+
+def _name(name):
+    """Split an `expat` name, 'uri local prefix', into a `{uri}local` tag and
+    the prefix the file used for it.
+    """
+    parts = name.split(' ')
+    if len(parts) == 1:
+        return name, None
+    return f'{{{parts[0]}}}{parts[1]}', parts[2] if len(parts) > 2 else ''
+
+
+def _qname(prefix, local):
+    return f'{prefix}:{local}' if prefix else local
+
+
+def _split_tag(tag):
+    """Split `{uri}local` into the uri and local name.
+    """
+    if not tag.startswith('{'):
+        return None, tag
+    uri, local = tag[1:].split('}', 1)
+    return uri, local
+
+
+def _key(tag):
+    uri, local = _split_tag(tag)
+    prefix = EXIV2_PREFIXES.get(uri, None)
+    if prefix is None:
+        return None
+    return f'Xmp.{prefix}.{local}'
+
+
+def _field(tag):
+    uri, local = _split_tag(tag)
+    prefix = EXIV2_PREFIXES.get(uri, None)
+    if prefix is None:
+        return None
+    return f'{prefix}:{local}'
+
+
+def _is_struct(element):
+    if element.get(RDF_PARSE_TYPE) == 'Resource':
+        return True
+    if element.find(RDF_DESCRIPTION) is not None:
+        return True
+    return any(name not in (XML_LANG,) for name in element.attrib)
+
+
+def _struct_fields(element):
+    """Generate the (tag, value or element) pairs of a structure.
+    """
+    if element.find(RDF_DESCRIPTION) is not None:
+        element = element.find(RDF_DESCRIPTION)
+    for name, value in element.attrib.items():
+        if name not in (RDF_PARSE_TYPE, f'{{{RDF_NS}}}about'):
+            yield name, value
+    for child in element:
+        yield child.tag, child
+
+
+def _flatten_struct(data, base, element):
+    for tag, value in _struct_fields(element):
+        field = _field(tag)
+        if field is None:
+            continue
+        key = f'{base}/{field}'
+        if isinstance(value, str):
+            data[key] = value
+            continue
+        array = None
+        for container in (RDF_BAG, RDF_SEQ, RDF_ALT):
+            array = value.find(container)
+            if array is not None:
+                break
+        if array is not None:
+            items = array.findall(RDF_LI)
+            if any(_is_struct(item) for item in items):
+                for index, item in enumerate(items, start=1):
+                    _flatten_struct(data, f'{key}[{index}]', item)
+            else:
+                data[key] = [item.text or '' for item in items]
+        elif _is_struct(value):
+            _flatten_struct(data, key, value)
+        else:
+            data[key] = value.text or ''
+
+
+def _value(element):
+    """Convert a property element into the value `pyexiv2` would return.
+    """
+    array = element.find(RDF_ALT)
+    if array is not None:
+        return {f'lang="{item.get(XML_LANG, "x-default")}"': item.text or '' for item in array.findall(RDF_LI)}
+    for container in (RDF_BAG, RDF_SEQ):
+        array = element.find(container)
+        if array is not None:
+            return [item.text or '' for item in array.findall(RDF_LI)]
+    return element.text or ''
+
+
+class _Property:
+    """Where a property element is in the file.
+
+    `space` is where the white space in front of it starts, `element` is only
+    built for the properties we want.
+    """
+
+    def __init__(self, tag, qname, space, start):
+        self.tag = tag
+        self.qname = qname
+        self.space = space
+        self.start = start
+        self.end = None
+        self.container = None
+        self.element = None
+
+
+class _Description:
+    """Where an rdf:Description is in the file and what its start tag holds.
+    """
+
+    def __init__(self, qname, start, start_end, namespaces):
+        self.qname = qname
+        self.start = start
+        self.start_end = start_end
+        self.close = None
+        self.namespaces = namespaces
+        self.values = {}
+        self.attributes = {}
+        self.children = []
+
+    def prefix(self, uri):
+        for prefix, namespace in self.namespaces.items():
+            if namespace == uri:
+                return prefix
+        return None
+
+
+class XmpSidecar:
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._changes = {}
+        with open(file_name, 'rb') as xmp_file:
+            self._raw = xmp_file.read()
+
+        self._descriptions = []
+        self._rdf = None
+        self._rdf_namespaces = None
+        self._rdf_close = None
+        self._depth = None
+        self._scan()
+        if self._rdf is None:
+            raise XmpError(f"no RDF found in {file_name}")
+        self._xmp = self._parse()
+
+    def _scan(self):
+        raw = self._raw
+        parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+        parser.namespace_prefixes = True
+        parser.buffer_text = True
+
+        # Each open element as tag, start, end of start tag and namespaces in
+        # scope, a dictionary of prefix to uri.
+        stack = []
+        declared = {}
+        description = None
+        prop = None
+        builder = None
+
+        def start_namespace(prefix, uri):
+            declared[prefix or ''] = uri
+
+        def start_element(name, attributes):
+            nonlocal description, prop, builder
+            tag, prefix = _name(name)
+            start = parser.CurrentByteIndex
+            namespaces = stack[-1][3] if stack else {'xml': XML_NS}
+            if declared:
+                namespaces = {**namespaces, **declared}
+                declared.clear()
+            parent = stack[-1][0] if stack else None
+            start_end = _tag_end(raw, start)
+            stack.append((tag, start, start_end, namespaces))
+            depth = len(stack)
+
+            if builder is not None:
+                builder.start(tag, {_name(key)[0]: value for key, value in attributes.items()})
+            if prop is not None:
+                if prop.container is None and depth == self._depth + 2:
+                    prop.container = tag
+            elif description is not None:
+                previous = description.children[-1].end if description.children else description.start_end
+                space = previous + len(raw[previous:start].rstrip())
+                prop = _Property(tag, _qname(prefix, tag.rpartition('}')[2]), space, start)
+                if _key(tag) in WANTED_TAGS:
+                    builder = ET.TreeBuilder()
+                    builder.start(tag, {_name(key)[0]: value for key, value in attributes.items()})
+            elif tag == RDF_DESCRIPTION and parent == RDF_RDF:
+                description = _Description(_qname(prefix, 'Description'), start, start_end, namespaces)
+                self._description_attributes(description, {_name(key)[0]: value
+                                                           for key, value in attributes.items()})
+                self._depth = depth
+            elif tag == RDF_RDF and self._rdf is None:
+                self._rdf, self._rdf_namespaces = _qname(prefix, 'RDF'), namespaces
+
+        def end_element(_expat_name):
+            nonlocal description, prop, builder
+            tag, start, start_end, _ = stack.pop()
+            if raw[start_end - 2:start_end] == b'/>':
+                close, end = None, start_end
+            else:
+                close = parser.CurrentByteIndex
+                end = _tag_end(raw, close)
+            if builder is not None:
+                builder.end(tag)
+            if prop is not None and len(stack) == self._depth:
+                prop.end = end
+                if builder is not None:
+                    prop.element = builder.close()
+                    builder = None
+                description.children.append(prop)
+                prop = None
+            elif description is not None and len(stack) == self._depth - 1:
+                description.close = close
+                self._descriptions.append(description)
+                description = None
+            elif tag == RDF_RDF and self._rdf_close is None:
+                self._rdf_close = close
+
+        def character_data(data):
+            if builder is not None:
+                builder.data(data)
+
+        parser.StartNamespaceDeclHandler = start_namespace
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = character_data
+        try:
+            parser.Parse(raw, True)
+        except (xml.parsers.expat.ExpatError, XmpError) as e:
+            raise XmpError(f"can't parse {self._file_name} ({str(e)})")
+
+    def _description_attributes(self, description, values):
+        # Find where each attribute of the start tag is so it can be changed.
+        start_tag = self._raw[description.start:description.start_end]
+        for match in ATTRIBUTE.finditer(start_tag):
+            prefix, _, local = match.group(1).decode('utf-8').rpartition(':')
+            if prefix == 'xmlns' or not prefix or prefix not in description.namespaces:
+                continue
+            tag = f'{{{description.namespaces[prefix]}}}{local}'
+            group = 2 if match.group(2) is not None else 3
+            description.values[tag] = values.get(tag, '')
+            description.attributes[tag] = (description.start + match.start(),
+                                           description.start + match.start(group),
+                                           description.start + match.end(group))
+
+    def _parse(self):
+        data = {}
+        for description in self._descriptions:
+            for tag, value in description.values.items():
+                key = _key(tag)
+                if key in WANTED_TAGS:
+                    data[key] = value
+            for child in description.children:
+                if child.element is None:
+                    continue
+                key = _key(child.tag)
+                if key == REGIONS_TAG:
+                    _flatten_struct(data, key, child.element)
+                else:
+                    data[key] = _value(child.element)
+        return data
+
+    def _array_type(self, key, tag):
+        for description in self._descriptions:
+            for child in description.children:
+                if child.tag == tag and child.container in (RDF_BAG, RDF_SEQ):
+                    return child.container
+        return ARRAY_TYPES.get(key, RDF_BAG)
+
+    def _set(self, key, value):
+        try:
+            _, prefix, local = key.split('.', 2)
+            uri = EXIV2_NAMESPACES[prefix]
+        except (KeyError, ValueError):
+            raise XmpError(f"unsupported tag {key}")
+        if '/' in local or '[' in local:
+            raise XmpError(f"unsupported tag {key}")
+        if value is not None and not isinstance(value, (str, list, dict)):
+            raise XmpError(f"unsupported value for {key}")
+
+        tag = f'{{{uri}}}{local}'
+        self._changes[tag] = (key, value, self._array_type(key, tag) if isinstance(value, list) else None)
+        self._xmp.pop(key, None)
+        if value is not None:
+            self._xmp[key] = value
+
+    def _render(self, qname, value, container, rdf, indent):
+        """Write out a property element.
+
+        If `indent` holds a new line the contents are laid out under it a
+        space further in for each level, the way `exiv2` does, otherwise the
+        element goes on one line.
+        """
+        if isinstance(value, str):
+            return f'<{qname}>{escape(value)}</{qname}>'
+        step = indent + ' ' if '\n' in indent else ''
+        inner = step + ' ' if step else ''
+        li = _qname(rdf, 'li')
+        if isinstance(value, dict):
+            container = RDF_ALT
+            items = []
+            for lang, item in value.items():
+                match = re.match(r'lang="(.*)"', lang)
+                items.append(f'{inner}<{li} xml:lang={quoteattr(match.group(1) if match else lang)}>'
+                             f'{escape(item)}</{li}>')
+        else:
+            items = [f'{inner}<{li}>{escape(item)}</{li}>' for item in value]
+        array = _qname(rdf, container.rpartition('}')[2])
+        return (f'<{qname}>{step}<{array}>{"".join(items)}{step}</{array}>'
+                f'{indent if step else ""}</{qname}>')
+
+    def _layout(self, child):
+        return self._raw[child.space:child.start].decode('utf-8')
+
+    def _new_prefix(self, uri, prefix, namespaces, added):
+        # Declare uri on the description, avoiding prefixes already in use.
+        prefix = FILE_PREFIXES.get(uri, prefix)
+        candidate, count = prefix, 1
+        while candidate in namespaces or candidate in added.values():
+            candidate, count = f'{prefix}{count}', count + 1
+        added[uri] = candidate
+        return candidate
+
+    def _edits(self):
+        """Work out the changes to make to the file, as a list of (start, end,
+        replacement) with offsets into the original.
+        """
+        raw = self._raw
+        edits = []
+        first = self._descriptions[0] if self._descriptions else None
+        if first is not None:
+            rdf, namespaces = first.prefix(RDF_NS), first.namespaces
+        else:
+            rdf, namespaces = self._rdf.rpartition(':')[0], self._rdf_namespaces
+
+        # New properties go at the end of the first description, laid out the
+        # same as what is already there.
+        lead = layout = ''
+        if first is not None and first.children:
+            lead = layout = self._layout(first.children[0])
+            if b'\n' not in raw[first.children[0].start:first.children[0].end]:
+                layout = ''
+        elif first is not None and first.close is not None:
+            lead = layout = raw[first.start_end:first.close].decode('utf-8')
+        if lead.strip():
+            lead = layout = ''
+
+        added_namespaces = {}
+        added_attributes = []
+        added_elements = []
+        for tag, (key, value, container) in self._changes.items():
+            placed = value is None
+            for description in self._descriptions:
+                if tag in description.attributes:
+                    space, value_start, value_end = description.attributes[tag]
+                    if not placed and isinstance(value, str):
+                        quote = raw[value_start - 1:value_start].decode('utf-8')
+                        text = escape(value, {quote: '&quot;' if quote == '"' else '&apos;', '\n': '&#10;'})
+                        edits.append((value_start, value_end, text))
+                        placed = True
+                    else:
+                        edits.append((space, value_end + 1, ''))
+                for child in description.children:
+                    if child.tag != tag:
+                        continue
+                    if not placed:
+                        # Keep to one line if that is how it was.
+                        child_layout = self._layout(child) if b'\n' in raw[child.start:child.end] else ''
+                        edits.append((child.start, child.end, self._render(child.qname, value, container,
+                                                                           description.prefix(RDF_NS), child_layout)))
+                        placed = True
+                    else:
+                        edits.append((child.space, child.end, ''))
+            if placed:
+                continue
+
+            uri, local = _split_tag(tag)
+            prefix = added_namespaces.get(uri, None)
+            if prefix is None:
+                prefix = next((p for p, namespace in namespaces.items() if namespace == uri), None)
+            if prefix is None:
+                prefix = self._new_prefix(uri, key.split('.')[1], namespaces, added_namespaces)
+            if isinstance(value, str):
+                added_attributes.append(f' {_qname(prefix, local)}={quoteattr(value)}')
+            else:
+                added_elements.append(lead + self._render(_qname(prefix, local), value, container, rdf, layout))
+
+        declarations = ''.join(f' xmlns:{prefix}="{uri}"' for uri, prefix in added_namespaces.items())
+        start_tag = declarations + ''.join(added_attributes)
+        elements = ''.join(added_elements)
+        if first is None:
+            if (start_tag or elements) and self._rdf_close is None:
+                raise XmpError(f"no room for a description in {self._file_name}")
+            if start_tag or elements:
+                description = _qname(rdf, 'Description')
+                about = _qname(rdf, 'about')
+                edits.append((self._rdf_close, self._rdf_close,
+                              f'<{description} {about}=""{start_tag}>{elements}</{description}>'))
+        elif first.close is None:
+            # An empty description has to be opened up to take elements.
+            if start_tag:
+                edits.append((first.start_end - 2, first.start_end - 2, start_tag))
+            if elements:
+                closing = lead.rstrip(' ') if '\n' in lead else ''
+                edits.append((first.start_end - 2, first.start_end,
+                              f'>{elements}{closing}</{first.qname}>'))
+        else:
+            if start_tag:
+                edits.append((first.start_end - 1, first.start_end - 1, start_tag))
+            if elements:
+                position = first.children[-1].end if first.children else first.start_end
+                edits.append((position, position, elements))
+        return edits
+
+    def get_bytes(self):
+        """Return the file with our changes made.
+
+        A changed property is rewritten where it is, a removed one is taken
+        out along with the white space in front of it and new ones are added
+        to the first rdf:Description. Nothing else in the file is touched.
+        """
+        pieces = []
+        position = 0
+        for start, end, text in sorted(self._edits(), key=lambda edit: (edit[0], edit[1])):
+            if start < position:
+                raise XmpError(f"overlapping changes to {self._file_name}")
+            pieces.append(self._raw[position:start])
+            pieces.append(text.encode('utf-8'))
+            position = end
+        pieces.append(self._raw[position:])
+        return b''.join(pieces)
+
+    def read_xmp(self):
+        return dict(self._xmp)
+
+    def read_iptc(self):
+        return {iptc: self._xmp[xmp] for iptc, xmp in IPTC_TO_XMP.items() if xmp in self._xmp}
+
+    def read_exif(self):
+        return {exif: self._xmp[xmp] for exif, xmp in EXIF_TO_XMP.items() if xmp in self._xmp}
+
+    def modify_xmp(self, changes):
+        for key, value in changes.items():
+            self._set(key, value)
+
+    def modify_iptc(self, changes):
+        for key, value in changes.items():
+            if key not in IPTC_TO_XMP:
+                raise XmpError(f"unsupported tag {key}")
+            if isinstance(value, list):
+                value = value[0] if value else None
+            self._set(IPTC_TO_XMP[key], value)
+
+    def modify_exif(self, changes):
+        for key, value in changes.items():
+            if key not in EXIF_TO_XMP:
+                raise XmpError(f"unsupported tag {key}")
+            self._set(EXIF_TO_XMP[key], value)
+
+    def close(self):
+        pass
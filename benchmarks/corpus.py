@@ -0,0 +1,167 @@
+"""Make a synthetic corpus for the benchmarks.
+
+The files look like what ACDSee leaves behind: hierarchical keywords in
+`Xmp.acdsee.keywords`, face regions in `Xmp.acdsee-rs.Regions` and GPS
+coordinates in the XMP EXIF tags. Images are made with Pillow and the XMP is
+written with `pyexiv2`; sidecars are written directly.
+
+Everything is generated from a seed so the same arguments always give the
+same corpus. Run it from the top of the source tree to make one to look at:
+
+    python -m benchmarks.corpus directory [files]
+"""
+import os
+import random
+import sys
+
+import pyexiv2
+import yaml
+from PIL import Image
+
+KINDS = ('jpg', 'tif', 'xmp')
+
+# Places the GPS coordinates are scattered around, the way real photos
+# bunch up around wherever you were.
+CENTRES = [(48.86, 2.35), (41.90, 12.50), (45.42, -75.70), (51.51, -0.13), (35.68, 139.69),
+           (-33.87, 151.21), (40.71, -74.01), (52.52, 13.40), (37.98, 23.73), (-22.91, -43.17)]
+
+XMP_PACKET = '''<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:acdsee="http://ns.acdsee.com/iptc/1.0/"
+    xmlns:acdsee-rs="http://ns.acdsee.com/regions/"
+    xmlns:exif="http://ns.adobe.com/exif/1.0/"
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmp:CreatorTool="ACDSee Photo Studio">
+   <acdsee:keywords><rdf:Bag>{keywords}</rdf:Bag></acdsee:keywords>{regions}{gps}
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>'''
+
+REGION = ('<rdf:li rdf:parseType="Resource"><acdsee-rs:Type>Face</acdsee-rs:Type>'
+          '<acdsee-rs:Name>{name}</acdsee-rs:Name></rdf:li>')
+REGIONS = ('<acdsee-rs:Regions rdf:parseType="Resource"><acdsee-rs:RegionList><rdf:Bag>{regions}'
+           '</rdf:Bag></acdsee-rs:RegionList></acdsee-rs:Regions>')
+GPS = '<exif:GPSLatitude>{latitude}</exif:GPSLatitude><exif:GPSLongitude>{longitude}</exif:GPSLongitude>'
+
+
+def vocabulary(count, seed=1):
+    """Return `count` hierarchical keywords, the non people part of an export.
+    """
+    rng = random.Random(seed)
+    keywords = []
+    for i in range(count):
+        depth = rng.randint(1, 3)
+        topics = [f'Topic{rng.randint(0, 50)}' for _ in range(depth)]
+        keywords.append('|'.join(['Things'] + topics + [f'Thing{i}']))
+    return keywords
+
+
+def people(count):
+    return [f'Person{i}' for i in range(count)]
+
+
+def _gps(value, positive, negative):
+    hemisphere = positive if value >= 0 else negative
+    value = abs(value)
+    return f'{int(value)},{(value - int(value)) * 60:.4f}{hemisphere}'
+
+
+def xmp_packet(keywords, faces, coords):
+    regions = ''
+    if faces:
+        regions = REGIONS.format(regions=''.join(REGION.format(name=name) for name in faces))
+    gps = ''
+    if coords is not None:
+        gps = GPS.format(latitude=_gps(coords[0], 'N', 'S'), longitude=_gps(coords[1], 'E', 'W'))
+    return XMP_PACKET.format(keywords=''.join(f'<rdf:li>{keyword}</rdf:li>' for keyword in keywords),
+                             regions=regions, gps=gps)
+
+
+def make_file(file, keywords, faces, coords, size=64):
+    packet = xmp_packet(keywords, faces, coords)
+    if file.endswith('.xmp'):
+        with open(file, 'w') as xmp_file:
+            xmp_file.write(packet)
+        return
+    Image.new('RGB', (size, size), 'grey').save(file)
+    image = pyexiv2.Image(file)
+    image.modify_raw_xmp(packet)
+    image.modify_exif({'Exif.Image.Make': 'Canon', 'Exif.Image.Model': 'Canon EOS 5D'})
+    image.close()
+
+
+def make_corpus(directory, files, keywords=10, faces=2, gps=0.8, kinds=KINDS, vocabulary_size=1000,
+                people_count=100, per_directory=100, seed=1):
+    """Fill `directory` with `files` images and sidecars.
+
+    :param keywords Keywords per file
+    :param faces Face regions per file
+    :param gps Fraction of files with GPS coordinates
+    :param kinds File types to cycle through
+    :return List of the files made
+    """
+    rng = random.Random(seed)
+    words = vocabulary(vocabulary_size, seed)
+    names = people(people_count)
+    made = []
+    for i in range(files):
+        sub_directory = os.path.join(directory, f'dir{i // per_directory:04d}')
+        os.makedirs(sub_directory, exist_ok=True)
+        file = os.path.join(sub_directory, f'img{i:06d}.{kinds[i % len(kinds)]}')
+        file_keywords = rng.sample(words, min(keywords, len(words)))
+        file_faces = rng.sample(names, min(faces, len(names)))
+        coords = None
+        if rng.random() < gps:
+            latitude, longitude = rng.choice(CENTRES)
+            coords = (latitude + rng.uniform(-0.05, 0.05), longitude + rng.uniform(-0.05, 0.05))
+        make_file(file, file_keywords, file_faces, coords)
+        made.append(file)
+    return made
+
+
+def make_keyword_export(file, count, people_count=100, seed=1):
+    """Write an ACDSee keyword export with about `count` keywords.
+    """
+    lines = []
+    last = []
+    for keyword in sorted(vocabulary(count, seed)):
+        topics = keyword.split('|')
+        common = 0
+        while common < min(len(last), len(topics)) and last[common] == topics[common]:
+            common += 1
+        for depth in range(common, len(topics)):
+            lines.append('\t' * depth + topics[depth])
+        last = topics
+    lines.append('People')
+    lines.append('\tFriends')
+    lines.extend(f'\t\t{name}' for name in people(people_count))
+    with open(file, 'w') as export_file:
+        export_file.write('\n'.join(lines) + '\n')
+
+
+def make_config(file, cache_dir, people_count=100):
+    """Write a config file with `people_count` people in it.
+    """
+    settings = {
+        'global': {
+            'cache-dir': cache_dir,
+            'geocode-backend': 'stub',
+            'keywords-excluded': ['Things|Topic1|'],
+        },
+        'people': [{'Family': people(people_count)}],
+    }
+    with open(file, 'w') as config_file:
+        yaml.safe_dump(settings, config_file)
+
+
+def main():
+    directory = sys.argv[1]
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    make_corpus(directory, files)
+    make_keyword_export(os.path.join(directory, 'keywords.txt'), 1000)
+    make_config(os.path.join(directory, 'config.yaml'), os.path.join(directory, 'cache'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Micro-benchmark for keyword and file pattern matching.
+
+Compares the old loop over `fnmatch.fnmatch` with `PatternMatcher` for a
+library with lots of keywords and lots of exclusions. Run it from the top of
+the source tree:
+
+    python -m benchmarks.patterns [keywords] [exclusions]
+"""
+import fnmatch
+import random
+import sys
+import time
+
+from acdsee_helper.util import PatternMatcher
+
+
+def build(keyword_count, exclusion_count):
+    random.seed(1)
+    topics = [f'Topic{i}' for i in range(200)]
+    keywords = []
+    for i in range(keyword_count):
+        depth = random.randint(1, 4)
+        keywords.append('|'.join(random.choice(topics) for _ in range(depth)) + f'|Leaf{i}')
+    exclusions = [f'{random.choice(topics)}|{random.choice(topics)}*' for _ in range(exclusion_count)]
+    exclusions += ['Events|*', 'People|*', '*|Private|*']
+    return keywords, exclusions
+
+
+def old_remove_hidden(keywords, exclusions):
+    visible = []
+    for keyword in keywords:
+        add = True
+        for pattern in exclusions:
+            if fnmatch.fnmatch(keyword, pattern):
+                add = False
+                break
+        if add:
+            visible.append(keyword)
+    return visible
+
+
+def new_remove_hidden(keywords, matcher):
+    return [keyword for keyword in keywords if not matcher.match(keyword)]
+
+
+def timed(name, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    print(f'{name:>10}: {elapsed * 1000:9.1f}ms')
+    return result, elapsed
+
+
+def main():
+    keyword_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    exclusion_count = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    keywords, exclusions = build(keyword_count, exclusion_count)
+    print(f'{len(keywords)} keywords, {len(exclusions)} exclusions')
+
+    old, old_time = timed('fnmatch', old_remove_hidden, keywords, exclusions)
+    matcher, compile_time = timed('compile', PatternMatcher, exclusions)
+    new, new_time = timed('matcher', new_remove_hidden, keywords, matcher)
+    assert old == new, 'results differ'
+    print(f'{"speed up":>10}: {old_time / (compile_time + new_time):9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""Benchmark suite.
+
+Builds a synthetic corpus at each size (see `benchmarks.corpus`) and times
+the main pieces of the program against it. Geocoding uses a stub so nothing
+goes over the network and the numbers only depend on our code.
+
+Results can be saved and compared with an earlier run to spot regressions.
+Run it from the top of the source tree:
+
+    python -m benchmarks.suite --sizes 100,400 --save
+    python -m benchmarks.suite --compare benchmarks/results/<earlier>.json
+
+Saved results go in `benchmarks/results`, named after the current commit
+unless you give a `--label`.
+"""
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import click
+from click.testing import CliRunner
+
+from acdsee_helper import acdsee
+from acdsee_helper import catalog
+from acdsee_helper import config
+from acdsee_helper import geocode
+from acdsee_helper import keywords
+from acdsee_helper import metadata
+from acdsee_helper.const import __version__
+from acdsee_helper.util import walk
+
+from . import corpus
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+class StubGeoLocator(geocode.BaseGeoLocator):
+    """Make up a place from the coordinates, no network needed.
+    """
+
+    def __init__(self, cfg):
+        super().__init__(cfg, None)
+
+    def lookup(self, coords):
+        latitude, longitude = round(coords[0], 1), round(coords[1], 1)
+        return {geocode.GEOCODE_COUNTRY_CODE_TAG: 'XX',
+                geocode.GEOCODE_COUNTRY_TAG: f'Country{int(latitude) % 7}',
+                geocode.GEOCODE_STATE_TAG: f'State{int(longitude) % 11}',
+                geocode.GEOCODE_CITY_TAG: f'City {latitude} {longitude}',
+                geocode.GEOCODE_LOCATION_TAG: None}
+
+
+def _options(work):
+    return {
+        'dry_run': False,
+        'verbose': 0,
+        'no_color': True,
+        'config_file': os.path.join(work, 'config.yaml'),
+        'keyword_file': os.path.join(work, 'keywords.txt'),
+        'recursive': True,
+    }
+
+
+class Corpus:
+    """A corpus of `size` files plus its configuration.
+    """
+
+    def __init__(self, directory, size):
+        self.size = size
+        self.work = os.path.join(directory, str(size))
+        self.pictures = os.path.join(self.work, 'pictures')
+        self.cache_dir = os.path.join(self.work, 'cache')
+        os.makedirs(self.pictures)
+        self.files = corpus.make_corpus(self.pictures, size)
+        corpus.make_keyword_export(os.path.join(self.work, 'keywords.txt'), size * 100)
+        corpus.make_config(os.path.join(self.work, 'config.yaml'), self.cache_dir)
+
+    def config(self):
+        return config.ACDSeeConfig(_options(self.work))
+
+    def reset_caches(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        geocode.geo_cache_ = None
+        catalog.catalog_ = None
+        keywords.compiled_.clear()
+
+    def copy(self):
+        copy = f'{self.pictures}.copy'
+        shutil.rmtree(copy, ignore_errors=True)
+        shutil.copytree(self.pictures, copy)
+        return [file.replace(self.pictures, copy, 1) for file in self.files]
+
+
+def bench_walk(c, cfg):
+    found = []
+    start = time.perf_counter()
+    walk(cfg, [c.pictures], lambda cfg, file: found.append(file))
+    return time.perf_counter() - start, len(found)
+
+
+def bench_metadata_load(c, cfg):
+    start = time.perf_counter()
+    for file in c.files:
+        metadata.MetaData(cfg, file, tags=metadata.FIX_TAGS).get_all_keywords
+    return time.perf_counter() - start, len(c.files)
+
+
+def bench_fix_up(c, cfg):
+    images = [metadata.MetaData(cfg, file, tags=metadata.FIX_TAGS) for file in c.files]
+    start = time.perf_counter()
+    for m in images:
+        m.fix_up_start()
+        m.fix_up()
+    return time.perf_counter() - start, len(images)
+
+
+def bench_fix_up_geo(c, cfg):
+    images = [metadata.MetaData(cfg, file, tags=metadata.FIX_TAGS) for file in c.files]
+    start = time.perf_counter()
+    for m in images:
+        m.fix_up_geo()
+    return time.perf_counter() - start, len(images)
+
+
+def bench_write_changes(c, cfg):
+    images = []
+    for file in c.copy():
+        m = metadata.MetaData(cfg, file, tags=metadata.FIX_TAGS)
+        m.fix_up_start()
+        m.fix_up()
+        images.append(m)
+    start = time.perf_counter()
+    for m in images:
+        m.write_changes(force=True)
+    return time.perf_counter() - start, len(images)
+
+
+def _run(*args):
+    result = CliRunner().invoke(acdsee.cli, list(args), catch_exceptions=False)
+    if result.exit_code != 0:
+        raise click.ClickException(f'{args[0]} failed: {result.output}')
+
+
+def bench_keywords(c, cfg):
+    start = time.perf_counter()
+    _run('keywords', '-G', '-j', '1', '-c', cfg.config_file, '-k', cfg.keyword_file, '-r', c.pictures)
+    return time.perf_counter() - start, len(c.files)
+
+
+def bench_find(c, cfg):
+    start = time.perf_counter()
+    _run('find', '-j', '1', '-c', cfg.config_file, '-r', 'Thing1', c.pictures)
+    return time.perf_counter() - start, len(c.files)
+
+
+def bench_acdsee_to_hash(c, cfg):
+    with open(cfg.keyword_file) as keyword_file:
+        lines = keyword_file.readlines()
+    start = time.perf_counter()
+    keywords.acdsee_to_hash(lines)
+    return time.perf_counter() - start, len(lines)
+
+
+def bench_geocache_check(c, cfg):
+    rng = random.Random(1)
+
+    def point():
+        latitude, longitude = rng.choice(corpus.CENTRES)
+        return latitude + rng.uniform(-0.5, 0.5), longitude + rng.uniform(-0.5, 0.5)
+
+    cache = geocode.GeoCache(cfg)
+    for _ in range(c.size):
+        cache.update(point(), {geocode.GEOCODE_COUNTRY_CODE_TAG: 'XX'})
+    checks = [point() for _ in range(c.size * 10)]
+    start = time.perf_counter()
+    for coords in checks:
+        cache.check(coords)
+    return time.perf_counter() - start, len(checks)
+
+
+BENCHMARKS = {
+    'walk': bench_walk,
+    'metadata_load': bench_metadata_load,
+    'fix_up': bench_fix_up,
+    'fix_up_geo': bench_fix_up_geo,
+    'write_changes': bench_write_changes,
+    'keywords': bench_keywords,
+    'find': bench_find,
+    'acdsee_to_hash': bench_acdsee_to_hash,
+    'geocache_check': bench_geocache_check,
+}
+
+
+def _label():
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+        return f'{__version__}-{commit}'
+    except (OSError, subprocess.CalledProcessError):
+        return __version__
+
+
+def run_suite(sizes, repeats, only):
+    results = {}
+    geocode.get_locator = StubGeoLocator
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            c = Corpus(directory, size)
+            for name, bench in BENCHMARKS.items():
+                if only and name not in only:
+                    continue
+                best, items = None, 0
+                for _ in range(repeats):
+                    c.reset_caches()
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        elapsed, items = bench(c, c.config())
+                    best = elapsed if best is None else min(best, elapsed)
+                key = f'{name}/{size}'
+                results[key] = {'seconds': best, 'items': items, 'us_per_item': best / max(items, 1) * 1e6}
+                click.echo(f'{key:>24}: {best * 1000:10.1f}ms {results[key]["us_per_item"]:10.1f}us/item')
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(results, earlier_file, threshold):
+    with open(earlier_file) as earlier:
+        earlier = json.load(earlier)
+    click.echo(f'compared with {earlier["label"]}:')
+    regressions = 0
+    for key, result in results.items():
+        if key not in earlier['results']:
+            continue
+        ratio = result['us_per_item'] / max(earlier['results'][key]['us_per_item'], 1e-9)
+        flag = ''
+        if ratio > threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        click.echo(f'{key:>24}: {ratio:6.2f}x{flag}')
+    return regressions
+
+
+@click.command()
+@click.option('-s', '--sizes', default='100,400', show_default=True, help="Corpus sizes, comma separated")
+@click.option('-r', '--repeats', default=3, show_default=True, help="Runs per benchmark, the best is kept")
+@click.option('-b', '--only', multiple=True, type=click.Choice(list(BENCHMARKS)), help="Only run these")
+@click.option('-l', '--label', default=None, help="Name for the saved results")
+@click.option('--save', is_flag=True, default=False, help="Save the results")
+@click.option('-c', '--compare', 'earlier', default=None, help="Earlier results to compare against")
+@click.option('-t', '--threshold', default=1.2, show_default=True, help="Slow down counted as a regression")
+def main(sizes, repeats, only, label, save, earlier, threshold):
+    label = label or _label()
+    results = run_suite([int(size) for size in sizes.split(',')], repeats, only)
+    if save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        results_file = os.path.join(RESULTS_DIR, f'{label}.json')
+        with open(results_file, 'w') as out:
+            json.dump({'label': label, 'python': platform.python_version(), 'machine': platform.machine(),
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, out, indent=2)
+        click.echo(f'saved {results_file}')
+    if earlier is not None and compare(results, earlier, threshold):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Benchmark for writing metadata changes.
+
+Compares writing each change as it is made, one `modify_xmp` call per tag,
+with `MetaData.write_changes` which writes them all at once. Bytes written are
+taken from `/proc/self/io` so this needs Linux for that column. The test
+images are made with Pillow, which the `benchmarks` extra installs. Run it
+from the top of the source tree:
+
+    python -m benchmarks.writes [megapixels] [repeats]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pyexiv2
+from PIL import Image
+
+from acdsee_helper import config
+from acdsee_helper import metadata
+from acdsee_helper import xmp
+
+KEYWORDS = ['Things|Cat', 'People|Family|Alice', 'Events|Holiday|Paris']
+SUBJECTS = ['Cat', 'Alice', 'Paris']
+PEOPLE = ['Alice']
+CHANGES = {'Xmp.lr.hierarchicalSubject': KEYWORDS,
+           'Xmp.dc.subject': SUBJECTS,
+           'Xmp.iptcExt.PersonInImage': PEOPLE}
+
+SIDECAR = '''<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">
+   <dc:subject><rdf:Bag><rdf:li>Dog</rdf:li></rdf:Bag></dc:subject>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>'''
+
+options = {
+    'dry_run': False,
+    'verbose': 0,
+    'no_color': True,
+    'config_file': None,
+    'keyword_file': None,
+}
+
+
+def bytes_written():
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def make_images(directory, megapixels):
+    side = int((megapixels * 1000000) ** 0.5)
+    image = Image.effect_noise((side, side), 64).convert('RGB')
+    files = {}
+    for name, kwargs in (('jpg', {'quality': 90}), ('tif', {})):
+        files[name] = os.path.join(directory, f'test.{name}')
+        image.save(files[name], **kwargs)
+    files['xmp'] = os.path.join(directory, 'test.xmp')
+    with open(files['xmp'], 'w') as xmp_file:
+        xmp_file.write(SIDECAR)
+    return files
+
+
+def old_write(file):
+    if file.endswith('.xmp'):
+        image = xmp.XmpSidecar(file)
+        for tag, value in CHANGES.items():
+            image.modify_xmp({tag: value})
+            with open(file, 'wb') as xmp_file:
+                xmp_file.write(image.get_bytes())
+        return
+    image = pyexiv2.Image(file)
+    for tag, value in CHANGES.items():
+        image.modify_xmp({tag: value})
+    image.close()
+
+
+def new_write(cfg, file):
+    m = metadata.MetaData(cfg, file)
+    m.set_keywords(KEYWORDS)
+    m.set_subjects(SUBJECTS)
+    m.set_people(PEOPLE)
+    m.write_changes()
+
+
+def measure(name, write, source, work, repeats):
+    elapsed = 0
+    written = 0
+    for _ in range(repeats):
+        shutil.copy(source, work)
+        before_bytes = bytes_written()
+        start = time.perf_counter()
+        write(work)
+        elapsed += time.perf_counter() - start
+        after_bytes = bytes_written()
+        if before_bytes is not None and after_bytes is not None:
+            written += after_bytes - before_bytes
+    size = os.path.getsize(source)
+    written = f'{written / repeats / 1024:12.0f}' if bytes_written() is not None else f'{"n/a":>12}'
+    print(f'{name:>10}: {size / 1024:10.0f} {written} {elapsed / repeats * 1000:10.1f}')
+
+
+def main():
+    megapixels = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    cfg = config.ACDSeeConfig(options)
+    directory = tempfile.mkdtemp()
+    try:
+        files = make_images(directory, megapixels)
+        print(f'{"":>10}  {"size KiB":>10} {"written KiB":>12} {"ms/file":>10}')
+        for file_type, source in files.items():
+            work = os.path.join(directory, f'work.{file_type}')
+            measure(f'{file_type} old', old_write, source, work, repeats)
+            measure(f'{file_type} new', lambda file: new_write(cfg, file), source, work, repeats)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,11 @@ setup(
         'watchdog',
         'xmltodict',
     ],
+    extras_require={
+        'benchmarks': [
+            'Pillow',
+        ],
+    },
 
     author='Steve Herrell',
     author_email='steve.herrell@gmail.com',
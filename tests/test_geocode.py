@@ -0,0 +1,69 @@
+import random
+import unittest
+
+from geopy import distance
+
+from acdsee_helper.geocode import GeoIndex
+
+# Places around the poles and either side of the antimeridian, where the
+# coordinates wrap, and somewhere ordinary.
+CENTRES = [(89.9995, 0.0), (-89.999, 120.0), (0.0, 179.9999), (45.0, -179.9995), (10.0, 20.0)]
+
+
+def near(rng, centre, radius):
+    # A point up to twice `radius` away from centre.
+    point = distance.distance(meters=rng.uniform(0, 2 * radius)).destination(centre, rng.uniform(0, 360))
+    return point.latitude, point.longitude
+
+
+def brute_force(places, coords, radius):
+    # What GeoIndex.nearest should find, looking at every place.
+    best, best_meters = None, radius
+    for place in places:
+        meters = distance.distance(place, coords).meters
+        if meters < best_meters:
+            best, best_meters = place, meters
+    return best, best_meters
+
+
+class GeoIndexTest(unittest.TestCase):
+
+    def check(self, radius, seed):
+        rng = random.Random(seed)
+        places = [near(rng, rng.choice(CENTRES), radius) for _ in range(80)]
+        index = GeoIndex(radius)
+        for place in places:
+            index.add(place, place)
+
+        for _ in range(30):
+            coords = near(rng, rng.choice(CENTRES), radius)
+            with self.subTest(radius=radius, coords=coords):
+                # Everything within radius has to be a candidate.
+                candidates = {place for place, _ in index.nearby(coords)}
+                for place in places:
+                    if distance.distance(place, coords).meters < radius:
+                        self.assertIn(place, candidates)
+
+                expected, expected_meters = brute_force(places, coords, radius)
+                found, value = index.nearest(coords, radius)
+                if expected is None:
+                    self.assertIsNone(found)
+                else:
+                    self.assertEqual(found, value)
+                    self.assertAlmostEqual(distance.distance(found, coords).meters, expected_meters, places=6)
+
+    def test_50m(self):
+        self.check(50, 1)
+
+    def test_250m(self):
+        self.check(250, 2)
+
+    def test_5km(self):
+        self.check(5000, 3)
+
+    def test_empty(self):
+        self.assertEqual(GeoIndex(250).nearest((45.0, 45.0), 250), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+import locale
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from acdsee_helper import keywords
+
+
+def old_acdsee_to_hash(lines, depth=0):
+    # The recursive parser acdsee_to_hash replaced, it eats `lines`.
+    entries = {}
+    last = None
+    while len(lines) > 0:
+        line = lines[0]
+        sline = line.strip()
+        new_depth = len(line) - len(sline) - 1
+        if new_depth > depth:
+            entries[last] = old_acdsee_to_hash(lines, depth + 1)
+        elif new_depth == depth:
+            entries[sline] = None
+            last = sline
+            lines.pop(0)
+        elif new_depth < depth:
+            return entries
+    return entries
+
+
+def random_hash(rng, depth=0):
+    hash = {}
+    for index in range(rng.randint(1, 4)):
+        topic = f'{"".join(rng.choice("abc xyz") for _ in range(rng.randint(1, 5))).strip() or "t"}{index}'
+        hash[topic] = random_hash(rng, depth + 1) if depth < 4 and rng.random() < 0.4 else None
+    return hash
+
+
+def export(hash):
+    # Lines as the old parser saw them, read from a file with open().
+    return [f'{line}\n' for line in keywords.hash_to_acdsee(hash)]
+
+
+SAMPLE = [
+    'Events\n',
+    '\tHoliday\n',
+    '\t\tRome\n',
+    '\t\tParis\n',
+    'People\n',
+    '\tFamily\n',
+    '\t\tAlice\n',
+    '\t\tBob\n',
+    '\tUnknown\n',
+    'Things\n',
+]
+
+
+class AcdseeToHashTest(unittest.TestCase):
+
+    def test_sample(self):
+        self.assertEqual(keywords.acdsee_to_hash(SAMPLE), {
+            'Events': {'Holiday': {'Rome': None, 'Paris': None}},
+            'People': {'Family': {'Alice': None, 'Bob': None}, 'Unknown': None},
+            'Things': None,
+        })
+
+    def test_matches_old_parser(self):
+        rng = random.Random(11)
+        for _ in range(200):
+            lines = export(random_hash(rng))
+            with self.subTest(lines=lines):
+                self.assertEqual(keywords.acdsee_to_hash(lines), old_acdsee_to_hash(list(lines)))
+
+    def test_round_trip(self):
+        rng = random.Random(12)
+        for _ in range(50):
+            hash = random_hash(rng)
+            self.assertEqual(keywords.acdsee_to_hash(keywords.hash_to_acdsee(hash)), hash)
+
+    def test_last_line_without_newline(self):
+        lines = SAMPLE[:-1] + ['\t\tCarol']
+        self.assertEqual(keywords.acdsee_to_hash(lines)['People']['Unknown'], {'Carol': None})
+
+    def test_blank_lines(self):
+        lines = SAMPLE[:4] + ['\n', '   \n'] + SAMPLE[4:]
+        self.assertEqual(keywords.acdsee_to_hash(lines), keywords.acdsee_to_hash(SAMPLE))
+
+    def test_deep(self):
+        # The old parser recursed once per level and popped from the front of
+        # the list, this has to cope with long and deep files.
+        lines = ['\t' * depth + f'Level{depth}\n' for depth in range(2000)]
+        hash = keywords.acdsee_to_hash(lines)
+        for depth in range(1999):
+            hash = hash[f'Level{depth}']
+        self.assertEqual(hash, {'Level1999': None})
+
+
+class CompileAcdseeFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.file = os.path.join(self._dir.name, 'keywords.txt')
+        self.cache_file = os.path.join(self._dir.name, 'cache', 'keywords.json')
+        keywords.compiled_.clear()
+        self.addCleanup(keywords.compiled_.clear)
+
+    def write(self, lines, encoding=None, newline=None):
+        with open(self.file, 'w', encoding=encoding, newline=newline) as keyword_file:
+            keyword_file.writelines(lines)
+
+    def test_compile(self):
+        self.write(SAMPLE)
+        hash, people = keywords.compile_acdsee_file(self.file, 'People', self.cache_file)
+        self.assertEqual(hash, keywords.acdsee_file_to_hash(self.file))
+        self.assertEqual(people, {'alice': 'People|Family|Alice', 'bob': 'People|Family|Bob',
+                                  'unknown': 'People|Unknown'})
+
+    def test_cached_on_disk(self):
+        self.write(SAMPLE)
+        compiled = keywords.compile_acdsee_file(self.file, 'People', self.cache_file)
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        # A new process only has the file on disk, it mustn't parse again.
+        keywords.compiled_.clear()
+        with mock.patch.object(keywords, 'acdsee_to_hash', side_effect=AssertionError("parsed again")):
+            self.assertEqual(keywords.compile_acdsee_file(self.file, 'People', self.cache_file), compiled)
+
+    def test_changed(self):
+        self.write(SAMPLE)
+        keywords.compile_acdsee_file(self.file, 'People', self.cache_file)
+        self.write(SAMPLE + ['\tToys\n'])
+        os.utime(self.file, (1, 1))
+        hash, _ = keywords.compile_acdsee_file(self.file, 'People', self.cache_file)
+        self.assertEqual(hash['Things'], {'Toys': None})
+
+    def test_people_prefix(self):
+        self.write(SAMPLE)
+        keywords.compile_acdsee_file(self.file, 'People', self.cache_file)
+        _, people = keywords.compile_acdsee_file(self.file, 'Events', self.cache_file)
+        self.assertEqual(people['rome'], 'Events|Holiday|Rome')
+
+    def test_decoded_like_open(self):
+        # The export is read in the locale's encoding, the same as it always
+        # was, and Windows line endings are fine.
+        encoding = locale.getpreferredencoding(False)
+        lines = SAMPLE + ['\tCafé\n']
+        try:
+            ''.join(lines).encode(encoding)
+        except UnicodeEncodeError:
+            lines = SAMPLE
+        self.write(lines, encoding=encoding, newline='\r\n')
+        hash, _ = keywords.compile_acdsee_file(self.file, 'People', self.cache_file)
+        self.assertEqual(hash, keywords.acdsee_file_to_hash(self.file))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+def random_keywords(rng, count):
+    topics = ['Events', 'People', 'Places', 'Things', 'Family', 'Unknown', 'Rome', 'Paris', 'Cat', 'Bob', 'Alice']
+    return [
+        '|'.join(rng.choice(topics) for _ in range(rng.randint(1, 4)))
+        for _ in range(count)
+    ]
+
+
+def sorted_hash(hash):
+    if hash is None:
+        return None
+    return {topic: sorted_hash(hash[topic]) for topic in sorted(hash)}
+
+
+class KeywordTrieTest(unittest.TestCase):
+    # The trie replaced going through the dictionary format with the helpers
+    # below, it has to give the same answers.
+
+    def test_matches_hash_helpers(self):
+        rng = random.Random(12)
+        for _ in range(200):
+            all_keywords = random_keywords(rng, rng.randint(0, 20))
+            trie = keywords.KeywordTrie(all_keywords)
+            hash = keywords.keywords_to_hash(all_keywords)
+            with self.subTest(keywords=all_keywords):
+                self.assertEqual(set(trie.keywords()), keywords.hash_to_keywords(hash))
+                self.assertEqual(trie.to_hash(), hash)
+                self.assertEqual(list(trie.to_acdsee()), keywords.hash_to_acdsee(sorted_hash(hash)))
+                self.assertEqual(set(keywords.KeywordTrie.from_hash(hash).keywords()),
+                                 keywords.hash_to_keywords(hash))
+                for keyword in all_keywords:
+                    self.assertEqual(keyword in trie, keyword in keywords.hash_to_keywords(hash))
+
+    def test_yaml(self):
+        entries = ['Things', {'Family': ['Alice', {'Kids': ['Carol', 'Dave']}]}]
+        trie = keywords.KeywordTrie.from_yaml(entries)
+        self.assertEqual(trie.to_hash(), keywords.yaml_to_hash(entries))
+        self.assertEqual(keywords.KeywordTrie.from_yaml(trie.to_yaml()).to_hash(), trie.to_hash())
+
+        # A topic with nothing under it is a keyword.
+        self.assertEqual(list(keywords.KeywordTrie.from_yaml([{'Empty': None}]).keywords()), ['Empty'])
+
+    def test_merge(self):
+        rng = random.Random(13)
+        for _ in range(50):
+            first, second = random_keywords(rng, 10), random_keywords(rng, 10)
+            trie = keywords.KeywordTrie(first)
+            trie.merge(keywords.KeywordTrie(second))
+            self.assertEqual(trie.to_hash(), keywords.keywords_to_hash(first + second))
+
+    def test_remove(self):
+        trie = keywords.KeywordTrie(['People|Unknown|Bob', 'People|Family|Bob', 'Things|Cat'])
+        trie.remove('People|Unknown|Bob')
+        # Unknown has nothing left under it so it goes too, rather than turn
+        # into a keyword.
+        self.assertEqual(set(trie.keywords()), {'People|Family|Bob', 'Things|Cat'})
+        trie.remove('People|Nobody|Bob')
+        trie.remove('People')
+        self.assertEqual(set(trie.keywords()), {'Things|Cat'})
+
+    def test_keywords_under(self):
+        trie = keywords.KeywordTrie(['People|Family|Bob', 'People|Family|Alice', 'People|Unknown|Bob'])
+        self.assertEqual(sorted(trie.keywords('People|Family')), ['People|Family|Alice', 'People|Family|Bob'])
+        self.assertEqual(list(trie.keywords('People|Family|Bob')), ['People|Family|Bob'])
+        self.assertEqual(list(trie.keywords('Places')), [])
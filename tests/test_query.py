@@ -0,0 +1,83 @@
+import unittest
+
+from acdsee_helper import query
+
+KEYWORDS = ['Places|France|Paris', 'People|Family|Alice', 'Things|Cat|Tabby', 'Events|2020|Holiday']
+
+
+class QueryTest(unittest.TestCase):
+
+    def check(self, text, expected, keywords=KEYWORDS):
+        with self.subTest(query=text):
+            self.assertEqual(query.parse(text).matches(keywords), expected)
+
+    def test_contains(self):
+        self.check('Paris', True)
+        self.check('Family|Ali', True)
+        self.check('London', False)
+        self.check('paris', False)
+        self.check('"France|Paris"', True)
+        self.check('"Tabby Cat"', False)
+        self.check('"Tabby Cat"', True, ['Things|Tabby Cat'])
+
+    def test_exact(self):
+        self.check('=Places|France', True)
+        self.check('=Places|France|Paris', True)
+        self.check('=Places|Fr', False)
+        self.check('=France', False)
+        self.check('="Places|France"', True)
+        self.check('="Things|Tabby Cat"', True, ['Things|Tabby Cat|Ginger'])
+
+    def test_regex(self):
+        self.check(r'/^Events\|20\d\d/', True)
+        self.check(r'/^Events\|19\d\d/', False)
+        self.check('/Cat$/', False)
+        self.check('/Cat/', True)
+        self.check(r'/a\/b/', True, ['a/b'])
+
+    def test_not(self):
+        self.check('not London', True)
+        self.check('not Paris', False)
+        self.check('not not Paris', True)
+
+    def test_and(self):
+        self.check('Paris and Alice', True)
+        self.check('Paris and London', False)
+        self.check('Paris Alice', True)
+        self.check('Paris London', False)
+        self.check('Paris AND Alice', True)
+
+    def test_or(self):
+        self.check('London or Paris', True)
+        self.check('London or Berlin', False)
+        self.check('London OR Paris', True)
+
+    def test_precedence(self):
+        # not binds tighter than and, which binds tighter than or.
+        self.check('London and Paris or Alice', True)
+        self.check('Alice or London and Berlin', True)
+        self.check('(Alice or London) and Berlin', False)
+        self.check('not Paris or Alice', True)
+        self.check('not (Paris or London)', False)
+        self.check('not Paris and Alice', False)
+        self.check('((Paris))', True)
+
+    def test_hint(self):
+        self.assertEqual(query.parse('Paris').hint, 'Paris')
+        self.assertEqual(query.parse('=Places|France').hint, 'Places|France')
+        self.assertEqual(query.parse('"Tabby Cat"').hint, 'Tabby Cat')
+        self.assertIsNone(query.parse('/Paris/').hint)
+        self.assertIsNone(query.parse('not Paris').hint)
+        self.assertIsNone(query.parse('Paris or Alice').hint)
+        self.assertEqual(query.parse('/x/ and Paris and Alice').hint, 'Paris')
+
+    def test_errors(self):
+        for text in ['', '   ', 'Paris and', 'or Paris', 'not', '(Paris', 'Paris)', '()', 'Paris (', '/[/',
+                     '"Paris', 'and']:
+            with self.subTest(query=text):
+                with self.assertRaises(ValueError):
+                    query.parse(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import fnmatch
+import os
+import random
+import tempfile
+import unittest
+
+from acdsee_helper.util import PatternMatcher, copy_file, replace_file
+
+
+def old_match(string, patterns):
+    # How the patterns were checked before PatternMatcher.
+    return any(fnmatch.fnmatch(string, pattern) for pattern in patterns)
+
+
+class PatternMatcherTest(unittest.TestCase):
+
+    def check(self, patterns, strings):
+        matcher = PatternMatcher(patterns)
+        for string in strings:
+            with self.subTest(patterns=patterns, string=string):
+                self.assertEqual(matcher.match(string), old_match(string, patterns))
+
+    def test_no_patterns(self):
+        self.check([], ['', 'a', 'photo.jpg'])
+
+    def test_file_patterns(self):
+        self.check(["*.xmp", "*.tif", "*.tiff", "*.jpg", "*.jpeg", "*.dng"],
+                   ['a.jpg', 'a.jpeg', 'dir/a.tif', 'a.tiff', 'a.tif.bak', 'a.xmp', 'xmp', '.jpg', 'a.JPG', 'a.png'])
+
+    def test_prefixes(self):
+        patterns = ['Events|*', 'People|*', 'Hidden*', 'Places|France|Paris*']
+        self.check(patterns, ['Events|2020', 'Events', 'Events|', 'events|2020', 'People|Family|Bob',
+                              'Hidden', 'Hiddenness', 'Hid', 'Places|France', 'Places|France|Paris',
+                              'Places|France|Paris|Louvre', 'Things|Events|2020', ''])
+
+    def test_everything(self):
+        self.check(['*'], ['', 'a', 'Events|2020'])
+        self.check(['Things|Cat', '*'], ['', 'Things|Dog'])
+
+    def test_wildcards(self):
+        patterns = ['Events|20??|*', '*|Unknown|*', 'Things|[CD]at', 'Places|*|Paris', 'Odd[*]', 'a?c*']
+        self.check(patterns, ['Events|2020|Rome', 'Events|1999|Rome', 'Events|2020', 'People|Unknown|Bob',
+                              'Unknown|Bob', 'Things|Cat', 'Things|Dat', 'Things|Bat', 'Places|France|Paris',
+                              'Places|Paris', 'Odd*', 'Odd', 'abc', 'abcdef', 'ac'])
+
+    def test_regex_characters(self):
+        # Characters that mean something in a regular expression are literal.
+        patterns = ['Things|C++*', 'a.b', 'Events|(2020)*', 'x^y$', 'back\\slash*']
+        self.check(patterns, ['Things|C++', 'Things|C', 'a.b', 'axb', 'Events|(2020)|Rome', 'Events|2020',
+                              'x^y$', 'xy', 'back\\slash', 'backslash'])
+
+    def test_random(self):
+        rng = random.Random(8)
+        alphabet = 'ab|*?'
+        for _ in range(200):
+            patterns = [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 5)))
+                        for _ in range(rng.randint(0, 4))]
+            strings = [''.join(rng.choice('ab|') for _ in range(rng.randint(0, 6))) for _ in range(20)]
+            self.check(patterns, strings)
+
+
+class ReplaceFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.directory.name, 'photo.jpg')
+        with open(self.file, 'wb') as file:
+            file.write(b'old')
+        os.chmod(self.file, 0o640)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replace(self):
+        replace_file(self.file, b'new')
+        with open(self.file, 'rb') as file:
+            self.assertEqual(file.read(), b'new')
+        self.assertEqual(os.stat(self.file).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.directory.name), ['photo.jpg'])
+
+    def test_copy(self):
+        new_file = os.path.join(self.directory.name, 'photo.copy.jpg')
+        copy_file(self.file, new_file)
+        with open(new_file, 'rb') as file:
+            self.assertEqual(file.read(), b'old')
+        self.assertEqual(os.stat(new_file).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['photo.copy.jpg', 'photo.jpg'])
+
+    @unittest.skipUnless(hasattr(os, 'setxattr'), "no extended attributes")
+    def test_extended_attributes(self):
+        try:
+            os.setxattr(self.file, 'user.acdsee_helper', b'kept')
+        except OSError:
+            self.skipTest("file system has no extended attributes")
+        replace_file(self.file, b'new')
+        self.assertEqual(os.getxattr(self.file, 'user.acdsee_helper'), b'kept')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import xml.etree.ElementTree as ET
+
+from acdsee_helper import xmp
+
+SIDECAR = '''<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.4.0-Exiv2">
+ <!-- written by hand -->
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:unused="http://example.com/unused/"
+    xmlns:acdsee="http://ns.acdsee.com/iptc/1.0/"
+    xmp:CreatorTool="ACDSee">
+   <dc:subject>
+    <rdf:Bag>
+     <rdf:li>Cat</rdf:li>
+    </rdf:Bag>
+   </dc:subject>
+   <!-- keep me -->
+   <acdsee:keywords>
+    <rdf:Bag>
+     <rdf:li>Things|Cat</rdf:li>
+    </rdf:Bag>
+   </acdsee:keywords>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>'''
+
+KEYWORDS = '''   <acdsee:keywords>
+    <rdf:Bag>
+     <rdf:li>Things|Cat</rdf:li>
+    </rdf:Bag>
+   </acdsee:keywords>'''
+
+SUBJECT = '''
+   <dc:subject>
+    <rdf:Bag>
+     <rdf:li>Cat</rdf:li>
+    </rdf:Bag>
+   </dc:subject>'''
+
+
+class XmpSidecarTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+
+    def sidecar(self, text=SIDECAR):
+        file = os.path.join(self._dir.name, 'test.xmp')
+        with open(file, 'wb') as xmp_file:
+            xmp_file.write(text.encode('utf-8'))
+        return xmp.XmpSidecar(file)
+
+    def reread(self, data):
+        file = os.path.join(self._dir.name, 'again.xmp')
+        with open(file, 'wb') as xmp_file:
+            xmp_file.write(data)
+        return xmp.XmpSidecar(file).read_xmp()
+
+    def test_read(self):
+        self.assertEqual(self.sidecar().read_xmp(), {
+            'Xmp.xmp.CreatorTool': 'ACDSee',
+            'Xmp.dc.subject': ['Cat'],
+            'Xmp.acdsee.keywords': ['Things|Cat'],
+        })
+
+    def test_unchanged(self):
+        self.assertEqual(self.sidecar().get_bytes(), SIDECAR.encode('utf-8'))
+
+    def test_change_in_place(self):
+        sidecar = self.sidecar()
+        sidecar.modify_xmp({'Xmp.acdsee.keywords': ['Things|Cat', 'Places|Rome & Home']})
+        text = sidecar.get_bytes().decode('utf-8')
+        new_keywords = KEYWORDS.replace('     <rdf:li>Things|Cat</rdf:li>\n',
+                                        '     <rdf:li>Things|Cat</rdf:li>\n'
+                                        '     <rdf:li>Places|Rome &amp; Home</rdf:li>\n')
+        self.assertIn(new_keywords, text)
+        self.assertEqual(text.replace(new_keywords, KEYWORDS), SIDECAR)
+        self.assertEqual(self.reread(text.encode('utf-8'))['Xmp.acdsee.keywords'],
+                         ['Things|Cat', 'Places|Rome & Home'])
+
+    def test_change_attribute(self):
+        sidecar = self.sidecar()
+        sidecar.modify_xmp({'Xmp.xmp.CreatorTool': 'Me "quoted"'})
+        text = sidecar.get_bytes().decode('utf-8')
+        self.assertEqual(text, SIDECAR.replace('xmp:CreatorTool="ACDSee"', 'xmp:CreatorTool="Me &quot;quoted&quot;"'))
+
+    def test_remove(self):
+        sidecar = self.sidecar()
+        sidecar.modify_xmp({'Xmp.dc.subject': None, 'Xmp.xmp.CreatorTool': None})
+        text = sidecar.get_bytes().decode('utf-8')
+        self.assertEqual(text, SIDECAR.replace(SUBJECT, '').replace('\n    xmp:CreatorTool="ACDSee"', ''))
+        self.assertEqual(self.reread(text.encode('utf-8')), {'Xmp.acdsee.keywords': ['Things|Cat']})
+
+    def test_add(self):
+        sidecar = self.sidecar()
+        sidecar.modify_xmp({'Xmp.photoshop.City': 'Rome', 'Xmp.lr.hierarchicalSubject': ['Things|Cat']})
+        sidecar.modify_iptc({'Iptc.Application2.SubLocation': ['Colosseum']})
+        text = sidecar.get_bytes().decode('utf-8')
+
+        # Everything that was there is still there.
+        self.assertIn('<!-- written by hand -->', text)
+        self.assertIn('<!-- keep me -->', text)
+        self.assertIn('xmlns:unused="http://example.com/unused/"', text)
+        self.assertIn(KEYWORDS, text)
+        self.assertTrue(text.startswith(SIDECAR[:SIDECAR.index('\n    xmp:CreatorTool')]))
+        self.assertTrue(text.endswith(SIDECAR[SIDECAR.index('  </rdf:Description>'):]))
+
+        # New namespaces are declared on the description, not the root.
+        description = text[text.index('<rdf:Description'):]
+        self.assertIn('xmlns:photoshop="http://ns.adobe.com/photoshop/1.0/"', description)
+        self.assertIn('xmlns:lr="http://ns.adobe.com/lightroom/1.0/"', description)
+        self.assertIn('xmlns:Iptc4xmpCore="http://iptc.org/std/Iptc4xmpCore/1.0/xmlns/"', description)
+        self.assertNotIn('xmlns:photoshop', text[:text.index('<rdf:Description')])
+
+        self.assertEqual(self.reread(text.encode('utf-8')), {
+            'Xmp.xmp.CreatorTool': 'ACDSee',
+            'Xmp.photoshop.City': 'Rome',
+            'Xmp.dc.subject': ['Cat'],
+            'Xmp.acdsee.keywords': ['Things|Cat'],
+            'Xmp.lr.hierarchicalSubject': ['Things|Cat'],
+            'Xmp.iptc.Location': 'Colosseum',
+        })
+
+    def test_add_to_empty_description(self):
+        sidecar = self.sidecar('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF '
+                               'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+                               '<rdf:Description rdf:about=""/></rdf:RDF></x:xmpmeta>')
+        sidecar.modify_xmp({'Xmp.dc.subject': ['Cat', 'Dog']})
+        self.assertEqual(self.reread(sidecar.get_bytes()), {'Xmp.dc.subject': ['Cat', 'Dog']})
+
+    def test_add_without_description(self):
+        sidecar = self.sidecar('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF '
+                               'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"></rdf:RDF></x:xmpmeta>')
+        sidecar.modify_xmp({'Xmp.xmp.CreatorTool': 'Me', 'Xmp.dc.subject': ['Cat']})
+        self.assertEqual(self.reread(sidecar.get_bytes()), {'Xmp.xmp.CreatorTool': 'Me', 'Xmp.dc.subject': ['Cat']})
+
+    def test_leaves_global_namespaces_alone(self):
+        sidecar = self.sidecar()
+        sidecar.modify_xmp({'Xmp.photoshop.City': 'Rome', 'Xmp.dc.subject': ['Dog']})
+        with mock.patch.object(ET, 'register_namespace', side_effect=AssertionError("called")):
+            sidecar.get_bytes()
+
+    def test_matches_exiv2(self):
+        try:
+            import pyexiv2
+        except ImportError:
+            self.skipTest("pyexiv2 isn't installed")
+        sidecar = self.sidecar()
+        sidecar.modify_xmp({'Xmp.acdsee.keywords': ['Places|Rome'], 'Xmp.photoshop.City': 'Rome',
+                            'Xmp.iptcExt.PersonInImage': ['Alice', 'Bob'], 'Xmp.dc.subject': None})
+        file = os.path.join(self._dir.name, 'exiv2.xmp')
+        with open(file, 'wb') as xmp_file:
+            xmp_file.write(sidecar.get_bytes())
+        image = pyexiv2.Image(file)
+        try:
+            data = image.read_xmp()
+        finally:
+            image.close()
+        self.assertEqual(data['Xmp.acdsee.keywords'], ['Places|Rome'])
+        self.assertEqual(data['Xmp.photoshop.City'], 'Rome')
+        self.assertEqual(data['Xmp.iptcExt.PersonInImage'], ['Alice', 'Bob'])
+        self.assertNotIn('Xmp.dc.subject', data)
+        self.assertEqual(sidecar.read_xmp(), {key: value for key, value in data.items()
+                                              if key in xmp.WANTED_TAGS})
+
+
+if __name__ == '__main__':
+    unittest.main()